@@ -6,7 +6,8 @@ import {finalize} from "rxjs/operators";
 import {NgForm} from "@angular/forms";
 import {
   AdminService,
-  ImportBooksResponse,
+  ExportJob,
+  ImportJob,
   ImportSource,
   NewMarkerQuestionAssignmentForm,
   NewQuestionForm,
@@ -45,6 +46,13 @@ export class AdminTaskComponent implements OnInit {
   importForceUpdate: boolean;
   importing: boolean;
   importProgress: number;
+  importJob: ImportJob;
+
+  exportShardSize: number;
+  exporting: boolean;
+  exportProgress: number;
+  exportJob: ExportJob;
+  exportArchiveUrls: string[];
 
   activeTab: string = 'questions';
 
@@ -148,18 +156,118 @@ export class AdminTaskComponent implements OnInit {
     const archive = fileList.item(0);
 
     this.importing = true;
-    this.adminService.importBooks(this.taskId, this.importSource, archive, this.importFileNames, this.importForceUpdate).pipe(
-      finalize(() => this.importing = false)
-    ).subscribe(
+    this.importJob = null;
+    this.adminService.importBooks(this.taskId, this.importSource, archive, this.importFileNames, this.importForceUpdate).subscribe(
       event => {
         switch (event.type) {
           case HttpEventType.UploadProgress:
             this.importProgress = Math.round(100 * event.loaded / event.total);
             break;
           case HttpEventType.Response:
-            const resp = event.body as ImportBooksResponse;
-            alert(`Imported books: ${resp.num_new_books} new, ${resp.num_updated_books} updated, ${resp.num_skipped_books} skipped`)
+            this.importProgress = 0;
+            this.pollImportJob(event.body as ImportJob);
+        }
+      },
+      error => {
+        this.importing = false;
+        this.error = error.error;
+      }
+    )
+  }
+
+  retryImportJob() {
+    if (!this.importJob)
+      return;
+
+    this.importing = true;
+    this.error = null;
+    this.adminService.retryImportJob(this.importJob.id).subscribe(
+      job => this.pollImportJob(job),
+      error => {
+        this.importing = false;
+        this.error = error.error;
+      }
+    )
+  }
+
+  private pollImportJob(job: ImportJob) {
+    this.importJob = job;
+    if (job.state == 'SUCCESS') {
+      this.importing = false;
+      const result = job.result;
+      alert(`Imported books: ${result.num_new_books} new, ${result.num_updated_books} updated, ${result.num_skipped_books} skipped`);
+      return;
+    }
+    if (job.state == 'FAILURE') {
+      this.importing = false;
+      this.error = job.error;
+      return;
+    }
+    if (job.progress && job.progress.num_students) {
+      this.importProgress = Math.round(100 * job.progress.num_processed_students / job.progress.num_students);
+    }
+    setTimeout(() => {
+      this.adminService.getImportJob(job.id).subscribe(
+        job => this.pollImportJob(job),
+        error => {
+          this.importing = false;
+          this.error = error.error;
         }
+      )
+    }, 2000);
+  }
+
+  exportBooks() {
+    this.exporting = true;
+    this.exportProgress = 0;
+    this.exportJob = null;
+    this.exportArchiveUrls = null;
+    this.adminService.exportBooks(this.taskId, this.exportShardSize).subscribe(
+      job => this.pollExportJob(job),
+      error => {
+        this.exporting = false;
+        this.error = error.error;
+      }
+    )
+  }
+
+  private pollExportJob(job: ExportJob) {
+    this.exportJob = job;
+    if (job.state == 'SUCCESS') {
+      this.exporting = false;
+      this.exportArchiveUrls = [];
+      for (let i = 1; i <= job.job.num_archives; ++i) {
+        this.exportArchiveUrls.push(this.adminService.getExportArchiveUrl(job.id, i));
+      }
+      return;
+    }
+    if (job.state == 'FAILURE') {
+      this.exporting = false;
+      this.error = job.error;
+      return;
+    }
+    if (job.progress && job.progress.num_books) {
+      this.exportProgress = Math.round(100 * job.progress.num_exported_books / job.progress.num_books);
+    }
+    setTimeout(() => {
+      this.adminService.getExportJob(job.id).subscribe(
+        job => this.pollExportJob(job),
+        error => {
+          this.exporting = false;
+          this.error = error.error;
+        }
+      )
+    }, 2000);
+  }
+
+  deleteExportJob(btn: HTMLElement) {
+    btn.classList.add('loading', 'disabled');
+    this.adminService.deleteExportJob(this.exportJob.id).pipe(
+      finalize(() => btn.classList.remove('loading', 'disabled'))
+    ).subscribe(
+      () => {
+        this.exportJob = null;
+        this.exportArchiveUrls = null;
       },
       error => this.error = error.error
     )
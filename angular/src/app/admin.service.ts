@@ -1,6 +1,6 @@
 import {Injectable} from '@angular/core';
 import {Observable} from "rxjs";
-import {MarkerQuestionAssignment, Question, Task} from "./models";
+import {BasicError, MarkerQuestionAssignment, Question, Task} from "./models";
 import {HttpClient, HttpEvent, HttpRequest} from "@angular/common/http";
 
 export class NewTaskForm {
@@ -26,6 +26,56 @@ export class ImportBooksResponse {
   num_updated_books: number;
 }
 
+export class ImportJobProgress extends ImportBooksResponse {
+  num_students: number;
+  num_processed_students: number;
+  current_student: string;
+}
+
+export class ImportJobRecord extends ImportBooksResponse {
+  id: string;
+  task_id: number;
+  importer_type: string;
+  status: string;
+  num_committed_students: number;
+  error_msg?: string;
+  error_detail?: string;
+}
+
+export class ImportJob {
+  id: string;
+  state: string;
+  progress?: ImportJobProgress;
+  result?: ImportBooksResponse;
+  error?: BasicError;
+  job?: ImportJobRecord;
+}
+
+export class ExportJobProgress {
+  num_books: number;
+  num_exported_books: number;
+  num_archives: number;
+}
+
+export class ExportJobRecord {
+  id: string;
+  task_id: number;
+  shard_size?: number;
+  status: string;
+  num_books: number;
+  num_archives: number;
+  error_msg?: string;
+  error_detail?: string;
+}
+
+export class ExportJob {
+  id: string;
+  state: string;
+  progress?: ExportJobProgress;
+  error?: BasicError;
+  job?: ExportJobRecord;
+}
+
 export class ImportSource {
   id: string;
   name: string;
@@ -86,6 +136,30 @@ export class AdminService {
     return this.http.request(req);
   }
 
+  getImportJob(jobId: string): Observable<ImportJob> {
+    return this.http.get<ImportJob>(`${this.api}/import-jobs/${jobId}`)
+  }
+
+  retryImportJob(jobId: string): Observable<ImportJob> {
+    return this.http.post<ImportJob>(`${this.api}/import-jobs/${jobId}/retry`, null)
+  }
+
+  exportBooks(taskId: number, shardSize?: number): Observable<ExportJob> {
+    return this.http.post<ExportJob>(`${this.api}/tasks/${taskId}/export`, {shard_size: shardSize || null})
+  }
+
+  getExportJob(jobId: string): Observable<ExportJob> {
+    return this.http.get<ExportJob>(`${this.api}/export-jobs/${jobId}`)
+  }
+
+  getExportArchiveUrl(jobId: string, index: number): string {
+    return `${this.api}/export-jobs/${jobId}/archives/${index}`
+  }
+
+  deleteExportJob(jobId: string): Observable<any> {
+    return this.http.delete(`${this.api}/export-jobs/${jobId}`)
+  }
+
   deleteBook(bookId: number) :Observable<any>{
     return this.http.delete(`${this.api}/books/${bookId}`)
   }
@@ -2,13 +2,13 @@ import {Component, OnDestroy, OnInit} from '@angular/core';
 import {AnswerBook, AnswerPage, BasicError, Task, User} from "../models";
 import {AnswerService, PDFCache, PDFCacheEntry} from "../answer.service";
 import {ActivatedRoute} from "@angular/router";
-import {concatMap, finalize, takeUntil} from "rxjs/operators";
+import {catchError, concatMap, finalize, first, map, takeUntil} from "rxjs/operators";
 import {HttpEventType} from "@angular/common/http";
 import * as pdfjsLib from "pdfjs-dist/webpack";
 import {TaskService} from "../task.service";
 import {AccountService} from "../account.service";
 import {CaptureSettings} from "../answer-book-capture/answer-book-capture.component";
-import {from, Subject, zip} from "rxjs";
+import {from, interval, of, Subject, zip} from "rxjs";
 import {TitleService} from "../title.service";
 import {environment} from "../../environments/environment";
 
@@ -130,20 +130,53 @@ export class AnswerBookComponent implements OnInit, OnDestroy {
   }
 
   private processPages(pages: AnswerPage[]) {
+    const processingPages = pages.filter(page => page.status == 'processing');
+    if (processingPages.length) {
+      this.waitForProcessedPages(processingPages);
+      pages = pages.filter(page => page.status != 'processing');
+    }
+    pages = pages.filter(page => page.status != 'failed');  // no file stored
     if (pages.length == 0)
       return;
+    // get the final urls of all the files at once, which may be signed urls of the mirror
+    this.answerService.getBookFileUrls(pages[0].book_id).pipe(
+      takeUntil(this.abortLoadFiles)
+    ).subscribe(
+      fileUrls => this.loadPageFiles(pages, fileUrls),
+      error => this.error = error.error
+    )
+  }
+
+  private loadPageFiles(pages: AnswerPage[], fileUrls: { [filePath: string]: string }) {
     const bookId = pages[0].book_id;
+    for (let page of pages) {
+      page['_url'] = fileUrls[page.file_path] || this.answerService.getBookFileUrl(bookId, page.file_path);
+    }
     const pageGroups = this.groupPagesByFilePath(pages);
     const loadTasks = from(pageGroups).pipe(
-      concatMap(group => this.answerService.getBookFile(bookId, group.filePath))
+      concatMap(group => {
+        if (group.filePath.toLowerCase().endsWith('.pdf'))
+          return of(true); // loaded progressively by PDF.js with range requests
+        return this.answerService.getFileByUrl(group.pages[0]['_url']).pipe(
+          map(() => true),
+          catchError(() => {  // keep loading the other files
+            this.error = {msg: `Failed to load file ${group.filePath}`};
+            return of(false);
+          })
+        )
+      })
     );
     zip(pageGroups, loadTasks).pipe(
       takeUntil(this.abortLoadFiles)
     ).subscribe(
-      ([group, data]) => {
+      ([group, loaded]) => {
+        if (!loaded)
+          return;
         if (group.filePath.toLowerCase().endsWith('.pdf')) {
           pdfjsLib.getDocument({
-            data,
+            url: group.pages[0]['_url'],
+            disableAutoFetch: true, // only fetch the ranges needed by the rendered pages
+            disableStream: true,
             cMapUrl: environment.cMapUrl,
             cMapPacked: true
           }).promise.then(
@@ -203,6 +236,27 @@ export class AnswerBookComponent implements OnInit, OnDestroy {
     )
   }
 
+  private waitForProcessedPages(pages: AnswerPage[]) {
+    // the files of the pages are being processed by the server, so check until they are ready
+    for (let page of pages) {
+      interval(2000).pipe(
+        concatMap(() => this.answerService.getPage(page.id)),
+        first(p => p.status != 'processing'),
+        takeUntil(this.abortLoadFiles)
+      ).subscribe(
+        p => {
+          page.status = p.status;
+          page.error = p.error;
+          if (p.status == 'failed')
+            this.error = {msg: 'Failed to process page', detail: p.error};
+          else
+            this.processPages([page]);
+        },
+        error => this.error = error.error
+      )
+    }
+  }
+
   addPages(fileList: FileList) {
     if (!fileList.length)
       return;
@@ -305,23 +359,25 @@ export class AnswerBookComponent implements OnInit, OnDestroy {
 
       if (currentAllLoaded) {
         clearInterval(this.preloadNextCheckerHandler);
-        this.answerService.goToBook(this.bookId, true, true).subscribe(
-          _book => {
-            if (!_book) // no next book
+        this.answerService.prefetchBooks(this.bookId, true, 1).subscribe(
+          books => {
+            if (!books.length) // no next book
               return;
 
+            const _book = books[0];
             this.preloadingNext = true;
             this.preloadNextProgress = 0;
             let countLoaded = 0;
-            const groups = this.groupPagesByFilePath(_book.pages);
-            from(groups).pipe(
-              concatMap(group => this.answerService.getBookFile(_book.id, group.filePath)),
+            const filePaths = Object.keys(_book.file_urls);
+            // the urls may be signed urls of the mirror, which are then cached by the browser directly
+            from(filePaths).pipe(
+              concatMap(filePath => this.answerService.getFileByUrl(_book.file_urls[filePath])),
               takeUntil(this.abortLoadFiles),
               finalize(() => this.preloadingNext = false)
             ).subscribe(
               data => {
                 ++countLoaded;
-                this.preloadNextProgress = Math.round(100 * countLoaded / groups.length);
+                this.preloadNextProgress = Math.round(100 * countLoaded / filePaths.length);
               },
               error => this.error = error.error
             )
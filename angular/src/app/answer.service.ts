@@ -38,6 +38,8 @@ export class PageOptions{
   discardSecond: boolean;
   fitMaxWidth?: number;
   fitMaxHeight?: number;
+  outputFormat?: string; // 'jpg', 'png' or 'webp'
+  outputQuality?: number;
 }
 
 @Injectable({
@@ -70,6 +72,17 @@ export class AnswerService {
       return this.http.get<AnswerBook>(`${this.api}/books/${fromId}/prev`, {params});
   }
 
+  prefetchBooks(fromId: number, isNext: boolean, num: number = 3, skipMarked: boolean = false): Observable<AnswerBook[]> {
+    let params = new HttpParams().append('n', `${num}`);
+    if (skipMarked)
+      params = params.append('skip-marked', 'true');
+
+    if (isNext)
+      return this.http.get<AnswerBook[]>(`${this.api}/books/${fromId}/next/prefetch`, {params});
+    else
+      return this.http.get<AnswerBook[]>(`${this.api}/books/${fromId}/prev/prefetch`, {params});
+  }
+
   addPages(book_id: number, files: File[], options?: PageOptions): Observable<HttpEvent<any>> {
     const form = new FormData();
     for (let file of files) {
@@ -89,10 +102,22 @@ export class AnswerService {
   }
 
   getBookFile(book_id: number, file_path:string): Observable<ArrayBuffer> {
-    return this.http.get(`${this.api}/books/${book_id}/files/${file_path}`,
+    return this.http.get(this.getBookFileUrl(book_id, file_path),
       {responseType: "arraybuffer"});
   }
 
+  getBookFileUrls(book_id: number): Observable<{ [filePath: string]: string }> {
+    return this.http.get<{ [filePath: string]: string }>(`${this.api}/books/${book_id}/file-urls`);
+  }
+
+  getFileByUrl(url: string): Observable<ArrayBuffer> {
+    return this.http.get(url, {responseType: "arraybuffer"});
+  }
+
+  getBookFileUrl(book_id: number, file_path:string): string {
+    return `${this.api}/books/${book_id}/files/${file_path}`;
+  }
+
   addMarking(book_id: number, form: NewMarkingForm):Observable<Marking> {
     return this.http.post<Marking>(`${this.api}/books/${book_id}/markings`, form)
   }
@@ -105,6 +130,10 @@ export class AnswerService {
     return this.http.post<Comment>(`${this.api}/books/${book_id}/comments`, form)
   }
 
+  getPage(page_id: number):Observable<AnswerPage> {
+    return this.http.get<AnswerPage>(`${this.api}/pages/${page_id}`)
+  }
+
   updatePage(page_id: number, form: UpdateAnswerPageForm):Observable<AnswerPage> {
     return this.http.put<AnswerPage>(`${this.api}/pages/${page_id}`, form)
   }
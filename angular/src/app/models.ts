@@ -93,6 +93,8 @@ export class AnswerBook {
   pages?: AnswerPage[];
   markings?: Marking[];
   comments?: Comment[];
+
+  file_urls?: { [filePath: string]: string };
 }
 
 export class AnswerPage {
@@ -103,6 +105,8 @@ export class AnswerPage {
   file_path: string;
   file_index?: number;
   transform: string;
+  status: 'processing' | 'failed' | 'ready';
+  error?: string;
 
   creator_id?: number;
   modifier_id?: number;
@@ -1,24 +1,21 @@
 import os
 import shutil
-import sys
-import tempfile
-from collections import defaultdict
+from datetime import timedelta
 from uuid import uuid4
 
-from flask import Blueprint, jsonify, request, current_app as app
+from flask import Blueprint, jsonify, request, current_app as app, send_from_directory
 
-from async_job_worker import run_book_mirror
+from async_job_worker import run_books_import, run_books_export, run_files_delete, is_task_active
 from auth_connect.oauth import requires_admin
 from models import db
 from services.account import AccountService, AccountServiceError
 from services.answer import AnswerService, AnswerServiceError
+from services.book_export import BookExportService, BookExportServiceError
+from services.book_import import BookImportService, BookImportServiceError
 from services.task import TaskService, TaskServiceError
-from utils.crypt import md5sum
-from utils.give import GiveImporter
-from utils.importer import ImporterError, GenericImporter
-from utils.mirror import MirrorTool
-from utils.pdf import get_pdf_pages, PDFError
-from utils.submit import SubmitImporter
+from utils.ip import IPTool
+from utils.pdf import get_pdf_pages_cache_stats
+from utils.upload import UploadTool
 
 admin_api = Blueprint('admin_api', __name__)
 
@@ -95,6 +92,16 @@ def do_task_assignments(tid):
 
         params = request.json
         question = TaskService.get_question(params.get('qid'))
+        marker_names = params.get('marker_names')
+        if marker_names is not None:  # assign many markers at once
+            if not isinstance(marker_names, list):
+                return jsonify(msg='marker names must be a list'), 400
+            markers = AccountService.sync_users_by_names(marker_names)
+            assignments = [TaskService.add_marker_question_assignment(question, markers[name])
+                           for name in dict.fromkeys(marker_names)]
+            db.session.commit()
+            return jsonify([ass.to_dict(with_marker=True) for ass in assignments]), 201
+
         marker = AccountService.sync_user_by_name(params.get('marker_name'))
 
         ass = TaskService.add_marker_question_assignment(question, marker)
@@ -138,137 +145,138 @@ def import_books(tid: int):
         archive = request.files.get('archive')
         file_names_str = request.form.get('file_names')
         force_update = request.form.get('force_update') == 'true'
-
-        if request.path.endswith('/import-generic'):
-            importer = GenericImporter
-        elif request.path.endswith('/import-give'):
-            importer = GiveImporter
-        else:  # /import-submit
-            importer = SubmitImporter
+        importer_type = request.path.rsplit('/import-', 1)[-1]
 
         if not archive:
             return jsonify(msg='archive file is required'), 400
-        if not file_names_str:
-            return jsonify(msg='file names are required'), 400
+        file_names = BookImportService.get_file_names(importer_type, file_names_str)
+
+        # save the archive to the data folder so that the async job worker can access it (and retry the job)
+        job_id = str(uuid4())
+        work_dir = os.path.join('import_jobs', job_id)
+        archive_name = os.path.basename(archive.filename) or 'archive'
+        BookImportService.add_job(job_id, task, importer_type, file_names, force_update, work_dir, archive_name)
+        full_work_dir = os.path.join(app.config['DATA_FOLDER'], work_dir)
+        os.makedirs(full_work_dir)
+        UploadTool.save(archive, os.path.join(full_work_dir, archive_name))
+        db.session.commit()
+
+        run_books_import.apply_async((job_id,), task_id=job_id)
+        return jsonify(id=job_id), 202
+    except (TaskServiceError, BookImportServiceError) as e:
+        return jsonify(msg=e.msg, detail=e.detail), 400
+
+
+@admin_api.route('/import-jobs/<string:job_id>')
+@requires_admin
+def get_import_job(job_id: str):
+    try:
+        job = BookImportService.get_job(job_id)
+        if job is None:
+            return jsonify(msg='import job not found'), 404
+
+        return jsonify(_get_job_state(job, run_books_import.AsyncResult(job_id), 'import job failed'))
+    except BookImportServiceError as e:
+        return jsonify(msg=e.msg, detail=e.detail), 400
+
 
-        file_names = []
-        if importer == GenericImporter:  # use fixed filename
-            file_names = [GenericImporter.PDF_FILE_NAME]
+def _get_job_state(job, result, failed_msg: str) -> dict:
+    """Get the state of a background job from its record and its async result, in which a returned error fails it."""
+    d = dict(id=job.id, state=result.state, progress=None, result=None, error=None, job=job.to_dict())
+    if job.status == 'pending' and result.ready():
+        # the result of the previous attempt of a retried job, which is not picked up by a worker yet
+        d['state'] = 'PENDING'
+    elif result.state == 'PROGRESS':
+        d['progress'] = result.info
+    elif result.state == 'SUCCESS':
+        job_result = result.result
+        if job_result.get('error'):
+            d['state'] = 'FAILURE'
+            d['error'] = job_result['error']
         else:
-            for name in file_names_str.split(','):
-                name = name.strip()
-                if name:
-                    file_names.append(name)
-        if not file_names:
-            return jsonify(msg='file names are required'), 400
+            d['result'] = job_result
+    elif result.state == 'FAILURE':
+        d['error'] = dict(msg=failed_msg, detail=str(result.info))
+    return d
 
-        data_folder = app.config['DATA_FOLDER']
 
-        num_new_books = 0
-        num_skipped_books = 0
-        num_updated_books = 0
-        with tempfile.TemporaryDirectory() as work_dir:
-            archive_path = os.path.join(work_dir, archive.filename)
-            archive.save(archive_path)
-            extract_dir = os.path.join(work_dir, '_extract')
-            os.mkdir(extract_dir)
-
-            copy_info = []
-            for student_id, submissions_info in importer(file_names).import_archive(archive_path, extract_dir):
-                student = AccountService.sync_user_by_name(student_id)
-                if not submissions_info:  # no submission
-                    continue  # ignore
-
-                files_to_find = set(file_names)
-                files_found = {}
-                submission_time = None
-                for i, (_time, files) in enumerate(reversed(submissions_info)):  # from the latest to the oldest
-                    for name, tmp_path in files.items():
-                        if name in files_to_find:  # not yet found
-                            if i != 0:  # not the latest
-                                print('[Warning] Importing "%s" from non-default submission for student "%s"'
-                                      % (name, student_id), file=sys.stderr)
-                            files_to_find.remove(name)
-                            files_found[name] = (_time, tmp_path)
-                            if submission_time is None or submission_time < _time:
-                                submission_time = _time
-                    if not files_to_find:  # all files found
-                        break
-
-                # find if a book exists
-                book = AnswerService.get_book_by_task_student(task, student)
-                if book is not None:  # already imported
-                    if not force_update and book.submitted_at is not None and book.submitted_at == submission_time:
-                        num_skipped_books += 1  # skip if same submission time
-                        continue
-                    else:  # update to latest version
-                        book_folder = os.path.join(data_folder, 'answer_books', str(book.id))
-                        old_path_pages = defaultdict(list)
-                        for page in book.pages:
-                            old_path_pages[page.file_path].append(page)
-
-                        has_content_change = False
-                        for file_name, (_time, tmp_path) in files_found.items():
-                            path = file_name  # directly use the file name as path
-                            old_pages = old_path_pages.get(path)
-                            if old_pages:  # file exists
-                                if md5sum(os.path.join(book_folder, path)) == md5sum(tmp_path):  # same file content
-                                    continue  # skip importing this file
-                                for page in old_pages:  # delete outdated pages
-                                    # file will be overwritten, so no file deletion is required
-                                    AnswerService.delete_page(page)
-                            ext = os.path.splitext(file_name)[-1]
-                            if ext == '.pdf':  # split pdf pages
-                                try:
-                                    num_pages = get_pdf_pages(tmp_path)
-                                except PDFError as e:
-                                    print('[Warning] Failed to get pdf info of: %s (%s)' % (tmp_path, e.msg),
-                                          file=sys.stderr)
-                                    continue
-                                AnswerService.add_multi_pages(book, path, num_pages)
-                            else:
-                                AnswerService.add_page(book, path)
-                            has_content_change = True
-                            copy_info.append((tmp_path, book, path))
-
-                        book.submitted_at = submission_time
-                        if has_content_change:  # invalidate existing markings because content has changed
-                            for m in book.markings:
-                                db.session.delete(m)
-                        num_updated_books += 1
-                else:  # create new book
-                    book = AnswerService.add_book(task, student, submitted_at=submission_time)
-                    num_new_books += 1
-
-                    for file_name, (_time, tmp_path) in files_found.items():
-                        path = file_name  # directly use the file name as path since no conflict could occur here
-                        ext = os.path.splitext(file_name)[-1]
-                        if ext == '.pdf':  # split pdf pages
-                            try:
-                                num_pages = get_pdf_pages(tmp_path)
-                            except PDFError as e:
-                                print('[Warning] Failed to get pdf info of: %s (%s)' % (tmp_path, e.msg),
-                                      file=sys.stderr)
-                                continue
-                            AnswerService.add_multi_pages(book, path, num_pages)
-                        else:
-                            AnswerService.add_page(book, path)
-                        copy_info.append((tmp_path, book, path))
-
-            # do actual file copies at last
-            for tmp_path, book, path in copy_info:
-                book_path = os.path.join(data_folder, 'answer_books', str(book.id))
-                to_path = os.path.join(book_path, path)
-                to_dir_path = os.path.dirname(to_path)
-                if not os.path.exists(to_dir_path):
-                    os.makedirs(to_dir_path)
-                shutil.copy(tmp_path, to_path)
-                run_book_mirror.apply_async((book.id, path))
+@admin_api.route('/import-jobs/<string:job_id>/retry', methods=['POST'])
+@requires_admin
+def retry_import_job(job_id: str):
+    try:
+        job = BookImportService.get_job(job_id)
+        if job is None:
+            return jsonify(msg='import job not found'), 404
 
+        BookImportService.retry_job(job, job.status == 'running' and is_task_active(job_id))
         db.session.commit()
-        return jsonify(num_new_books=num_new_books, num_skipped_books=num_skipped_books,
-                       num_updated_books=num_updated_books)
-    except (TaskServiceError, ImporterError, AccountServiceError, AnswerServiceError) as e:
+
+        # reuse the id, so that the job can be polled in the same way
+        run_books_import.apply_async((job_id,), task_id=job_id)
+        return jsonify(id=job_id), 202
+    except BookImportServiceError as e:
+        return jsonify(msg=e.msg, detail=e.detail), 400
+
+
+@admin_api.route('/tasks/<int:tid>/export', methods=['POST'])
+@requires_admin
+def export_books(tid: int):
+    try:
+        task = TaskService.get(tid)
+        if task is None:
+            return jsonify(msg='task not found'), 404
+
+        params = request.json or {}
+        # the archives are kept for downloading until deleted, or until expired (checked when exporting again)
+        expired_work_dirs = BookExportService.delete_expired_jobs(
+            timedelta(days=app.config.get('EXPORT_EXPIRY_DAYS') or 7))
+        job_id = str(uuid4())
+        BookExportService.add_job(job_id, task, params.get('shard_size'), os.path.join('export_jobs', job_id))
+        db.session.commit()
+        for work_dir in expired_work_dirs:
+            shutil.rmtree(os.path.join(app.config['DATA_FOLDER'], work_dir), ignore_errors=True)
+
+        run_books_export.apply_async((job_id,), task_id=job_id)
+        return jsonify(id=job_id), 202
+    except (TaskServiceError, BookExportServiceError) as e:
+        return jsonify(msg=e.msg, detail=e.detail), 400
+
+
+@admin_api.route('/export-jobs/<string:job_id>', methods=['GET', 'DELETE'])
+@requires_admin
+def do_export_job(job_id: str):
+    try:
+        job = BookExportService.get_job(job_id)
+        if job is None:
+            return jsonify(msg='export job not found'), 404
+
+        if request.method == 'DELETE':
+            BookExportService.delete_job(job)
+            db.session.commit()
+            shutil.rmtree(os.path.join(app.config['DATA_FOLDER'], job.work_dir), ignore_errors=True)
+            return "", 204
+
+        return jsonify(_get_job_state(job, run_books_export.AsyncResult(job_id), 'export job failed'))
+    except BookExportServiceError as e:
+        return jsonify(msg=e.msg, detail=e.detail), 400
+
+
+@admin_api.route('/export-jobs/<string:job_id>/archives/<int:index>')
+@requires_admin
+def download_export_archive(job_id: str, index: int):
+    try:
+        job = BookExportService.get_job(job_id)
+        if job is None:
+            return jsonify(msg='export job not found'), 404
+        if job.status != 'finished':
+            return jsonify(msg='export job not finished'), 400
+        if not 1 <= index <= job.num_archives:
+            return jsonify(msg='archive not found'), 404
+
+        archive_name = BookExportService.get_archive_name(job, index)
+        return send_from_directory(app.config['DATA_FOLDER'], BookExportService.get_archive_path(job, index),
+                                   as_attachment=True, attachment_filename=archive_name, cache_timeout=0)
+    except BookExportServiceError as e:
         return jsonify(msg=e.msg, detail=e.detail), 400
 
 
@@ -282,22 +290,13 @@ def delete_book(bid: int):
 
         file_paths = AnswerService.delete_book(book)
 
-        data_folder = app.config['DATA_FOLDER']
+        # the files are removed (also from the mirror) in background after the deletion is committed
         book_path = os.path.join('answer_books', str(book.id))
-        book_folder = os.path.join(data_folder, book_path)
-        if os.path.exists(book_folder):
-            for path in file_paths:
-                full_path = os.path.join(book_folder, path)
-                if os.path.exists(full_path):
-                    os.remove(full_path)
-                if MirrorTool.enabled:
-                    remote_path = os.path.join(book_path, path)
-                    if MirrorTool.exists(remote_path):
-                        MirrorTool.delete(remote_path)
-            if not os.listdir(book_folder):
-                os.rmdir(book_folder)
-
+        removed_paths = [os.path.join(book_path, path) for path in file_paths]
+        removed_paths.extend(AnswerService.collect_orphan_blobs())
         db.session.commit()
+
+        run_files_delete.apply_async((removed_paths, [book_path]))
         return "", 204
     except AnswerServiceError as e:
         return jsonify(msg=e.msg, detail=e.detail), 400
@@ -313,19 +312,14 @@ def delete_page(pid: int):
 
         file_path = AnswerService.delete_page(page)
 
+        removed_paths = []
         if file_path:
-            data_folder = app.config['DATA_FOLDER']
-            book_path = os.path.join('answer_books', str(page.book_id))
-            book_folder = os.path.join(data_folder, book_path)
-            full_path = os.path.join(book_folder, file_path)
-            if os.path.exists(full_path):
-                os.remove(full_path)
-            if MirrorTool.enabled:
-                remote_path = os.path.join(book_path, file_path)
-                if MirrorTool.exists(remote_path):
-                    MirrorTool.delete(remote_path)
-
+            removed_paths.append(os.path.join('answer_books', str(page.book_id), file_path))
+            removed_paths.extend(AnswerService.collect_orphan_blobs())
         db.session.commit()
+
+        if removed_paths:
+            run_files_delete.apply_async((removed_paths,))
         return "", 204
     except AnswerServiceError as e:
         return jsonify(msg=e.msg, detail=e.detail), 400
@@ -357,7 +351,7 @@ def do_task_materials(tid: int):
         folder_path = os.path.dirname(full_path)
         if not os.path.exists(folder_path):
             os.makedirs(folder_path)
-        file.save(full_path)
+        UploadTool.save(file, full_path)
 
         db.session.commit()
         return jsonify(material.to_dict()), 201
@@ -381,3 +375,10 @@ def do_material(mid: int):
         return '', 204
     except TaskServiceError as e:
         return jsonify(msg=e.msg, detail=e.detail), 400
+
+
+@admin_api.route('/cache-stats')
+@requires_admin
+def get_cache_stats():
+    """Get the counters of the in-memory caches of the process serving this request."""
+    return jsonify(geoip=IPTool.get_cache_stats(), pdf_pages=get_pdf_pages_cache_stats())
@@ -1,23 +1,31 @@
 import json
 import os
-import shutil
+import sys
 import tempfile
 import uuid
-import zipfile
+from typing import Tuple, Optional, Dict
 
-from flask import Blueprint, jsonify, request, current_app as app, send_from_directory, redirect
+from flask import Blueprint, jsonify, request, current_app as app, send_from_directory, redirect, url_for
+from werkzeug.datastructures import FileStorage
 
-from async_job_worker import run_book_mirror
+from async_job_worker import run_files_mirror, run_pages_render, run_pages_process
 from auth_connect.oauth import requires_login
-from models import db
+from models import db, AnswerBook, AnswerFile
 from services.account import AccountService, AccountServiceError
 from services.answer import AnswerService, AnswerServiceError
 from services.marking import MarkingService, MarkingServiceError
+from services.mirror import MirrorService
 from services.task import TaskService, TaskServiceError
-from utils.image import process_image
+from utils.crypt import md5sum
+from utils.image import ImagePipeline, ImageTranscoder, get_output_ext, get_num_outputs
 from utils.ip import IPTool
 from utils.mirror import MirrorTool
-from utils.pdf import get_pdf_pages, PDFError
+from utils.pdf import PDFError
+from utils.render import RenderTool
+from utils.send import send_file_with_digest, send_stream_as_attachment
+from utils.store import FileStore
+from utils.upload import UploadTool
+from utils.zip_stream import stream_zip
 
 answer_api = Blueprint('answer_api', __name__)
 
@@ -82,6 +90,62 @@ def go_to_book(bid: int):
         return jsonify(msg=e.msg, detail=e.detail), 400
 
 
+@answer_api.route('/books/<int:bid>/next/prefetch')
+@answer_api.route('/books/<int:bid>/prev/prefetch')
+@requires_login
+def prefetch_books(bid: int):
+    """
+    Get the books to be visited in turn from a book (n books, 3 by default), each with its pages and the urls of its
+    files (file_urls by file path), so that the client can load them in background.
+    """
+    try:
+        book = AnswerService.get_book(bid)
+        if book is None:
+            return jsonify(msg='book not found'), 404
+
+        if request.args.get('skip-marked') == 'true':
+            user = AccountService.get_current_user()
+            if user is None:
+                return jsonify(msg='user info required'), 500
+            skip_marked_by = user
+        else:
+            skip_marked_by = None
+
+        num_books = request.args.get('n', 3, type=int)
+        if not 1 <= num_books <= 10:
+            return jsonify(msg='invalid number of books', detail='n must be between 1 and 10'), 400
+
+        books = AnswerService.go_to_books(book, request.path.endswith('/next/prefetch'), skip_marked_by, num_books)
+        files = AnswerService.get_files_by_books(b.id for b in books)
+        mirror_preferred = _is_mirror_preferred()
+        manifest = []
+        for book2 in books:
+            book_dict = book2.to_dict(with_pages=True)
+            book_dict['file_urls'] = _get_file_urls(book2, files[book2.id], mirror_preferred)
+            manifest.append(book_dict)
+        db.session.commit()  # the mirror states may be updated
+        return jsonify(manifest)
+    except (AccountServiceError, AnswerServiceError) as e:
+        return jsonify(msg=e.msg, detail=e.detail), 400
+
+
+@answer_api.route('/books/<int:bid>/file-urls')
+@requires_login
+def get_book_file_urls(bid: int):
+    """Get the urls to download all the files of a book from, by file path, which saves a redirect per file."""
+    try:
+        book = AnswerService.get_book(bid)
+        if book is None:
+            return jsonify(msg='book not found'), 404
+
+        files = AnswerService.get_files_by_books([book.id])[book.id]
+        file_urls = _get_file_urls(book, files, _is_mirror_preferred())
+        db.session.commit()  # the mirror states may be updated
+        return jsonify(file_urls)
+    except (AccountServiceError, AnswerServiceError) as e:
+        return jsonify(msg=e.msg, detail=e.detail), 400
+
+
 @answer_api.route('/books/<int:bid>/pages', methods=['POST'])
 @requires_login
 def do_book_pages(bid: int):
@@ -115,7 +179,8 @@ def do_book_pages(bid: int):
         if not os.path.exists(full_book_folder):
             os.makedirs(full_book_folder)
 
-        pages = []
+        # receive all the uploads first, so that the images to be transcoded can be transcoded in parallel
+        uploads = []
         for file in file_list:
             ext = os.path.splitext(file.filename)[-1].lower()
             num_tries = 0
@@ -129,47 +194,111 @@ def do_book_pages(bid: int):
                 if num_tries > 10:
                     return jsonify(msg='failed to generate a new path'), 500
 
-            if ext == '.pdf':  # split pdf pages
-                with tempfile.TemporaryDirectory() as tmp_dir:
-                    tmp_path = os.path.join(tmp_dir, 'file.pdf')
-                    file.save(tmp_path)
+            # the upload is usually staged in the data folder and hashed while being received
+            upload_path, upload_md5 = _get_upload(file, full_book_folder, random_id, ext)
+            uploads.append((random_id, ext, upload_path, upload_md5))
+
+        pages = []
+        mirror_paths = []
+        render_info = []
+        process_info = []
+        # process in the staging folder, so that the outputs can be moved into place by renaming
+        with tempfile.TemporaryDirectory(dir=UploadTool.get_staging_folder()) as tmp_dir:
+            transcoded_img_paths = {}
+            img_uploads = [upload for upload in uploads if upload[1] != '.pdf']
+            if img_uploads and not options and ImageTranscoder.enabled:
+                try:
+                    results = ImagePipeline.transcode_images([upload[2] for upload in img_uploads], tmp_dir)
+                except Exception as e:  # e.g. a broken pool, so the images are stored as uploaded
+                    print('[Warning] Failed to transcode images (%s)' % e, file=sys.stderr)
+                    results = [upload[2] for upload in img_uploads]
+                for upload, output_path in zip(img_uploads, results):
+                    if output_path != upload[2]:  # not transcoded if no gain
+                        transcoded_img_paths[upload[0]] = output_path
+
+            for random_id, ext, upload_path, upload_md5 in uploads:
+                path = random_id + ext
+                if ext == '.pdf':  # split pdf pages
                     try:
-                        num_pages = get_pdf_pages(tmp_path)
+                        num_pages = AnswerService.get_pdf_pages(upload_path, upload_md5)
                     except PDFError as e:
                         return jsonify(msg=e.msg, detail=e.detail), 500
                     pages.extend(AnswerService.add_multi_pages(book, path, num_pages, creator=user))
-                    shutil.copyfile(tmp_path, full_path)
-                    run_book_mirror.apply_async((book.id, path))
-            else:
-                if options:
-                    with tempfile.TemporaryDirectory() as tmp_dir:
-                        tmp_path = os.path.join(tmp_dir, 'file' + ext)
-                        file.save(tmp_path)
-                        try:
-                            processed_img_paths = process_image(tmp_path, options, tmp_dir)
-                        except Exception as e:
-                            return jsonify(msg='Failed to process image', detail=str(e)), 400
-
-                        for i, output_img_path in enumerate(processed_img_paths):
-                            if i == 0:
-                                alt_path = path  # keep the path of the first as the original path
-                            else:
-                                alt_path = '%s_%d%s' % (random_id, i, ext)
-                            page = AnswerService.add_page(book, alt_path, creator=user)
-                            shutil.copy(output_img_path, os.path.join(data_folder, book_folder, alt_path))
-                            run_book_mirror.apply_async((book.id, alt_path))
-                            pages.append(page)
+                    mirror_paths.append(AnswerService.store_file(book, path, upload_path, upload_md5, move=True))
+                    render_info.append((path, upload_md5, list(range(1, num_pages + 1))))
+                elif options:
+                    # the image is processed in background, and the pages are ready once their files are stored
+                    process_options = ImageTranscoder.apply_to_options(options)
+                    try:
+                        output_ext = get_output_ext(ext, process_options)  # may be converted to another format
+                    except ValueError as e:
+                        return jsonify(msg='Failed to process image', detail=str(e)), 400
+                    processing_pages = []
+                    for i in range(get_num_outputs(process_options)):
+                        if i == 0:
+                            alt_path = random_id + output_ext  # keep the path of the first as the original path
+                        else:
+                            alt_path = '%s_%d%s' % (random_id, i, output_ext)
+                        page = AnswerService.add_page(book, alt_path, creator=user)
+                        AnswerService.set_page_processing(page)
+                        processing_pages.append(page)
+                    pages.extend(processing_pages)
+                    source_path = os.path.join('tmp', 'processing', path)
+                    FileStore.put(upload_path, source_path, move=True)
+                    original_path = None
+                    if ImageTranscoder.keep_original:
+                        original_path = FileStore.get_original_path(random_id, ext)
+                    process_info.append((processing_pages, source_path, upload_md5, process_options, original_path))
                 else:
+                    img_path, img_md5 = upload_path, upload_md5
+                    transcoded_img_path = transcoded_img_paths.get(random_id)
+                    if transcoded_img_path:
+                        path = random_id + os.path.splitext(transcoded_img_path)[-1]
+                        img_path, img_md5 = transcoded_img_path, md5sum(transcoded_img_path)
+                        if ImageTranscoder.keep_original:
+                            _store_original(book, random_id, ext, upload_path, upload_md5)
                     page = AnswerService.add_page(book, path, index=params.get('index'), creator=user)
-                    file.save(full_path)
-                    run_book_mirror.apply_async((book.id, path))
+                    mirror_paths.append(AnswerService.store_file(book, path, img_path, img_md5, move=True))
+                    render_info.append((path, img_md5, [None]))
                     pages.append(page)
+        mirror_paths = [path for path in mirror_paths if path]  # skip mirroring if the content is already stored
+        MirrorService.set_queued(mirror_paths)
         db.session.commit()
+        for processing_pages, source_path, md5, process_options, original_path in process_info:
+            run_pages_process.apply_async((book.id, [page.id for page in processing_pages], source_path, md5,
+                                           process_options, original_path))
+        if mirror_paths:
+            run_files_mirror.apply_async((mirror_paths,))
+        if RenderTool.enabled:
+            for path, md5, file_indices in render_info:
+                run_pages_render.apply_async((FileStore.get_book_file_path(book.id, path), md5, file_indices))
         return jsonify([page.to_dict(with_annotations=True, with_creator=True) for page in pages]), 201
     except (AccountServiceError, AnswerServiceError) as e:
         return jsonify(msg=e.msg, detail=e.detail), 400
 
 
+def _store_original(book: AnswerBook, random_id: str, ext: str, upload_path: str, upload_md5: str):
+    """
+    Store the original upload of a transcoded image next to it. It is not referenced by any page, so it
+    is only removed with the book, and it is not mirrored since it is rarely needed.
+    """
+    AnswerService.store_file(book, FileStore.get_original_path(random_id, ext), upload_path, upload_md5, move=True)
+
+
+def _get_upload(file: FileStorage, folder: str, random_id: str, ext: str) -> Tuple[str, str]:
+    """
+    Get the path and md5 of an uploaded file. If the file has not been staged (e.g. the request is not parsed by the
+    request class of the app), save it into folder first.
+    """
+    staged = UploadTool.get_staged(file)
+    if staged is not None:
+        staged.flush()
+        return staged.path, staged.md5
+    tmp_path = os.path.join(folder, '.%s.upload%s' % (random_id, ext))
+    file.save(tmp_path)
+    return tmp_path, md5sum(tmp_path)
+
+
 @answer_api.route('/books/<int:bid>/files/<path:file_path>')
 @requires_login
 def do_book_file(bid: int, file_path: str):
@@ -182,15 +311,84 @@ def do_book_file(bid: int, file_path: str):
         book_path = os.path.join('answer_books', str(book.id))
         book_folder = os.path.join(data_folder, book_path)
 
-        if MirrorTool.enabled:
-            region = IPTool.get_ip_country(IPTool.get_client_ip(request))
-            if region:
-                region = region.lower()
-            if MirrorTool.is_region_supported(region):
-                remote_path = os.path.join(book_path, file_path)
-                if MirrorTool.exists(remote_path):
-                    return redirect(MirrorTool.get_url(remote_path))
-        return send_from_directory(book_folder, file_path)
+        file = AnswerService.get_file(book, file_path)
+        if _is_mirror_preferred():
+            mirror_url = _get_mirror_url(book.id, file_path, file)
+            db.session.commit()  # the mirror state may be updated
+            if mirror_url:
+                return redirect(mirror_url)
+        if file is None:  # stored before the digests were recorded
+            return send_file_with_digest(book_folder, file_path)
+        return send_file_with_digest(book_folder, file_path, file.md5, file.size, file.mtime)
+    except AnswerServiceError as e:
+        return jsonify(msg=e.msg, detail=e.detail), 400
+
+
+def _get_file_urls(book: AnswerBook, files: Dict[str, AnswerFile], mirror_preferred: bool) -> Dict[str, str]:
+    """
+    Get the urls of the files of the pages of a book (except the pages being processed), which are the mirror urls
+    if the mirror is preferred and the files are mirrored, otherwise the urls of do_book_file.
+    """
+    file_urls = {}
+    for page in book.pages:
+        if page.file_path in file_urls or page.processing is not None:
+            continue
+        mirror_url = _get_mirror_url(book.id, page.file_path, files.get(page.file_path)) if mirror_preferred else None
+        file_urls[page.file_path] = mirror_url or url_for('.do_book_file', bid=book.id, file_path=page.file_path)
+    return file_urls
+
+
+def _get_mirror_url(book_id: int, file_path: str, file: Optional[AnswerFile]) -> Optional[str]:
+    """
+    Get the url of a book file in the mirror, or None if it is not mirrored yet. The state of a file mirrored before
+    the states were recorded may be added, which should be committed by the caller.
+    """
+    remote_path = FileStore.get_stored_path(book_id, file_path, file.blob_md5 if file else None)
+    if MirrorService.is_mirrored(remote_path):
+        return MirrorTool.get_url(remote_path)
+    return None
+
+
+def _is_mirror_preferred() -> bool:
+    """Check if the client should be redirected to the file mirror of its region."""
+    if not MirrorTool.enabled:
+        return False
+    return IPTool.get_ip_region(IPTool.get_client_ip(request), MirrorTool.get_regions()) is not None
+
+
+@answer_api.route('/pages/<int:pid>/render')
+@requires_login
+def render_page(pid: int):
+    """Get a pre-rendered image of a page, with the smallest width that is at least the requested width (w)."""
+    try:
+        if not RenderTool.enabled:
+            return jsonify(msg='page rendering disabled'), 404
+
+        page = AnswerService.get_page(pid)
+        if page is None:
+            return jsonify(msg='page not found'), 404
+
+        file = AnswerService.get_file(page.book, page.file_path)
+        if file is None:  # stored before the digests were recorded
+            return jsonify(msg='page rendition not available'), 404
+
+        width = RenderTool.choose_width(request.args.get('w', type=int))
+        rendition_path = RenderTool.get_rendition_path(file.md5, page.file_index, width)
+        if not os.path.exists(FileStore.get_full_path(rendition_path)):
+            if RenderTool.mark_pending(file.md5, page.file_index):  # not queued yet
+                file_indices = [page.file_index]
+                run_pages_render.apply_async((FileStore.get_book_file_path(page.book_id, page.file_path), file.md5,
+                                              file_indices))
+            return jsonify(msg='page rendition not ready'), 404
+
+        if _is_mirror_preferred():
+            mirrored = MirrorService.is_mirrored(rendition_path)
+            db.session.commit()
+            if mirrored:
+                return redirect(MirrorTool.get_url(rendition_path))
+        # the renditions are named by the digest of the content, so they never change
+        return send_from_directory(FileStore.get_full_path(''), rendition_path,
+                                   cache_timeout=RenderTool.cache_timeout)
     except AnswerServiceError as e:
         return jsonify(msg=e.msg, detail=e.detail), 400
 
@@ -275,30 +473,13 @@ def download_zip(bid: int):
         if book is None:
             return jsonify(msg='book not found'), 404
 
-        data_folder = app.config['DATA_FOLDER']
         if book.student_id:
             target_name = book.student.name
         else:
             target_name = 'book_%d' % bid
 
-        # sort file paths according to the minimal index among the pages linked to each file path
-        file_indices = {}
-        for page in book.pages:
-            index = file_indices.get(page.file_path)
-            if index is None or page.index < index:
-                file_indices[page.file_path] = page.index
-        file_paths = [path for path, index in sorted(file_indices.items(), key=lambda x: x[1])]
-
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            zip_name = '%s.zip' % target_name
-            zip_path = os.path.join(tmp_dir, zip_name)
-            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as f_zip:
-                for i, file_path in enumerate(file_paths):
-                    ext = os.path.splitext(file_path)[-1]
-                    f_zip.write(os.path.join(data_folder, 'answer_books', str(bid), file_path),
-                                os.path.join(target_name, '%d%s' % (i + 1, ext)))
-            return send_from_directory(tmp_dir, zip_name, as_attachment=True, attachment_filename=zip_name,
-                                       cache_timeout=0)
+        entries = [(FileStore.get_full_path(path), name) for path, name in AnswerService.get_archive_entries(book)]
+        return send_stream_as_attachment(stream_zip(entries), '%s.zip' % target_name, 'application/zip')
     except AnswerServiceError as e:
         return jsonify(msg=e.msg, detail=e.detail), 400
 
@@ -1,7 +1,8 @@
-from flask import Blueprint, current_app as app, jsonify, send_from_directory
+from flask import Blueprint, current_app as app, jsonify
 
 from auth_connect.oauth import requires_login
 from services.task import TaskService, TaskServiceError
+from utils.send import send_file_with_digest
 
 material_api = Blueprint('material_api', __name__)
 
@@ -15,6 +16,6 @@ def do(mid: int, name: str = None):
         if material is None:
             return jsonify(msg='material not found'), 404
         data_folder = app.config['DATA_FOLDER']
-        return send_from_directory(data_folder, material.path)
+        return send_file_with_digest(data_folder, material.path)
     except TaskServiceError as e:
         return jsonify(msg=e.msg, detail=e.detail), 400
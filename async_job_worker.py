@@ -1,10 +1,18 @@
 import json
 import os
+import shutil
 import ssl
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import celery
+from flask import Flask
 
-from utils.mirror import MirrorTool
+from utils.mirror import MirrorTool, MirrorProgressController
+from utils.render import RenderTool
+from utils.store import FileStore
 
 with open('config.json') as _f:
     config = json.load(_f)
@@ -12,11 +20,22 @@ celery_config = config['ASYNC_JOB']
 data_folder = config['DATA_FOLDER']
 
 MirrorTool.init(config)
+FileStore.init(config)
+RenderTool.init(config)
 
 app = celery.Celery('mark', broker=celery_config['broker'], backend=celery_config['backend'])
+# the import jobs run the per-student work in a pool of processes, which a daemonic (prefork) worker can not start,
+# so the worker of mark_books_import should be started separately with a non-daemonic pool, e.g.
+#   celery -A async_job_worker worker -Q mark_books_import -P solo
 app.conf.update(
     task_routes={
-        'mark.book.mirror': {'queue': 'mark_book_mirror'}
+        'mark.book.mirror': {'queue': 'mark_book_mirror'},
+        'mark.files.mirror': {'queue': 'mark_book_mirror'},
+        'mark.files.delete': {'queue': 'mark_book_mirror'},
+        'mark.books.import': {'queue': 'mark_books_import'},
+        'mark.books.export': {'queue': 'mark_books_export'},
+        'mark.pages.render': {'queue': 'mark_pages_render'},
+        'mark.pages.process': {'queue': 'mark_pages_process'}
     },
     task_track_started=True
 )
@@ -27,10 +46,312 @@ if broker_ssl_config:
         broker_ssl_config['cert_reqs'] = getattr(ssl, cert_reqs)
     app.conf.update(broker_use_ssl=broker_ssl_config)
 
+_flask_app = None
+
+
+def _get_flask_app() -> Flask:
+    """
+    Lazily create a minimal Flask app for the jobs that need the database or the OAuth server.
+    The full app in server.py can not be imported here because the APIs import this module.
+    """
+    global _flask_app
+    if _flask_app is None:
+        from auth_connect import oauth
+        from models import db
+
+        flask_app = Flask(__name__)
+        flask_app.config.from_json('config.json')
+        db.init_app(flask_app)
+        oauth.init_app(flask_app)
+        _flask_app = flask_app
+    return _flask_app
+
+
+def is_task_active(task_id: str) -> bool:
+    """Check if a task is being run (or has been reserved) by a worker, asking the workers that reply in time."""
+    replies = app.control.inspect(timeout=1).query_task(task_id) or {}
+    return any(task_id in tasks for tasks in replies.values())
+
 
 @app.task(bind=True, name='mark.book.mirror')
 def run_book_mirror(self, book_id: int, file_path: str):
-    if not MirrorTool.enabled:
+    """Kept for the jobs queued by earlier versions, which are passed on to run_files_mirror."""
+    run_files_mirror.apply_async(([FileStore.get_book_file_path(book_id, file_path)],))
+
+
+@app.task(bind=True, name='mark.files.mirror', max_retries=3)
+def run_files_mirror(self, file_paths: list):
+    """
+    Mirror many files (given their paths relative to the data folder) with a bounded number of concurrent uploads
+    (MIRROR_WORKERS), reporting the progress in bytes. Large files are uploaded by resumable multipart uploads if
+    configured, so the failed files are retried later and resume from the uploaded parts.
+    """
+    if not MirrorTool.enabled or not file_paths:
+        return
+    flask_app = _get_flask_app()
+    total_bytes = 0
+    for file_path in file_paths:
+        full_path = os.path.join(data_folder, file_path)
+        if os.path.exists(full_path):
+            total_bytes += os.path.getsize(full_path)
+    progress = dict(num_files=len(file_paths), num_mirrored_files=0, num_skipped_files=0, num_failed_files=0,
+                    total_bytes=total_bytes, uploaded_bytes=0)
+    uploaded_bytes = {}
+    lock = threading.Lock()
+
+    def _mirror(file_path: str) -> str:
+        def _progress(consumed_bytes, _total_bytes):
+            with lock:
+                uploaded_bytes[file_path] = consumed_bytes
+
+        try:
+            size = os.path.getsize(os.path.join(data_folder, file_path))
+        except FileNotFoundError:  # removed in the meantime, e.g. by a deletion job
+            return 'skipped'
+        with flask_app.app_context():
+            try:
+                _mirror_file(file_path, MirrorProgressController(_progress, 1))
+            except Exception as e:
+                if not os.path.exists(os.path.join(data_folder, file_path)):  # removed while being uploaded
+                    return 'skipped'
+                print('[Warning] Failed to mirror %s (%s)' % (file_path, e), file=sys.stderr)
+                return 'failed'
+        with lock:
+            uploaded_bytes[file_path] = size
+        return 'mirrored'
+
+    failed_paths = []
+    with ThreadPoolExecutor(flask_app.config.get('MIRROR_WORKERS') or 4) as executor:
+        pending = {executor.submit(_mirror, file_path): file_path for file_path in file_paths}
+        while pending:
+            done, _ = wait(pending, timeout=1)
+            for future in done:
+                status = future.result()
+                progress['num_%s_files' % status] += 1
+                if status == 'failed':
+                    failed_paths.append(pending[future])
+                del pending[future]
+            with lock:
+                progress['uploaded_bytes'] = sum(uploaded_bytes.values())
+            self.update_state(state='PROGRESS', meta=dict(progress))
+
+    if failed_paths:
+        raise self.retry(args=(failed_paths,), countdown=60)
+    return progress
+
+
+def _mirror_file(file_path: str, progress_controller: MirrorProgressController = None):
+    """Upload a file to the mirror and record its state, in an app context."""
+    from models import db
+    from services.mirror import MirrorService
+
+    MirrorService.set_pending(file_path)
+    db.session.commit()
+    try:
+        etag = MirrorTool.put(file_path, os.path.join(data_folder, file_path), progress_controller)
+    except Exception as e:
+        db.session.rollback()
+        MirrorService.set_failed(file_path, str(e))
+        db.session.commit()
+        raise
+    MirrorService.set_uploaded(file_path, etag)
+    db.session.commit()
+
+
+@app.task(bind=True, name='mark.files.delete', autoretry_for=(Exception,), retry_backoff=True, max_retries=5)
+def run_files_delete(self, file_paths: list, folder_paths: list = None):
+    """
+    Remove stored files (given their paths relative to the data folder) and their copies in the mirror, and then
+    the folders if they are empty (including the folders of the removed renditions). The removed files are skipped
+    when the job is retried, e.g. after a mirror outage.
+    """
+    from models import db, AnswerBlob, AnswerFile
+    from services.mirror import MirrorService
+
+    folder_paths = list(folder_paths or [])
+    with _get_flask_app().app_context():
+        for file_path in file_paths:
+            # a blob (or a content with renditions) may be stored again for a new file before this job is run
+            if file_path.startswith('blobs' + os.sep) and AnswerBlob.query.get(os.path.basename(file_path)):
+                continue
+            if file_path.startswith('renditions' + os.sep):
+                rendition_folder = os.path.dirname(file_path)
+                if AnswerFile.query.filter_by(md5=os.path.basename(rendition_folder)).first():
+                    continue
+                if rendition_folder not in folder_paths:
+                    folder_paths.append(rendition_folder)
+            FileStore.remove(file_path)
+            MirrorService.remove(file_path)
+            db.session.commit()
+    for folder_path in folder_paths:
+        full_path = os.path.join(data_folder, folder_path)
+        if os.path.isdir(full_path) and not os.listdir(full_path):
+            os.rmdir(full_path)
+
+
+@app.task(bind=True, name='mark.pages.render')
+def run_pages_render(self, file_path: str, md5: str, file_indices: list):
+    """
+    Render the pages of a stored file (given its path relative to the data folder) into renditions, and mirror the
+    new renditions. For an image, file_indices should be [None]. The pending markers of the pages are cleared.
+    """
+    if not RenderTool.enabled:
         return
-    file_full_path = os.path.join('answer_books', str(book_id), file_path)
-    MirrorTool.put(file_full_path, os.path.join(data_folder, file_full_path))
+    full_path = os.path.join(data_folder, file_path)
+    rendition_paths = []
+    with tempfile.TemporaryDirectory(dir=data_folder) as work_dir:
+        for file_index in file_indices:
+            try:
+                rendition_paths.extend(RenderTool.render(full_path, md5, file_index, work_dir))
+            finally:
+                RenderTool.clear_pending(md5, file_index)
+    if MirrorTool.enabled and rendition_paths:
+        from models import db
+        from services.mirror import MirrorService
+
+        with _get_flask_app().app_context():
+            MirrorService.set_queued(rendition_paths)
+            db.session.commit()
+        run_files_mirror.apply_async((rendition_paths,))
+
+
+@app.task(bind=True, name='mark.pages.process')
+def run_pages_process(self, book_id: int, page_ids: list, source_path: str, source_md5: str, options: dict,
+                      original_path: str = None):
+    """
+    Process an uploaded image (given its path relative to the data folder) with the options, and store the outputs as
+    the files of the pages created for them in order, which are then ready. If processing fails, the pages are marked
+    as failed. The upload is stored as original_path of the book if given, otherwise removed.
+    """
+    from models import db
+    from services.answer import AnswerService
+    from services.mirror import MirrorService
+    from utils.crypt import md5sum
+    from utils.image import process_image
+
+    flask_app = _get_flask_app()
+    with flask_app.app_context():
+        book = AnswerService.get_book(book_id)
+        if book is None:  # deleted in the meantime
+            FileStore.remove(source_path)
+            return
+        pages = [AnswerService.get_page(page_id) for page_id in page_ids]
+
+        mirror_paths = []
+        render_info = []
+        with tempfile.TemporaryDirectory(dir=data_folder) as work_dir:
+            try:
+                output_paths = process_image(FileStore.get_full_path(source_path), options, work_dir)
+            except Exception as e:
+                for page in pages:
+                    if page is not None:
+                        AnswerService.set_page_processing(page, 'failed', str(e))
+                db.session.commit()
+                FileStore.remove(source_path)
+                return dict(error=dict(msg='Failed to process image', detail=str(e)))
+
+            for page, output_path in zip(pages, output_paths):
+                if page is None:  # deleted in the meantime
+                    continue
+                output_md5 = md5sum(output_path)
+                mirror_paths.append(AnswerService.store_file(book, page.file_path, output_path, output_md5,
+                                                             move=True))
+                render_info.append((page.file_path, output_md5))
+                AnswerService.clear_page_processing(page)
+            if original_path:
+                AnswerService.store_file(book, original_path, FileStore.get_full_path(source_path), source_md5,
+                                         move=True)
+            mirror_paths = [path for path in mirror_paths if path]  # skip mirroring if the content is already stored
+            MirrorService.set_queued(mirror_paths)
+            db.session.commit()
+        FileStore.remove(source_path)
+
+    if mirror_paths:
+        run_files_mirror.apply_async((mirror_paths,))
+    if RenderTool.enabled:
+        for path, md5 in render_info:
+            run_pages_render.apply_async((FileStore.get_book_file_path(book_id, path), md5, [None]))
+
+
+@app.task(bind=True, name='mark.books.import')
+def run_books_import(self, job_id: str):
+    """
+    Run an import job. The students are committed in batches, so if the job fails, the staged archive is kept and a
+    retry of the job resumes from the last committed student.
+    The per-student work only runs in parallel if the worker is not daemonic (-P solo or -P threads).
+    """
+    from error import BasicError
+    from models import db
+    from services.book_import import BookImportService
+
+    def _progress_callback(progress: dict):
+        self.update_state(state='PROGRESS', meta=progress)
+
+    flask_app = _get_flask_app()
+    with flask_app.app_context():
+        job = BookImportService.get_job(job_id)
+        if job is None:
+            return dict(error=dict(msg='import job not found', detail=None))
+        job.status = 'running'
+        db.session.commit()
+
+        try:
+            result = BookImportService.import_books(job, data_folder, flask_app.config.get('IMPORT_WORKERS'),
+                                                    _progress_callback, db.session.commit)
+        except BasicError as e:
+            _fail_job(job, e.msg, e.detail)  # the work dir is kept for a retry
+            return dict(error=dict(msg=e.msg, detail=e.detail))
+        except Exception as e:
+            _fail_job(job, 'import job failed', str(e))
+            raise
+
+        job.status = 'finished'
+        db.session.commit()
+        shutil.rmtree(os.path.join(data_folder, job.work_dir), ignore_errors=True)
+        return result
+
+
+def _fail_job(job, msg: str, detail: str):
+    """Roll back the uncommitted changes (e.g. the current batch of an import) and mark the job as failed."""
+    from models import db
+
+    db.session.rollback()
+    job.status = 'failed'
+    job.error_msg = msg
+    job.error_detail = detail
+    db.session.commit()
+
+
+@app.task(bind=True, name='mark.books.export')
+def run_books_export(self, job_id: str):
+    """Run an export job, whose archives are written into its work dir for downloading."""
+    from error import BasicError
+    from models import db
+    from services.book_export import BookExportService
+
+    def _progress_callback(progress: dict):
+        self.update_state(state='PROGRESS', meta=progress)
+
+    flask_app = _get_flask_app()
+    with flask_app.app_context():
+        job = BookExportService.get_job(job_id)
+        if job is None:
+            return dict(error=dict(msg='export job not found', detail=None))
+        job.status = 'running'
+        db.session.commit()
+
+        try:
+            result = BookExportService.export_books(job, data_folder, flask_app.config.get('EXPORT_WORKERS'),
+                                                    _progress_callback)
+        except BasicError as e:
+            _fail_job(job, e.msg, e.detail)
+            shutil.rmtree(os.path.join(data_folder, job.work_dir), ignore_errors=True)  # the partial archives
+            return dict(error=dict(msg=e.msg, detail=e.detail))
+        except Exception as e:
+            _fail_job(job, 'export job failed', str(e))
+            shutil.rmtree(os.path.join(data_folder, job.work_dir), ignore_errors=True)
+            raise
+
+        job.status = 'finished'
+        db.session.commit()
+        return result
@@ -60,6 +60,14 @@ class GroupAlias(db.Model):
         return _dict
 
 
+class UserAliasSync(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user_alias.id', ondelete='CASCADE'), primary_key=True)
+    synced_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return '<UserAliasSync %r>' % self.user_id
+
+
 class Task(db.Model):
     id = db.Column(db.Integer, primary_key=True)
 
@@ -228,7 +236,10 @@ class AnswerPage(db.Model):
                 with_creator: bool = False, with_modifier: bool = False) -> dict:
         d = dict(id=self.id, book_id=self.book_id, index=self.index, file_index=self.file_index,
                  transform=self.transform, file_path=self.file_path,
+                 status=self.processing.status if self.processing else 'ready',
                  created_at=self.created_at, modified_at=self.modified_at)
+        if self.processing and self.processing.error:
+            d['error'] = self.processing.error
         if with_book:
             d['book'] = self.book.to_dict()
         if with_annotations:
@@ -240,6 +251,149 @@ class AnswerPage(db.Model):
         return d
 
 
+class AnswerPageProcessing(db.Model):
+    """The state of a page whose file is being processed in background, which is deleted once the file is ready."""
+    page_id = db.Column(db.Integer, db.ForeignKey('answer_page.id'), primary_key=True)
+    status = db.Column(db.String(16), nullable=False, default='processing')  # processing or failed
+    error = db.Column(db.String(256))
+
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    modified_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    page = db.relationship('AnswerPage', backref=db.backref('processing', uselist=False, lazy='joined'))
+
+    def __repr__(self):
+        return '<AnswerPageProcessing %r>' % self.page_id
+
+
+class AnswerBlob(db.Model):
+    md5 = db.Column(db.String(32), primary_key=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0, index=True)
+
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    modified_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return '<AnswerBlob %r>' % self.md5
+
+
+class AnswerFile(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    book_id = db.Column(db.Integer, db.ForeignKey('answer_book.id'), nullable=False, index=True)
+    path = db.Column(db.String(128), nullable=False)
+    __table_args__ = (db.UniqueConstraint(book_id, path),)
+
+    # content digest of the stored file, with its size and mtime to detect changes made outside of the app
+    md5 = db.Column(db.String(32), nullable=False, index=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    mtime = db.Column(db.Float, nullable=False)
+    # set if the file is a link to a deduplicated blob
+    blob_md5 = db.Column(db.String(32), db.ForeignKey('answer_blob.md5'), index=True)
+
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    modified_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    book = db.relationship('AnswerBook', backref=db.backref('files'))
+    blob = db.relationship('AnswerBlob')
+
+    def __repr__(self):
+        return '<AnswerFile %r>' % self.id
+
+    def to_dict(self) -> dict:
+        return dict(id=self.id, book_id=self.book_id, path=self.path, md5=self.md5, size=self.size,
+                    created_at=self.created_at, modified_at=self.modified_at)
+
+
+class PDFPageCount(db.Model):
+    """The number of pages of a pdf content, so that the same content is not parsed again by any process."""
+    md5 = db.Column(db.String(32), primary_key=True)
+    num_pages = db.Column(db.Integer, nullable=False)
+
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return '<PDFPageCount %r>' % self.md5
+
+
+class MirrorObject(db.Model):
+    """The state of a stored file in the mirror, so that the mirror needs not be checked remotely."""
+    path = db.Column(db.String(256), primary_key=True)  # relative to the data folder, also the remote path
+    status = db.Column(db.String(16), nullable=False, default='pending')  # pending, uploaded or failed
+    etag = db.Column(db.String(64))
+    error = db.Column(db.String(256))
+    mirrored_at = db.Column(db.DateTime)
+
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    modified_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return '<MirrorObject %r>' % self.path
+
+
+class ImportJob(db.Model):
+    id = db.Column(db.String(36), primary_key=True)  # also the id of the async job
+    task_id = db.Column(db.Integer, db.ForeignKey('task.id'), nullable=False)
+    importer_type = db.Column(db.String(16), nullable=False)
+    file_names = db.Column(db.Text, nullable=False)  # comma separated
+    force_update = db.Column(db.Boolean, nullable=False, default=False)
+    work_dir = db.Column(db.String(128), nullable=False)  # staged archive, relative to the data folder
+    archive_name = db.Column(db.String(128), nullable=False)
+
+    # pending, running, failed or finished
+    status = db.Column(db.String(16), nullable=False, default='pending')
+    # the students are committed in the order they are scanned, so a retry resumes after the committed ones
+    num_committed_students = db.Column(db.Integer, nullable=False, default=0)
+    num_new_books = db.Column(db.Integer, nullable=False, default=0)
+    num_skipped_books = db.Column(db.Integer, nullable=False, default=0)
+    num_updated_books = db.Column(db.Integer, nullable=False, default=0)
+    error_msg = db.Column(db.String(256))
+    error_detail = db.Column(db.Text)
+
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    modified_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    task = db.relationship('Task')
+
+    def __repr__(self):
+        return '<ImportJob %r>' % self.id
+
+    def to_dict(self) -> dict:
+        return dict(id=self.id, task_id=self.task_id, importer_type=self.importer_type, status=self.status,
+                    num_committed_students=self.num_committed_students, num_new_books=self.num_new_books,
+                    num_skipped_books=self.num_skipped_books, num_updated_books=self.num_updated_books,
+                    error_msg=self.error_msg, error_detail=self.error_detail,
+                    created_at=self.created_at, modified_at=self.modified_at)
+
+
+class ExportJob(db.Model):
+    id = db.Column(db.String(36), primary_key=True)  # also the id of the async job
+    task_id = db.Column(db.Integer, db.ForeignKey('task.id'), nullable=False)
+    shard_size = db.Column(db.Integer)  # max number of books per archive, or all books in one archive if not set
+    work_dir = db.Column(db.String(128), nullable=False)  # archives, relative to the data folder
+
+    # pending, running, failed or finished
+    status = db.Column(db.String(16), nullable=False, default='pending')
+    num_books = db.Column(db.Integer, nullable=False, default=0)
+    num_archives = db.Column(db.Integer, nullable=False, default=0)
+    error_msg = db.Column(db.String(256))
+    error_detail = db.Column(db.Text)
+
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    modified_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    task = db.relationship('Task')
+
+    def __repr__(self):
+        return '<ExportJob %r>' % self.id
+
+    def to_dict(self) -> dict:
+        return dict(id=self.id, task_id=self.task_id, shard_size=self.shard_size, status=self.status,
+                    num_books=self.num_books, num_archives=self.num_archives,
+                    error_msg=self.error_msg, error_detail=self.error_detail,
+                    created_at=self.created_at, modified_at=self.modified_at)
+
+
 class Marking(db.Model):
     # TODO consider using (book_id, question_id) as primary key in new db setup?
     id = db.Column(db.Integer, primary_key=True)
@@ -3,7 +3,7 @@ import re
 import subprocess
 
 import click
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Request, request, jsonify, send_from_directory
 
 from api_account import account_api
 from api_admin import admin_api
@@ -15,12 +15,25 @@ from auth_connect import oauth
 from models import db
 from services.account import AccountService, AccountServiceError
 from services.marking import MarkingService
+from services.mirror import MirrorService
 from services.task import TaskService
+from utils.image import ImagePipeline, ImageTranscoder
 from utils.ip import IPTool
 from utils.mirror import MirrorTool
+from utils.render import RenderTool
+from utils.store import FileStore
+from utils.upload import UploadTool
+
+
+class MyRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # stage the uploaded files in the data folder, so that they can be moved into place without copying
+        return UploadTool.create_stream(filename)
 
 
 class MyFlask(Flask):
+    request_class = MyRequest
+
     _hashed_static_file_pattern = re.compile(r'^.+\.[a-z0-9]{20}\.\w+$')
     _hashed_static_file_pattern_alt = re.compile(r'^[a-z0-9]{20}\..+\.\w+$')
     _hashed_static_file_cache_timeout = 365 * 24 * 60 * 60  # 1 year
@@ -65,12 +78,7 @@ class MyFlask(Flask):
     def get_request_region(self):
         detect_regions = self.config.get('DETECT_REQUEST_REGIONS')
         if detect_regions:
-            ip = IPTool.get_client_ip(request)
-            country_code = IPTool.get_ip_country(ip)
-            if country_code:
-                country_code = country_code.lower()
-                if country_code in detect_regions:
-                    return country_code
+            return IPTool.get_ip_region(IPTool.get_client_ip(request), detect_regions)
         return None
     
 
@@ -80,6 +88,11 @@ app.config.from_json('config.json')
 db.init_app(app)
 IPTool.init_app(app)
 MirrorTool.init(app.config)
+FileStore.init(app.config)
+RenderTool.init(app.config)
+ImagePipeline.init(app.config)
+ImageTranscoder.init(app.config)
+UploadTool.init(app.config)
 
 
 # import logging
@@ -147,6 +160,34 @@ def import_marks(question_id: int, file_path: str):
     db.session.commit()
 
 
+@app.cli.command()
+@click.option('--dry-run', is_flag=True, help='Only report the differences.')
+@click.option('--workers', type=int, default=4, help='Number of concurrent uploads and deletions.')
+@click.option('--rate-limit', type=float, help='Max number of uploads and deletions per second.')
+def reconcile_mirror(dry_run: bool, workers: int, rate_limit: float):
+    """Upload the stored files missing from the mirror, and delete the mirror objects without local files."""
+    if not MirrorTool.enabled:
+        raise click.ClickException('mirror not enabled')
+    missing_paths, mirrored_paths, orphan_paths = MirrorService.diff(app.config['DATA_FOLDER'])
+    click.echo('%d files mirrored, %d files missing from the mirror, %d orphan objects in the mirror'
+               % (len(mirrored_paths), len(missing_paths), len(orphan_paths)))
+    if dry_run:
+        for path in missing_paths:
+            click.echo('missing: %s' % path)
+        for path in orphan_paths:
+            click.echo('orphan: %s' % path)
+        return
+
+    def _progress(num_done: int, num_total: int):
+        if num_done % 100 == 0 or num_done == num_total:
+            click.echo('%d/%d done' % (num_done, num_total))
+
+    failed = MirrorService.reconcile(app.config['DATA_FOLDER'], missing_paths, mirrored_paths, orphan_paths,
+                                     workers, rate_limit, _progress)
+    db.session.commit()
+    for path, error in failed:
+        click.echo('failed: %s (%s)' % (path, error), err=True)
+
 
 @app.route('/api/version')
 def api_version():
@@ -1,10 +1,13 @@
-from typing import Optional, List
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Optional, List, Iterable, Dict
 
+from flask import current_app
 from sqlalchemy import or_, func
 
 from auth_connect import oauth
 from error import BasicError
-from models import db, UserAlias, GroupAlias
+from models import db, UserAlias, GroupAlias, UserAliasSync
 
 
 class AccountServiceError(BasicError):
@@ -12,6 +15,9 @@ class AccountServiceError(BasicError):
 
 
 class AccountService:
+    sync_max_age = timedelta(hours=1)  # users synced more recently are not fetched again in batch sync
+    sync_max_workers = 8  # max concurrent requests to the OAuth server in batch sync
+
     @staticmethod
     def get_current_user() -> Optional[UserAlias]:
         user = oauth.get_user()
@@ -33,6 +39,13 @@ class AccountService:
             raise AccountServiceError('name is required')
         return UserAlias.query.filter_by(name=name).first()
 
+    @staticmethod
+    def get_users_by_names(names: Iterable[str]) -> Dict[str, UserAlias]:
+        names = set(names)
+        if not names:
+            return {}
+        return {u.name: u for u in UserAlias.query.filter(UserAlias.name.in_(names))}
+
     @staticmethod
     def get_group(_id) -> Optional[GroupAlias]:
         if _id is None:
@@ -86,6 +99,92 @@ class AccountService:
         except oauth.OAuthError as e:
             raise AccountServiceError('Failed to sync user %s' % name, e.msg)
 
+    @classmethod
+    def sync_users_by_names(cls, names: Iterable[str]) -> Dict[str, UserAlias]:
+        """
+        Sync many users by their names and return the user aliases by the requested names.
+
+        The users whose aliases have been synced within sync_max_age are not fetched again. The others are fetched from
+        the OAuth server with a bounded number of concurrent requests, then the users, groups and their links are
+        synced against the local copies in bulk.
+        """
+        names = set(names)
+        if not names:
+            return {}
+
+        users_local = AccountService.get_users_by_names(names)
+        synced_since = datetime.utcnow() - cls.sync_max_age
+        fresh_user_ids = {s.user_id for s in UserAliasSync.query.filter(
+            UserAliasSync.user_id.in_([u.id for u in users_local.values()]),
+            UserAliasSync.synced_at >= synced_since)}
+        result = {name: u for name, u in users_local.items() if u.id in fresh_user_ids}
+
+        fetch_names = sorted(names - set(result))
+        users = cls._fetch_users_by_names(fetch_names)
+        if not users:
+            return result
+
+        groups = {g.id: g for user in users for g in user.groups}
+        groups_local = {g.id: g for g in GroupAlias.query.filter(GroupAlias.id.in_(groups.keys()))}
+        groups_synced = {gid: cls._sync_group(group, groups_local.get(gid), skip_get_alias=True)
+                         for gid, group in groups.items()}
+
+        users_local_by_id = {u.id: u for u in UserAlias.query.filter(UserAlias.id.in_([u.id for u in users]))}
+        users_synced = {}
+        # the users are returned by the names as requested, which may differ from their names (e.g. in case), and
+        # several names may refer to the same user
+        for name, user in zip(fetch_names, users):
+            user_alias = users_synced.get(user.id)
+            if user_alias is not None:
+                result[name] = user_alias
+                continue
+            user_alias = cls._sync_user(user, users_local_by_id.get(user.id), skip_get_alias=True)
+            users_synced[user.id] = user_alias
+
+            group_ids = {g.id for g in user.groups}
+            local_user_groups = {g.id: g for g in user_alias.groups}
+            local_user_group_ids = set(local_user_groups)
+            for gid in local_user_group_ids - group_ids:
+                user_alias.groups.remove(local_user_groups[gid])  # remove deleted link
+            for gid in group_ids - local_user_group_ids:
+                user_alias.groups.append(groups_synced[gid])  # add missing link
+
+            result[name] = user_alias
+
+        cls._set_synced(list(users_synced))
+        return result
+
+    @classmethod
+    def _fetch_users_by_names(cls, names: List[str]) -> List[oauth.User]:
+        if not names:
+            return []
+        app = current_app._get_current_object()
+
+        def _fetch(name):
+            with app.app_context():
+                try:
+                    return oauth.get_user_by_name(name)
+                except oauth.OAuthError as e:
+                    raise AccountServiceError('Failed to sync user %s' % name, e.msg)
+
+        with ThreadPoolExecutor(min(cls.sync_max_workers, len(names))) as executor:
+            users = list(executor.map(_fetch, names))
+        for name, user in zip(names, users):
+            if user is None:
+                raise AccountServiceError('Failed to sync user %s' % name, 'user not found')
+        return users
+
+    @staticmethod
+    def _set_synced(user_ids: List[int]):
+        now = datetime.utcnow()
+        records = {s.user_id: s for s in UserAliasSync.query.filter(UserAliasSync.user_id.in_(user_ids))}
+        for uid in user_ids:
+            record = records.get(uid)
+            if record is None:
+                db.session.add(UserAliasSync(user_id=uid, synced_at=now))
+            else:
+                record.synced_at = now
+
     @classmethod
     def sync_user(cls, user: oauth.User) -> UserAlias:
         """
@@ -117,6 +216,7 @@ class AccountService:
         for gid in group_ids - local_user_group_ids:
             user_alias.groups.append(groups_synced[gid])  # add missing link
 
+        cls._set_synced([user_alias.id])
         return user_alias
 
     @classmethod
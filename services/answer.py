@@ -1,11 +1,16 @@
+import os
+from collections import defaultdict
 from datetime import datetime
-from typing import Optional, Set, List
+from typing import Optional, Set, List, Iterable, Dict, Tuple
 
 from sqlalchemy import func
 
 from error import BasicError
 from models import AnswerBook, Task, UserAlias, db, AnswerPage, Annotation, Marking, Comment, MarkerQuestionAssignment, \
-    Question
+    Question, AnswerFile, AnswerBlob, AnswerPageProcessing, PDFPageCount
+from utils.pdf import get_pdf_pages
+from utils.render import RenderTool
+from utils.store import FileStore
 
 
 class AnswerServiceError(BasicError):
@@ -34,10 +39,31 @@ class AnswerService:
                     AnswerBook.student_id == student.id).first()
 
     @staticmethod
-    def go_to_book(from_book: AnswerBook, is_next: bool = True, skip_marked_by: UserAlias = None) \
+    def get_books_by_task_students(task: Task, student_ids: Iterable[int]) -> Dict[int, AnswerBook]:
+        if task is None:
+            raise AnswerServiceError('task is required')
+
+        student_ids = set(student_ids)
+        if not student_ids:
+            return {}
+        return {b.student_id: b for b in db.session.query(AnswerBook)
+                .filter(AnswerBook.task_id == task.id,
+                        AnswerBook.student_id.in_(student_ids))}
+
+    @classmethod
+    def go_to_book(cls, from_book: AnswerBook, is_next: bool = True, skip_marked_by: UserAlias = None) \
             -> Optional[AnswerBook]:
+        books = cls.go_to_books(from_book, is_next, skip_marked_by, 1)
+        return books[0] if books else None
+
+    @staticmethod
+    def go_to_books(from_book: AnswerBook, is_next: bool = True, skip_marked_by: UserAlias = None,
+                    limit: int = 1) -> List[AnswerBook]:
+        """Get the books visited in turn by go_to_book() from a book, at most limit books."""
         if from_book is None:
             raise AnswerServiceError('from book is required')
+        if not isinstance(limit, int) or limit < 1:
+            raise AnswerServiceError('limit must be a positive integer')
 
         filters = [AnswerBook.task_id == from_book.task_id]
         if is_next:
@@ -60,7 +86,7 @@ class AnswerService:
                 .group_by(Marking.book_id).having(func.count() == len(qids)).subquery()
             filters.append(AnswerBook.id.notin_(sub_query))
 
-        return db.session.query(AnswerBook).filter(*filters).order_by(order_by).first()
+        return db.session.query(AnswerBook).filter(*filters).order_by(order_by).limit(limit).all()
 
     @staticmethod
     def add_book(task: Task, student: UserAlias = None, creator: UserAlias = None, submitted_at: datetime = None) \
@@ -81,6 +107,37 @@ class AnswerService:
         db.session.add(book)
         return book
 
+    @classmethod
+    def add_books(cls, task: Task, students_submitted_at: List[Tuple[UserAlias, Optional[datetime]]]) \
+            -> Dict[int, AnswerBook]:
+        """
+        Add books for many students at once with a single bulk insert.
+        Return the new books keyed by student id.
+        """
+        if task is None:
+            raise AnswerServiceError('task is required')
+
+        if task.answer_locked:
+            raise AnswerServiceError('task answer locked')
+
+        if not students_submitted_at:
+            return {}
+        student_ids = [student.id for student, _ in students_submitted_at]
+        if len(set(student_ids)) != len(student_ids):
+            raise AnswerServiceError('duplicate book')
+
+        db.session.flush()  # make sure the students exist before the bulk insert
+        if db.session.query(func.count()) \
+                .filter(AnswerBook.task_id == task.id,
+                        AnswerBook.student_id.in_(student_ids)) \
+                .scalar():
+            raise AnswerServiceError('duplicate book')
+
+        db.session.execute(AnswerBook.__table__.insert(),
+                           [dict(task_id=task.id, student_id=student.id, submitted_at=submitted_at)
+                            for student, submitted_at in students_submitted_at])
+        return cls.get_books_by_task_students(task, student_ids)
+
     @staticmethod
     def update_book(book: AnswerBook, student: Optional[UserAlias], modifier: UserAlias = None):
         if book is None:
@@ -134,6 +191,30 @@ class AnswerService:
         db.session.add(page)
         return page
 
+    @staticmethod
+    def set_page_processing(page: AnswerPage, status: str = 'processing', error: str = None):
+        """Mark a page whose file is being processed in background, or has failed to be processed."""
+        if page is None:
+            raise AnswerServiceError('page is required')
+        if status not in ('processing', 'failed'):
+            raise AnswerServiceError('invalid processing status', status)
+
+        processing = page.processing
+        if processing is None:
+            processing = AnswerPageProcessing(page=page)
+            db.session.add(processing)
+        processing.status = status
+        processing.error = error[:256] if error else None
+
+    @staticmethod
+    def clear_page_processing(page: AnswerPage):
+        """Mark a page as ready once its file has been stored."""
+        if page is None:
+            raise AnswerServiceError('page is required')
+
+        if page.processing is not None:
+            db.session.delete(page.processing)
+
     @staticmethod
     def add_multi_pages(book: AnswerBook, file_path: str, num_pages: int, start_index: int = None,
                         creator: UserAlias = None) -> List[AnswerPage]:
@@ -166,6 +247,69 @@ class AnswerService:
             pages.append(page)
         return pages
 
+    @staticmethod
+    def get_page_indices_by_books(book_ids: Iterable[int]) -> Dict[int, List[Tuple[int, int, str]]]:
+        """Get (id, index, file_path) of the pages of many books at once, keyed by book id."""
+        book_ids = set(book_ids)
+        pages = defaultdict(list)
+        if not book_ids:
+            return pages
+        for _id, book_id, index, file_path in db.session.query(AnswerPage.id, AnswerPage.book_id, AnswerPage.index,
+                                                                AnswerPage.file_path) \
+                .filter(AnswerPage.book_id.in_(book_ids)):
+            pages[book_id].append((_id, index, file_path))
+        return pages
+
+    @staticmethod
+    def add_pages_bulk(pages: List[dict]):
+        """
+        Insert many pages with a single bulk insert. Each item is a dict of the column values of a page, in which the
+        index must have been computed by the caller.
+        """
+        if not pages:
+            return
+        for page in pages:
+            if page.get('book_id') is None:
+                raise AnswerServiceError('book id is required')
+            if not page.get('file_path'):
+                raise AnswerServiceError('file path is required')
+            if not isinstance(page.get('index'), int):
+                raise AnswerServiceError('index must be an integer')
+        db.session.flush()
+        db.session.bulk_insert_mappings(AnswerPage, pages)
+
+    @staticmethod
+    def delete_pages_bulk(page_ids: Iterable[int]):
+        """
+        Delete many pages and their annotations at once.
+        The file records are left to the caller as the files are expected to be overwritten.
+        """
+        page_ids = set(page_ids)
+        if not page_ids:
+            return
+        db.session.flush()
+        db.session.execute(Annotation.__table__.delete().where(Annotation.page_id.in_(page_ids)))
+        db.session.execute(AnswerPageProcessing.__table__.delete().where(AnswerPageProcessing.page_id.in_(page_ids)))
+        db.session.execute(AnswerPage.__table__.delete().where(AnswerPage.id.in_(page_ids)))
+
+    @staticmethod
+    def delete_markings_bulk(book_ids: Iterable[int]):
+        book_ids = set(book_ids)
+        if not book_ids:
+            return
+        db.session.flush()
+        db.session.execute(Marking.__table__.delete().where(Marking.book_id.in_(book_ids)))
+
+    @staticmethod
+    def get_files_by_books(book_ids: Iterable[int]) -> Dict[int, Dict[str, AnswerFile]]:
+        book_ids = set(book_ids)
+        files = defaultdict(dict)
+        if not book_ids:
+            return files
+        for file in db.session.query(AnswerFile).filter(AnswerFile.book_id.in_(book_ids)):
+            files[file.book_id][file.path] = file
+        return files
+
     @staticmethod
     def update_page(page: AnswerPage, index: int, transform: Optional[str], modifier: UserAlias = None):
         if page is None:
@@ -189,6 +333,186 @@ class AnswerService:
         page.transform = transform
         page.modifier = modifier
 
+    @staticmethod
+    def get_archive_entries(book: AnswerBook) -> List[Tuple[str, str]]:
+        """
+        Get the files of a book to be archived, as (path of the file relative to the data folder, name in the archive).
+        The files are put in a folder named by the student (or book_<id>) and numbered in the order of their pages.
+        """
+        if book is None:
+            raise AnswerServiceError('book is required')
+
+        if book.student_id:
+            target_name = book.student.name
+        else:
+            target_name = 'book_%d' % book.id
+
+        # sort file paths according to the minimal index among the pages linked to each file path
+        file_indices = {}
+        for page in book.pages:
+            if page.processing is not None:  # no file yet
+                continue
+            index = file_indices.get(page.file_path)
+            if index is None or page.index < index:
+                file_indices[page.file_path] = page.index
+        file_paths = [path for path, index in sorted(file_indices.items(), key=lambda x: x[1])]
+
+        return [(FileStore.get_book_file_path(book.id, file_path),
+                 os.path.join(target_name, '%d%s' % (i + 1, os.path.splitext(file_path)[-1])))
+                for i, file_path in enumerate(file_paths)]
+
+    @staticmethod
+    def get_file(book: AnswerBook, path: str) -> Optional[AnswerFile]:
+        if book is None:
+            raise AnswerServiceError('book is required')
+        if not path:
+            raise AnswerServiceError('path is required')
+
+        return db.session.query(AnswerFile) \
+            .filter(AnswerFile.book_id == book.id,
+                    AnswerFile.path == path).first()
+
+    @classmethod
+    def set_file(cls, book: AnswerBook, path: str, md5: str, size: int, mtime: float, blob: AnswerBlob = None) \
+            -> AnswerFile:
+        """
+        Record the digest, size and mtime of a stored file of a book.
+        If the file is a link to a blob, the reference counts of the old and new blobs are updated.
+        """
+        if not md5:
+            raise AnswerServiceError('md5 is required')
+        if size is None:
+            raise AnswerServiceError('size is required')
+        if mtime is None:
+            raise AnswerServiceError('mtime is required')
+
+        file = cls.get_file(book, path)
+        if file is None:
+            file = AnswerFile(book=book, path=path, md5=md5, size=size, mtime=mtime)
+            db.session.add(file)
+        else:
+            if file.md5 != md5:
+                cls._release_content(file.md5)
+            file.md5 = md5
+            file.size = size
+            file.mtime = mtime
+        if file.blob is not blob:
+            if file.blob is not None:
+                file.blob.ref_count -= 1
+            if blob is not None:
+                blob.ref_count += 1
+            file.blob = blob
+        return file
+
+    @classmethod
+    def store_file(cls, book: AnswerBook, path: str, src_path: str, md5: str, move: bool = False) -> Optional[str]:
+        """
+        Store a file for a book and record its digest.
+
+        If deduplication is enabled and the same content is already stored, only a link to the existing blob is
+        created. Return the stored path (relative to the data folder) if new content has been stored and should be
+        mirrored, otherwise None.
+        """
+        if book is None:
+            raise AnswerServiceError('book is required')
+        if not path:
+            raise AnswerServiceError('path is required')
+        if not md5:
+            raise AnswerServiceError('md5 is required')
+
+        if book.id is None:
+            db.session.flush()  # get book id
+
+        book_file_path = FileStore.get_book_file_path(book.id, path)
+        blob = None
+        new_content_path = book_file_path
+        if FileStore.dedup:
+            blob = AnswerBlob.query.get(md5)
+            if blob is None:  # new content
+                blob_path = FileStore.put_blob(src_path, md5, move=move)
+                blob = AnswerBlob(md5=md5, size=os.path.getsize(FileStore.get_full_path(blob_path)), ref_count=0)
+                db.session.add(blob)
+                new_content_path = blob_path
+            else:  # content already stored (and mirrored)
+                new_content_path = None
+            FileStore.put(FileStore.get_full_path(FileStore.get_blob_path(md5)), book_file_path, link=True)
+        elif FileStore.has_content(book_file_path, os.path.getsize(src_path), md5,
+                                   cls._get_recorded_md5(book, path)):  # no need to copy again
+            if move:
+                os.remove(src_path)
+        else:
+            FileStore.put(src_path, book_file_path, move=move)
+
+        stat = os.stat(FileStore.get_full_path(book_file_path))
+        cls.set_file(book, path, md5, stat.st_size, stat.st_mtime, blob)
+        return new_content_path
+
+    @staticmethod
+    def get_recorded_pdf_pages(md5s: Iterable[str]) -> Dict[str, int]:
+        md5s = set(md5s)
+        if not md5s:
+            return {}
+        return {r.md5: r.num_pages for r in PDFPageCount.query.filter(PDFPageCount.md5.in_(md5s))}
+
+    @staticmethod
+    def get_task_pdf_pages(task: Task) -> Dict[str, int]:
+        """Get the recorded page counts of the files of the books of a task by their md5."""
+        if task is None:
+            raise AnswerServiceError('task is required')
+        return dict(db.session.query(PDFPageCount.md5, PDFPageCount.num_pages)
+                    .join(AnswerFile, AnswerFile.md5 == PDFPageCount.md5)
+                    .join(AnswerBook, AnswerBook.id == AnswerFile.book_id)
+                    .filter(AnswerBook.task_id == task.id))
+
+    @staticmethod
+    def set_pdf_pages(md5: str, num_pages: int):
+        if not md5:
+            raise AnswerServiceError('md5 is required')
+        if num_pages is None:
+            raise AnswerServiceError('number of pages is required')
+        db.session.merge(PDFPageCount(md5=md5, num_pages=num_pages))
+
+    @classmethod
+    def get_pdf_pages(cls, file_path: str, md5: str) -> Optional[int]:
+        """
+        Get the number of pages of a pdf file, from the record of the same content if any, otherwise by parsing it and
+        recording the result, which should be committed by the caller.
+        """
+        num_pages = get_pdf_pages(file_path, md5, cls.get_recorded_pdf_pages([md5]))
+        if num_pages is not None:
+            cls.set_pdf_pages(md5, num_pages)
+        return num_pages
+
+    @classmethod
+    def _get_recorded_md5(cls, book: AnswerBook, path: str) -> Optional[str]:
+        """Get the md5 of a stored file from its record, or None if it is not recorded (and has to be hashed)."""
+        file = cls.get_file(book, path)
+        return file.md5 if file is not None else None
+
+    @staticmethod
+    def _release_content(md5: str):
+        """Note the content of a file record being deleted or replaced, whose renditions may be no longer needed."""
+        db.session.info.setdefault('released_md5s', set()).add(md5)
+
+    @staticmethod
+    def collect_orphan_blobs() -> List[str]:
+        """
+        Delete the blobs that are no longer referenced by any file and return their stored paths, with the paths of
+        the renditions of the contents (released in this session) that are no longer referenced by any file, so that
+        the caller can remove the actual files (may break if race condition occurs).
+        """
+        paths = []
+        orphan_md5s = db.session.info.pop('released_md5s', set())
+        for blob in db.session.query(AnswerBlob).filter(AnswerBlob.ref_count <= 0):
+            paths.append(FileStore.get_blob_path(blob.md5))
+            orphan_md5s.add(blob.md5)
+            db.session.delete(blob)
+        if orphan_md5s:
+            orphan_md5s -= {md5 for md5, in db.session.query(AnswerFile.md5).filter(AnswerFile.md5.in_(orphan_md5s))}
+            for md5 in sorted(orphan_md5s):
+                paths.extend(RenderTool.list_renditions(md5))
+        return paths
+
     @classmethod
     def delete_book(cls, book: AnswerBook) -> Set[str]:
         if book is None:
@@ -213,13 +537,21 @@ class AnswerService:
             if path_to_delete:
                 file_paths_to_delete.add(path_to_delete)
 
+        # delete the file records not referenced by any page
+        for file in db.session.query(AnswerFile).filter(AnswerFile.book_id == book.id):
+            if file.blob is not None:
+                file.blob.ref_count -= 1
+            cls._release_content(file.md5)
+            db.session.delete(file)
+            file_paths_to_delete.add(file.path)
+
         # delete the book at last
         db.session.delete(book)
 
         return file_paths_to_delete
 
-    @staticmethod
-    def delete_page(page: AnswerPage) -> Optional[str]:
+    @classmethod
+    def delete_page(cls, page: AnswerPage) -> Optional[str]:
         if page is None:
             raise AnswerServiceError('page is required')
 
@@ -239,6 +571,16 @@ class AnswerService:
             file_path_to_delete = None
         else:
             file_path_to_delete = page.file_path
+            for file in db.session.query(AnswerFile) \
+                    .filter(AnswerFile.book_id == page.book_id,
+                            AnswerFile.path == page.file_path):
+                if file.blob is not None:
+                    file.blob.ref_count -= 1
+                cls._release_content(file.md5)
+                db.session.delete(file)
+
+        if page.processing is not None:
+            db.session.delete(page.processing)
 
         # delete the page at last
         db.session.delete(page)
@@ -0,0 +1,137 @@
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from error import BasicError
+from models import db, Task, AnswerBook, ExportJob
+from services.answer import AnswerService
+from utils.zip_stream import stream_zip
+
+
+class BookExportServiceError(BasicError):
+    pass
+
+
+class BookExportService:
+    @staticmethod
+    def get_job(job_id: str) -> Optional[ExportJob]:
+        if job_id is None:
+            raise BookExportServiceError('id is required')
+        return ExportJob.query.get(job_id)
+
+    @staticmethod
+    def add_job(job_id: str, task: Task, shard_size: Optional[int], work_dir: str) -> ExportJob:
+        if task is None:
+            raise BookExportServiceError('task is required')
+        if shard_size is not None and (not isinstance(shard_size, int) or shard_size < 1):
+            raise BookExportServiceError('shard size must be a positive integer')
+
+        job = ExportJob(id=job_id, task=task, shard_size=shard_size, work_dir=work_dir)
+        db.session.add(job)
+        return job
+
+    @staticmethod
+    def delete_job(job: ExportJob):
+        """Delete the record of a job, and the work dir should be removed by the caller."""
+        if job is None:
+            raise BookExportServiceError('job is required')
+        if job.status in ('pending', 'running'):
+            raise BookExportServiceError('export job not done yet')
+        db.session.delete(job)
+
+    @classmethod
+    def delete_expired_jobs(cls, max_age: timedelta) -> List[str]:
+        """
+        Delete the records of the jobs done more than max_age ago, and return their work dirs, which should be removed
+        by the caller.
+        """
+        done_before = datetime.utcnow() - max_age
+        work_dirs = []
+        for job in ExportJob.query.filter(ExportJob.status.in_(('failed', 'finished')),
+                                          ExportJob.modified_at < done_before):
+            work_dirs.append(job.work_dir)
+            cls.delete_job(job)
+        return work_dirs
+
+    @staticmethod
+    def get_archive_path(job: ExportJob, index: int) -> str:
+        """Get the path (relative to the data folder) of the index-th archive of a job, starting from 1."""
+        return os.path.join(job.work_dir, 'part_%d.zip' % index)
+
+    @staticmethod
+    def get_archive_name(job: ExportJob, index: int) -> str:
+        """Get the name of the index-th archive of a job for downloading."""
+        if job.num_archives == 1:
+            return '%s.zip' % job.task.name
+        return '%s_%d.zip' % (job.task.name, index)
+
+    @classmethod
+    def export_books(cls, job: ExportJob, data_folder: str, num_workers: int = None,
+                     progress_callback: Callable[[dict], None] = None) -> dict:
+        """
+        Export the files of all the answer books of a task into zip archives in the work dir of a job, with the same
+        layout as the zip download of a book (a folder for each student). With a shard size, the books are split
+        into archives of at most shard size books, which are written in parallel by num_workers threads. Without a
+        shard size, the single archive is written (and the book folders are read) by one thread, so parallelism needs
+        sharding.
+        If provided, progress_callback is called with the current counters about every second.
+        """
+        if job is None:
+            raise BookExportServiceError('job is required')
+        if job.task is None:
+            raise BookExportServiceError('task is required')
+
+        books = db.session.query(AnswerBook).filter(AnswerBook.task_id == job.task_id).order_by(AnswerBook.id).all()
+        # the entries are listed in advance, since the database is only accessed in this thread
+        book_entries = [(book.id, AnswerService.get_archive_entries(book)) for book in books]
+        shard_size = job.shard_size or max(len(book_entries), 1)
+        shards = [book_entries[i:i + shard_size] for i in range(0, len(book_entries), shard_size)] or [[]]
+        job.num_books = len(book_entries)
+        job.num_archives = len(shards)
+
+        work_dir = os.path.join(data_folder, job.work_dir)
+        os.makedirs(work_dir, exist_ok=True)
+
+        progress = dict(num_books=len(book_entries), num_exported_books=0, num_archives=len(shards))
+        lock = threading.Lock()
+
+        def _book_exported():
+            with lock:
+                progress['num_exported_books'] += 1
+
+        with ThreadPoolExecutor(num_workers) as executor:
+            pending = {executor.submit(cls._write_archive, shard, data_folder,
+                                       os.path.join(data_folder, cls.get_archive_path(job, i + 1)), _book_exported)
+                       for i, shard in enumerate(shards)}
+            while pending:
+                done, pending = wait(pending, timeout=1)
+                for future in done:
+                    future.result()  # raise the error of a failed archive
+                if progress_callback:
+                    with lock:
+                        progress_callback(dict(progress))
+        return dict(num_books=job.num_books, num_archives=job.num_archives)
+
+    @classmethod
+    def _write_archive(cls, shard: List[Tuple[int, List[Tuple[str, str]]]], data_folder: str, archive_path: str,
+                       book_exported: Callable[[], None]):
+        tmp_path = archive_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            for chunk in stream_zip(cls._iter_entries(shard, data_folder, book_exported)):
+                f.write(chunk)
+        os.replace(tmp_path, archive_path)
+
+    @staticmethod
+    def _iter_entries(shard: List[Tuple[int, List[Tuple[str, str]]]], data_folder: str,
+                      book_exported: Callable[[], None]) -> Iterator[Tuple[str, str]]:
+        for book_id, entries in shard:
+            for path, name in entries:
+                full_path = os.path.join(data_folder, path)
+                if not os.path.exists(full_path):
+                    print('[Warning] Missing file of book %d: %s' % (book_id, path), file=sys.stderr)
+                    continue
+                yield full_path, name
+            book_exported()
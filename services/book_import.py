@@ -0,0 +1,306 @@
+import os
+import shutil
+import sys
+from collections import defaultdict
+from typing import List, Callable, Optional
+
+from error import BasicError
+from models import db, Task, AnswerBook, AnswerFile, ImportJob
+from services.account import AccountService
+from services.answer import AnswerService
+from services.mirror import MirrorService
+from utils.archive import ArchiveReader, ArchiveError
+from utils.crypt import md5sum
+from utils.give import GiveImporter
+from utils.import_engine import ImportEngine, StudentImport
+from utils.importer import GenericImporter
+from utils.render import RenderTool
+from utils.store import FileStore
+from utils.submit import SubmitImporter
+
+
+class BookImportServiceError(BasicError):
+    pass
+
+
+class BookImportService:
+    _batch_size = 100
+
+    importers = {
+        'generic': GenericImporter,
+        'give': GiveImporter,
+        'submit': SubmitImporter
+    }
+
+    @classmethod
+    def get_file_names(cls, importer_type: str, file_names_str: Optional[str]) -> List[str]:
+        if importer_type not in cls.importers:
+            raise BookImportServiceError('invalid importer type')
+        if not file_names_str:
+            raise BookImportServiceError('file names are required')
+
+        file_names = []
+        if importer_type == 'generic':  # use fixed filename
+            file_names = [GenericImporter.PDF_FILE_NAME]
+        else:
+            for name in file_names_str.split(','):
+                name = name.strip()
+                if name:
+                    file_names.append(name)
+        if not file_names:
+            raise BookImportServiceError('file names are required')
+        return file_names
+
+    @staticmethod
+    def get_job(job_id: str) -> Optional[ImportJob]:
+        if job_id is None:
+            raise BookImportServiceError('id is required')
+        return ImportJob.query.get(job_id)
+
+    @classmethod
+    def add_job(cls, job_id: str, task: Task, importer_type: str, file_names: List[str], force_update: bool,
+                work_dir: str, archive_name: str) -> ImportJob:
+        if task is None:
+            raise BookImportServiceError('task is required')
+        if task.answer_locked:
+            raise BookImportServiceError('task answer locked')
+        if importer_type not in cls.importers:
+            raise BookImportServiceError('invalid importer type')
+        if not file_names:
+            raise BookImportServiceError('file names are required')
+
+        job = ImportJob(id=job_id, task=task, importer_type=importer_type, file_names=','.join(file_names),
+                        force_update=force_update, work_dir=work_dir, archive_name=archive_name)
+        db.session.add(job)
+        return job
+
+    @staticmethod
+    def retry_job(job: ImportJob, task_active: bool):
+        """
+        Mark a failed job as pending again, so that it can be resumed from the last committed student. A running job
+        can also be retried if its task is no longer active (e.g. the worker was killed or restarted).
+        """
+        if job is None:
+            raise BookImportServiceError('job is required')
+        if job.status == 'running':
+            if task_active:
+                raise BookImportServiceError('import job still running')
+        elif job.status != 'failed':
+            raise BookImportServiceError('only failed or interrupted job can be retried')
+        job.status = 'pending'
+        job.error_msg = None
+        job.error_detail = None
+
+    @classmethod
+    def import_books(cls, job: ImportJob, data_folder: str, num_workers: int = None,
+                     progress_callback: Callable[[dict], None] = None,
+                     commit_callback: Callable[[], None] = None) -> dict:
+        """
+        Import the answer books of a task from the staged archive of an import job.
+
+        The students are imported in batches. After each batch, the files are stored, the job is updated with the
+        number of committed students and commit_callback is called to commit the database changes, so that a failed
+        job can be resumed from the last committed student. The extracted files are staged in a sub-folder of the
+        work dir of the job.
+        If provided, progress_callback is called with the current counters after each student has been processed.
+        """
+        if job is None:
+            raise BookImportServiceError('job is required')
+        task = job.task
+        if task is None:
+            raise BookImportServiceError('task is required')
+        if task.answer_locked:
+            raise BookImportServiceError('task answer locked')
+        importer = cls.importers.get(job.importer_type)
+        if importer is None:
+            raise BookImportServiceError('invalid importer type')
+        file_names = job.file_names.split(',')
+
+        progress = dict(num_students=None, num_processed_students=job.num_committed_students, current_student=None,
+                        num_new_books=job.num_new_books, num_skipped_books=job.num_skipped_books,
+                        num_updated_books=job.num_updated_books)
+
+        work_dir = os.path.join(data_folder, job.work_dir)
+        extract_dir = os.path.join(work_dir, '_extract')
+        if os.path.exists(extract_dir):  # left by an interrupted attempt, the uncommitted students are redone
+            shutil.rmtree(extract_dir)
+        os.mkdir(extract_dir)
+        try:
+            # decompressed once and kept in the work dir for retries
+            archive_path = ArchiveReader.prepare(os.path.join(work_dir, job.archive_name), work_dir)
+        except ArchiveError as e:
+            raise BookImportServiceError('failed to unpack archive', e.detail or e.msg) from e
+
+        batch = []
+        # the page counts of the files already imported for the task, so that a re-import does not parse them again
+        known_pdf_pages = AnswerService.get_task_pdf_pages(task)
+        engine = ImportEngine(importer(file_names), file_names, num_workers, known_pdf_pages)
+        for result in engine.run(archive_path, extract_dir, job.num_committed_students):
+            batch.append(result)
+            if len(batch) >= cls._batch_size:
+                cls._commit_batch(job, batch, data_folder, progress, commit_callback)
+                batch = []
+            progress['num_students'] = engine.num_students
+            progress['num_processed_students'] += 1
+            progress['current_student'] = result.student_id
+            if progress_callback:
+                progress_callback(dict(progress))
+        cls._commit_batch(job, batch, data_folder, progress, commit_callback)
+
+        return dict(num_new_books=progress['num_new_books'], num_skipped_books=progress['num_skipped_books'],
+                    num_updated_books=progress['num_updated_books'])
+
+    @classmethod
+    def _commit_batch(cls, job: ImportJob, batch: List[StudentImport], data_folder: str, progress: dict,
+                      commit_callback: Optional[Callable[[], None]]):
+        from async_job_worker import run_files_mirror, run_pages_render, run_files_delete
+
+        copy_info = []
+        cls._import_batch(job.task, batch, job.force_update, data_folder, progress, copy_info)
+
+        # do actual file copies (the extracted files are moved since they are no longer needed)
+        mirror_paths = []
+        render_info = []
+        for tmp_path, md5, book, path, num_pages in copy_info:
+            mirror_path = AnswerService.store_file(book, path, tmp_path, md5, move=True)
+            if num_pages is not None:
+                AnswerService.set_pdf_pages(md5, num_pages)
+            if mirror_path:  # skip mirroring if the content is already stored
+                mirror_paths.append(mirror_path)
+            file_indices = list(range(1, num_pages + 1)) if num_pages is not None else [None]
+            render_info.append((FileStore.get_book_file_path(book.id, path), md5, file_indices))
+
+        MirrorService.set_queued(mirror_paths)
+
+        # the blobs no longer used by the updated books
+        orphan_blob_paths = AnswerService.collect_orphan_blobs()
+
+        job.num_committed_students += len(batch)
+        job.num_new_books = progress['num_new_books']
+        job.num_skipped_books = progress['num_skipped_books']
+        job.num_updated_books = progress['num_updated_books']
+        if commit_callback:
+            commit_callback()
+
+        if mirror_paths:
+            run_files_mirror.apply_async((mirror_paths,))
+        if RenderTool.enabled:
+            for args in render_info:
+                run_pages_render.apply_async(args)
+        if orphan_blob_paths:
+            run_files_delete.apply_async((orphan_blob_paths,))
+
+    @staticmethod
+    def _get_stored_md5(book: AnswerBook, book_folder: str, path: str, file: Optional[AnswerFile]) -> Optional[str]:
+        """
+        Get the md5 of a stored file from its committed record, rather than from the file, which may already hold the
+        content of a batch that failed to commit (the files are stored before the commit). Only the files stored before
+        the records were introduced are hashed, and their records are added.
+        """
+        if file is not None:
+            return file.md5
+        full_path = os.path.join(book_folder, path)
+        try:
+            stat = os.stat(full_path)
+        except FileNotFoundError:
+            return None
+        md5 = md5sum(full_path)
+        AnswerService.set_file(book, path, md5, stat.st_size, stat.st_mtime)
+        return md5
+
+    @classmethod
+    def _import_batch(cls, task: Task, batch: List[StudentImport], force_update: bool, data_folder: str,
+                      progress: dict, copy_info: list):
+        """
+        Import a batch of students with set-based queries: the students, books, pages and file records are loaded
+        with a few IN queries, the page indices are computed in memory and the new books and pages are bulk inserted.
+        """
+        results = [result for result in batch if result.has_submission]  # ignore the students with no submission
+        if not results:
+            return
+
+        students = AccountService.sync_users_by_names([result.student_id for result in results])
+        books = AnswerService.get_books_by_task_students(task, [student.id for student in students.values()])
+        book_ids = [book.id for book in books.values()]
+        book_pages = AnswerService.get_page_indices_by_books(book_ids)
+        book_files = AnswerService.get_files_by_books(book_ids)
+
+        new_books = []
+        new_pages = []  # (book, path, num_pages, start_index)
+        page_ids_to_delete = []
+        book_ids_content_changed = []
+        for result in results:
+            student = students[result.student_id]
+            submission_time = result.submission_time
+
+            book = books.get(student.id)
+            if book is None:  # create new book later in bulk
+                new_books.append((student, result))
+                continue
+
+            # already imported
+            if not force_update and book.submitted_at is not None and book.submitted_at == submission_time:
+                progress['num_skipped_books'] += 1  # skip if same submission time
+                continue
+
+            # update to latest version
+            book_folder = os.path.join(data_folder, 'answer_books', str(book.id))
+            old_path_pages = defaultdict(list)
+            for page_id, index, path in book_pages.get(book.id, []):
+                old_path_pages[path].append((page_id, index))
+            indices = {index for page_id, index, path in book_pages.get(book.id, [])}
+            old_path_files = book_files.get(book.id, {})
+
+            has_content_change = False
+            for file_name, file in result.files.items():
+                path = file_name  # directly use the file name as path
+                old_pages = old_path_pages.get(path)
+                if old_pages:  # file exists
+                    stored_md5 = cls._get_stored_md5(book, book_folder, path, old_path_files.get(path))
+                    if stored_md5 == file.md5:  # same file content
+                        continue  # skip importing this file
+                    for page_id, index in old_pages:  # delete outdated pages
+                        # file will be overwritten, so no file deletion is required
+                        page_ids_to_delete.append(page_id)
+                        indices.discard(index)
+                if file.error:
+                    print('[Warning] Failed to get pdf info of: %s (%s)' % (file.path, file.error), file=sys.stderr)
+                    continue
+                num_pages = file.num_pages if file.num_pages is not None else 1
+                start_index = max(indices, default=0) + 1
+                indices.update(range(start_index, start_index + num_pages))
+                new_pages.append((book, path, file.num_pages, start_index))
+                has_content_change = True
+                copy_info.append((file.path, file.md5, book, path, file.num_pages))
+
+            book.submitted_at = submission_time
+            if has_content_change:  # invalidate existing markings because content has changed
+                book_ids_content_changed.append(book.id)
+            progress['num_updated_books'] += 1
+
+        # create new books
+        created_books = AnswerService.add_books(task, [(student, result.submission_time)
+                                                       for student, result in new_books])
+        for student, result in new_books:
+            book = created_books[student.id]
+            progress['num_new_books'] += 1
+            start_index = 1
+            for file_name, file in result.files.items():
+                path = file_name  # directly use the file name as path since no conflict could occur here
+                if file.error:
+                    print('[Warning] Failed to get pdf info of: %s (%s)' % (file.path, file.error), file=sys.stderr)
+                    continue
+                new_pages.append((book, path, file.num_pages, start_index))
+                start_index += file.num_pages if file.num_pages is not None else 1
+                copy_info.append((file.path, file.md5, book, path, file.num_pages))
+
+        AnswerService.delete_pages_bulk(page_ids_to_delete)
+        AnswerService.delete_markings_bulk(book_ids_content_changed)
+        page_rows = []
+        for book, path, num_pages, start_index in new_pages:
+            if num_pages is None:  # single page
+                page_rows.append(dict(book_id=book.id, index=start_index, file_path=path))
+            else:  # split pdf pages
+                for i in range(num_pages):
+                    page_rows.append(dict(book_id=book.id, index=start_index + i, file_path=path, file_index=i + 1))
+        AnswerService.add_pages_bulk(page_rows)
@@ -0,0 +1,210 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from typing import Optional, List, Tuple, Callable
+
+from error import BasicError
+from models import db, MirrorObject, AnswerFile
+from utils.cache import LRUCache
+from utils.mirror import MirrorTool
+from utils.store import FileStore
+
+
+class MirrorServiceError(BasicError):
+    pass
+
+
+class _RateLimiter:
+    """Allow at most rate calls of acquire() per second, shared by threads."""
+
+    def __init__(self, rate: Optional[float]):
+        self._interval = 1 / rate if rate else 0
+        self._next_time = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self._interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next_time - now
+            self._next_time = max(now, self._next_time) + self._interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class MirrorService:
+    """
+    Keep track of the stored files in the mirror (by their paths relative to the data folder, which are also the
+    remote paths), so that serving a file does not need a remote check.
+    """
+    mirrored_folders = ('answer_books', 'blobs', 'renditions')
+    # the files without a state found missing from the mirror, which are not checked remotely again for a while
+    _missing_cache = LRUCache(max_size=65536, ttl=300)
+
+    @staticmethod
+    def get_object(path: str) -> Optional[MirrorObject]:
+        if not path:
+            raise MirrorServiceError('path is required')
+        return MirrorObject.query.get(path)
+
+    @classmethod
+    def _get_or_add_object(cls, path: str) -> MirrorObject:
+        obj = cls.get_object(path)
+        if obj is None:
+            obj = MirrorObject(path=path)
+            db.session.add(obj)
+        return obj
+
+    @classmethod
+    def set_pending(cls, path: str):
+        obj = cls._get_or_add_object(path)
+        obj.status = 'pending'
+        obj.error = None
+
+    @classmethod
+    def set_queued(cls, paths: List[str]):
+        """
+        Record the files queued for mirroring as pending, so that they are not checked remotely before being uploaded,
+        which should be committed by the caller.
+        """
+        if not MirrorTool.enabled:
+            return
+        for path in paths:
+            cls.set_pending(path)
+
+    @classmethod
+    def set_uploaded(cls, path: str, etag: Optional[str]):
+        obj = cls._get_or_add_object(path)
+        obj.status = 'uploaded'
+        obj.etag = etag
+        obj.error = None
+        obj.mirrored_at = datetime.utcnow()
+
+    @classmethod
+    def set_failed(cls, path: str, error: str):
+        obj = cls._get_or_add_object(path)
+        obj.status = 'failed'
+        obj.error = error[:256] if error else None
+
+    @classmethod
+    def is_mirrored(cls, path: str) -> bool:
+        """
+        Check if a file has been uploaded to the mirror. A file mirrored before the states were recorded is checked
+        in the mirror once and recorded if found, which should be committed by the caller. A file not found is not
+        checked again for a while.
+        """
+        if not MirrorTool.enabled:
+            return False
+        obj = cls.get_object(path)
+        if obj is not None:
+            return obj.status == 'uploaded'
+        if cls._missing_cache.get(path):
+            return False
+        if not MirrorTool.exists(path):
+            cls._missing_cache.put(path, True)
+            return False
+        cls.set_uploaded(path, None)
+        return True
+
+    @classmethod
+    def remove(cls, path: str):
+        """Remove a file from the mirror if it may be there, and forget its state."""
+        if not MirrorTool.enabled:
+            return
+        obj = cls.get_object(path)
+        if obj is None:  # mirrored before the states were recorded, or never
+            if MirrorTool.exists(path):
+                MirrorTool.delete(path)
+            return
+        MirrorTool.delete(path)  # deleting a missing object is fine, e.g. a failed or pending upload
+        db.session.delete(obj)
+
+    @classmethod
+    def diff(cls, data_folder: str) -> Tuple[List[str], List[str], List[str]]:
+        """
+        Compare the stored files under the mirrored folders of the data folder with the mirror listing. The files of
+        books that are links to blobs are skipped, since their content is mirrored as the blobs. The originals kept
+        next to transcoded images (and the blobs only stored for them) are skipped, since they are not mirrored.
+        Return the paths of (files missing from the mirror, files in the mirror, orphan objects in the mirror).
+        """
+        blob_linked_paths = set()
+        original_blob_md5s = set()
+        used_blob_md5s = set()
+        for book_id, path, blob_md5 in db.session.query(AnswerFile.book_id, AnswerFile.path, AnswerFile.blob_md5) \
+                .filter(AnswerFile.blob_md5.isnot(None)):
+            blob_linked_paths.add(FileStore.get_book_file_path(book_id, path))
+            if FileStore.is_original_path(path):
+                original_blob_md5s.add(blob_md5)
+            else:
+                used_blob_md5s.add(blob_md5)
+        skipped_paths = blob_linked_paths
+        skipped_paths.update(FileStore.get_blob_path(md5) for md5 in original_blob_md5s - used_blob_md5s)
+        local_paths = set()
+        remote_paths = set()
+        for folder in cls.mirrored_folders:
+            for root, dirs, files in os.walk(os.path.join(data_folder, folder)):
+                for name in files:
+                    if name.startswith('.'):  # temporary files
+                        continue
+                    path = os.path.relpath(os.path.join(root, name), data_folder)
+                    if path not in skipped_paths and not FileStore.is_original_path(path):
+                        local_paths.add(path)
+            remote_paths.update(MirrorTool.list(folder + '/'))
+        return sorted(local_paths - remote_paths), sorted(local_paths & remote_paths), \
+            sorted(remote_paths - local_paths)
+
+    @classmethod
+    def reconcile(cls, data_folder: str, missing_paths: List[str], mirrored_paths: List[str],
+                  orphan_paths: List[str], num_workers: int = None, rate_limit: float = None,
+                  progress_callback: Callable[[int, int], None] = None) -> List[Tuple[str, str]]:
+        """
+        Upload the missing files and delete the orphan objects (as found by diff()) in parallel, with at most
+        rate_limit operations per second if given, and record the states of all the files, which should be committed
+        by the caller. Return the failed paths with their errors.
+        If provided, progress_callback is called with the number of done and all operations after each operation.
+        """
+        if not MirrorTool.enabled:
+            raise MirrorServiceError('mirror not enabled')
+
+        objects = {obj.path: obj for obj in MirrorObject.query}
+        for path in mirrored_paths:
+            obj = objects.get(path)
+            if obj is None or obj.status != 'uploaded':  # e.g. mirrored before the states were recorded
+                cls.set_uploaded(path, obj.etag if obj else None)
+
+        limiter = _RateLimiter(rate_limit)
+
+        def _upload(path: str) -> Optional[str]:
+            limiter.acquire()
+            return MirrorTool.put(path, os.path.join(data_folder, path))
+
+        def _delete(path: str):
+            limiter.acquire()
+            MirrorTool.delete(path)
+
+        failed = []
+        num_done = 0
+        num_total = len(missing_paths) + len(orphan_paths)
+        with ThreadPoolExecutor(num_workers) as executor:
+            futures = {executor.submit(_upload, path): ('upload', path) for path in missing_paths}
+            futures.update({executor.submit(_delete, path): ('delete', path) for path in orphan_paths})
+            for future in as_completed(futures):
+                op, path = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    failed.append((path, str(e)))
+                    if op == 'upload':
+                        cls.set_failed(path, str(e))
+                else:
+                    if op == 'upload':
+                        cls.set_uploaded(path, result)
+                    elif path in objects:
+                        db.session.delete(objects[path])
+                num_done += 1
+                if progress_callback:
+                    progress_callback(num_done, num_total)
+        return failed
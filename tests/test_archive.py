@@ -0,0 +1,74 @@
+import os
+import tarfile
+import tempfile
+import unittest
+import zipfile
+
+from utils.archive import ArchiveReader
+
+
+class ArchiveReaderTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.tmp_dir = self._tmp_dir.name
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _make_zip(self, names, with_dirs: bool) -> str:
+        path = os.path.join(self.tmp_dir, 'archive.zip')
+        with zipfile.ZipFile(path, 'w') as f_zip:
+            if with_dirs:
+                dirs = sorted({os.path.dirname(name) for name in names})
+                for d in dirs:
+                    parts = d.split('/')
+                    for i in range(1, len(parts) + 1):
+                        dir_name = '/'.join(parts[:i]) + '/'
+                        if dir_name not in f_zip.namelist():
+                            f_zip.writestr(dir_name, b'')
+            for name in names:
+                f_zip.writestr(name, name.encode())
+        return path
+
+    def _check_tree(self, path: str):
+        with ArchiveReader(path) as reader:
+            self.assertEqual(reader.list_dir(), ['root'])
+            self.assertEqual(reader.list_dir('root'), ['s1', 's2', 's3'])
+            walked = {top: (dirs, files) for top, dirs, files in reader.walk()}
+            self.assertEqual(walked['root/s2'], ([], ['log', 'submission.tar']))
+            self.assertEqual(len(walked), 5)
+            with reader.open('root/s3/log') as f:
+                self.assertEqual(f.read(), b'root/s3/log')
+
+    def _names(self):
+        return ['root/%s/%s' % (sid, name) for sid in ('s1', 's2', 's3') for name in ('log', 'submission.tar')]
+
+    def test_zip_without_dir_entries(self):
+        self._check_tree(self._make_zip(self._names(), with_dirs=False))
+
+    def test_zip_with_dir_entries(self):
+        self._check_tree(self._make_zip(self._names(), with_dirs=True))
+
+    def test_zip_with_nested_dir_entry_only(self):
+        # the entry of a nested folder comes before any entry of its parent
+        path = os.path.join(self.tmp_dir, 'archive.zip')
+        with zipfile.ZipFile(path, 'w') as f_zip:
+            f_zip.writestr('root/s1/', b'')
+            for name in self._names():
+                f_zip.writestr(name, name.encode())
+        self._check_tree(path)
+
+    def test_tar(self):
+        src_dir = os.path.join(self.tmp_dir, 'src')
+        for name in self._names():
+            os.makedirs(os.path.join(src_dir, os.path.dirname(name)), exist_ok=True)
+            with open(os.path.join(src_dir, name), 'wb') as f:
+                f.write(name.encode())
+        path = os.path.join(self.tmp_dir, 'archive.tar')
+        with tarfile.open(path, 'w') as f_tar:
+            f_tar.add(os.path.join(src_dir, 'root'), 'root')
+        self._check_tree(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
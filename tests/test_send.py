@@ -0,0 +1,53 @@
+import os
+import tempfile
+import unittest
+
+try:
+    import flask
+except ImportError:
+    flask = None
+
+
+@unittest.skipIf(flask is None, 'flask is not installed')
+class SendFileWithDigestTest(unittest.TestCase):
+    content = b'%PDF-1.4 ' + bytes(range(256)) * 16
+
+    def setUp(self):
+        from utils.send import send_file_with_digest
+
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        with open(os.path.join(self._tmp_dir.name, 'file.pdf'), 'wb') as f:
+            f.write(self.content)
+
+        app = flask.Flask(__name__)
+
+        @app.route('/file')
+        def get_file():
+            return send_file_with_digest(self._tmp_dir.name, 'file.pdf')
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def test_get_advertises_ranges(self):
+        rv = self.client.get('/file')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.headers.get('Accept-Ranges'), 'bytes')
+        self.assertEqual(rv.data, self.content)
+        self.assertTrue(rv.headers.get('ETag'))
+
+    def test_range_request(self):
+        rv = self.client.get('/file', headers={'Range': 'bytes=10-19'})
+        self.assertEqual(rv.status_code, 206)
+        self.assertEqual(rv.headers.get('Accept-Ranges'), 'bytes')
+        self.assertEqual(rv.data, self.content[10:20])
+
+    def test_not_modified(self):
+        etag = self.client.get('/file').headers['ETag']
+        rv = self.client.get('/file', headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 304)
+
+
+if __name__ == '__main__':
+    unittest.main()
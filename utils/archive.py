@@ -0,0 +1,202 @@
+import bz2
+import gzip
+import lzma
+import os
+import posixpath
+import shutil
+import tarfile
+import zipfile
+from datetime import datetime
+from typing import Dict, IO, Iterator, List, Optional, Set, Tuple
+
+from dateutil import tz
+
+from error import BasicError
+from utils.crypt import copy_with_md5
+
+_tz_local = tz.tzlocal()
+_tz_utc = tz.tzutc()
+
+_compressed_tar_openers = (
+    (b'\x1f\x8b', gzip.open),
+    (b'BZh', bz2.open),
+    (b'\xfd7zXZ\x00', lzma.open)
+)
+
+
+class ArchiveError(BasicError):
+    pass
+
+
+class ArchiveMember:
+    def __init__(self, name: str, size: int, mtime: datetime, info):
+        self.name = name
+        self.size = size
+        self.mtime = mtime  # in UTC
+        self.info = info  # ZipInfo or TarInfo
+
+    def __repr__(self):
+        return '<ArchiveMember %r>' % self.name
+
+
+class ArchiveReader:
+    """
+    Read the members of a zip or tar archive in place, without unpacking the whole archive to disk.
+
+    The archive is indexed once when opened, then the members can be listed like folders and opened as streams.
+    Nested tar files can be read with open_tar(), which streams the inner tar from the outer member.
+    """
+
+    def __init__(self, archive_path: str):
+        self._zip = None
+        self._tar = None
+        self._files = {}  # type: Dict[str, ArchiveMember]
+        self._dirs = {'': set()}  # type: Dict[str, Set[str]]
+
+        try:
+            if zipfile.is_zipfile(archive_path):
+                self._zip = zipfile.ZipFile(archive_path)
+                for info in self._zip.infolist():
+                    if info.is_dir():
+                        self._add_dir(info.filename)
+                        continue
+                    local_time = datetime(*info.date_time)
+                    mtime = local_time.replace(tzinfo=_tz_local).astimezone(_tz_utc).replace(tzinfo=None)
+                    self._add_file(ArchiveMember(info.filename, info.file_size, mtime, info))
+            elif tarfile.is_tarfile(archive_path):
+                self._tar = tarfile.open(archive_path)
+                for info in self._tar.getmembers():
+                    if info.isdir():
+                        self._add_dir(info.name)
+                    elif info.isfile():
+                        self._add_file(ArchiveMember(info.name, info.size, datetime.utcfromtimestamp(info.mtime),
+                                                     info))
+            else:
+                raise ArchiveError('unsupported archive format')
+        except (IOError, zipfile.BadZipFile, tarfile.TarError) as e:
+            self.close()
+            raise ArchiveError('failed to read archive', str(e)) from e
+
+    @staticmethod
+    def _normalize(name: str) -> str:
+        name = posixpath.normpath(name.replace('\\', '/')).lstrip('/')
+        if name == '.':
+            return ''
+        return name
+
+    def _add_dir(self, name: str):
+        name = self._normalize(name)
+        self._dirs.setdefault(name, set())
+        # link each ancestor to its parent, since the archive may have no entries for the folders (e.g. a zip without
+        # directory entries), or a parent may have been created before being linked to its own parent
+        while name:
+            parent, base = posixpath.split(name)
+            children = self._dirs.setdefault(parent, set())
+            if base in children:  # the rest of the ancestors are already linked
+                break
+            children.add(base)
+            name = parent
+
+    def _add_file(self, member: ArchiveMember):
+        name = self._normalize(member.name)
+        if not name or name == '..' or name.startswith('../'):  # ignore unsafe paths
+            return
+        member.name = name
+        parent, base = posixpath.split(name)
+        self._add_dir(parent)
+        self._dirs[parent].add(base)
+        self._files[name] = member
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+            self._zip = None
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def is_dir(self, path: str) -> bool:
+        return self._normalize(path) in self._dirs
+
+    def is_file(self, path: str) -> bool:
+        return self._normalize(path) in self._files
+
+    def get(self, path: str) -> Optional[ArchiveMember]:
+        return self._files.get(self._normalize(path))
+
+    def list_dir(self, path: str = '') -> List[str]:
+        children = self._dirs.get(self._normalize(path))
+        if children is None:
+            raise ArchiveError('folder not found in archive: %s' % path)
+        return sorted(children)
+
+    def walk(self, top: str = '') -> Iterator[Tuple[str, List[str], List[str]]]:
+        """Walk the folders in the archive from top to bottom like os.walk."""
+        top = self._normalize(top)
+        dir_names = []
+        file_names = []
+        for name in self.list_dir(top):
+            if posixpath.join(top, name) in self._dirs:
+                dir_names.append(name)
+            else:
+                file_names.append(name)
+        yield top, dir_names, file_names
+        for name in dir_names:
+            yield from self.walk(posixpath.join(top, name))
+
+    def open(self, path: str) -> IO[bytes]:
+        member = self.get(path)
+        if member is None:
+            raise ArchiveError('file not found in archive: %s' % path)
+        if self._zip is not None:
+            return self._zip.open(member.info)
+        return self._tar.extractfile(member.info)
+
+    def open_tar(self, path: str) -> tarfile.TarFile:
+        """Open a nested tar file as a stream, so that its members can only be read in order."""
+        return tarfile.open(fileobj=self.open(path), mode='r|*')
+
+    @staticmethod
+    def prepare(archive_path: str, work_dir: str) -> str:
+        """
+        Return the path of an archive that supports random access to its members.
+
+        Zip files and plain tar files are returned as is. A compressed tar file has to be decompressed from the
+        beginning whenever an earlier member is read, so it is decompressed once into work_dir instead, where it is
+        reused by later calls.
+        """
+        with open(archive_path, 'rb') as f:
+            head = f.read(8)
+        opener = next((opener for magic, opener in _compressed_tar_openers if head.startswith(magic)), None)
+        if opener is None:
+            return archive_path
+        tar_path = os.path.join(work_dir, '_archive.tar')
+        if os.path.exists(tar_path):  # already decompressed by an earlier attempt
+            return tar_path
+        tmp_path = tar_path + '.tmp'
+        try:
+            with opener(archive_path, 'rb') as f_in, open(tmp_path, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+            os.replace(tmp_path, tar_path)  # only a complete file can be reused
+        except (IOError, EOFError, lzma.LZMAError) as e:
+            raise ArchiveError('failed to decompress archive', str(e)) from e
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return tar_path
+
+
+def extract_stream(src: IO[bytes], dst_path: str, block_size: int = 1024 * 1024) -> str:
+    """Write a member stream to dst_path and return the md5 of its content, which is computed during the copy."""
+    dst_dir = os.path.dirname(dst_path)
+    if not os.path.exists(dst_dir):
+        os.makedirs(dst_dir)
+    with open(dst_path, 'wb') as f_out:
+        md5, _ = copy_with_md5(src, f_out, block_size)
+    return md5
@@ -0,0 +1,59 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+_missing = object()
+
+
+class LRUCache:
+    """
+    A thread-safe in-memory cache, which evicts the least recently used entries beyond max_size and, if ttl (in
+    seconds) is set, the entries older than ttl. The hits and misses are counted for monitoring.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (value, expire_time)
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key, _missing)
+            if item is not _missing:
+                value, expire_time = item
+                if expire_time is None or expire_time > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]  # expired
+            self.misses += 1
+            return default
+
+    def put(self, key: Hashable, value: Any):
+        expire_time = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expire_time)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.pop(key, _missing)
+            if item is _missing:
+                return default
+            return item[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get_stats(self) -> dict:
+        return dict(size=len(self._data), max_size=self.max_size, ttl=self.ttl, hits=self.hits, misses=self.misses)
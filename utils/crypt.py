@@ -1,5 +1,5 @@
 import hashlib
-from typing import Union
+from typing import Union, IO, Tuple
 
 
 def md5s(content: Union[str, bytes]):
@@ -17,3 +17,16 @@ def md5sum(file_path, block_size=65536):
             md5.update(block)
             block = f.read(block_size)
         return md5.hexdigest()
+
+
+def copy_with_md5(src: IO[bytes], dst: IO[bytes], block_size=1048576) -> Tuple[str, int]:
+    """Copy a stream and compute the md5 of the content on the fly. Return the md5 and the number of bytes copied."""
+    md5 = hashlib.md5()
+    size = 0
+    block = src.read(block_size)
+    while block:
+        md5.update(block)
+        dst.write(block)
+        size += len(block)
+        block = src.read(block_size)
+    return md5.hexdigest(), size
@@ -1,14 +1,15 @@
+import io
 import os
+import posixpath
 import re
-import shutil
 import sys
 from datetime import datetime
-from tarfile import TarFile
+from tarfile import TarError
 from typing import Iterable, List
 
 from dateutil import tz
 
-from error import BasicError
+from utils.archive import ArchiveReader, ArchiveError
 from utils.importer import Importer, ImporterError
 
 _tz_local = tz.tzlocal()
@@ -35,17 +36,21 @@ class GiveLog:
     @staticmethod
     def parse(log_path: str):
         with open(log_path) as f:
-            entries = []
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-                s_num, timestamp, others = line.split('\t', 2)
-                num = int(s_num.split()[-1])
-                local_time = datetime.strptime(timestamp, '%a %b %d %H:%M:%S %Y')
-                utc_time = local_time.replace(tzinfo=_tz_local).astimezone(_tz_utc).replace(tzinfo=None)
-                entries.append(GiveLogEntry(num, utc_time))
-            return GiveLog(entries)
+            return GiveLog.parse_lines(f)
+
+    @staticmethod
+    def parse_lines(lines: Iterable[str]):
+        entries = []
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            s_num, timestamp, others = line.split('\t', 2)
+            num = int(s_num.split()[-1])
+            local_time = datetime.strptime(timestamp, '%a %b %d %H:%M:%S %Y')
+            utc_time = local_time.replace(tzinfo=_tz_local).astimezone(_tz_utc).replace(tzinfo=None)
+            entries.append(GiveLogEntry(num, utc_time))
+        return GiveLog(entries)
 
 
 class GiveImporter(Importer):
@@ -61,13 +66,13 @@ class GiveImporter(Importer):
         self.pre_submission_fallback = pre_submission_fallback
         self.skip_overwritten = skip_overwritten
 
-    def _scan_submission_tars(self, folder_path: str) -> list:
-        folder_files = os.listdir(folder_path)
+    def _scan_submission_tars(self, reader: ArchiveReader, folder_path: str) -> list:
+        folder_files = reader.list_dir(folder_path)
         if not folder_files:  # empty folder
             return []
 
         if len(folder_files) == 1 and folder_files[0] == self._pre_submission_name and self.pre_submission_fallback:
-            _time = datetime.utcfromtimestamp(os.stat(os.path.join(folder_path, self._pre_submission_name)).st_mtime)
+            _time = reader.get(posixpath.join(folder_path, self._pre_submission_name)).mtime
             print('[Warning] Fallback to use pre-submission in %s' % folder_path, file=sys.stderr)
             return [(self._pre_submission_name, _time)]
 
@@ -75,7 +80,8 @@ class GiveImporter(Importer):
             raise GiveImporterError('no log file in student folder: %s' % folder_path)
 
         tars = []
-        log = GiveLog.parse(os.path.join(folder_path, self._log_name))
+        with reader.open(posixpath.join(folder_path, self._log_name)) as f_log:
+            log = GiveLog.parse_lines(io.TextIOWrapper(f_log))
         default_file = None
         numbered_files = {}
         for file_name in folder_files:
@@ -97,63 +103,61 @@ class GiveImporter(Importer):
             tars.append((self._default_submission_name, log.entries[-1].time))
         return tars
 
-    def _import_student_folder(self, student_id: str, folder_path: str) -> list:
+    def import_student_folder(self, student_id: str, folder_path: str) -> list:
+        reader = self._get_reader()
         all_extracted = []
-        for file_name, time in self._scan_submission_tars(folder_path):
+        for file_name, time in self._scan_submission_tars(reader, folder_path):
             if file_name is None:  # submission tar has been overwritten
                 all_extracted.append((time, None))  # pass 'None' to the output
                 continue
 
-            extract_dir = os.path.join(folder_path, '%s_extracted' % file_name)
+            extract_dir = os.path.join(self.extract_dir, student_id, '%s_extracted' % file_name)
             if os.path.exists(extract_dir):
                 raise GiveImporterError('extract folder for tar already exists')
-            os.mkdir(extract_dir)
+            os.makedirs(extract_dir)
 
             extracted = {}
             try:
-                with TarFile.open(os.path.join(folder_path, file_name)) as f_tar:
-                    for member in f_tar.getmembers():
+                # read the nested tar as a stream and only write the required files to disk
+                with reader.open_tar(posixpath.join(folder_path, file_name)) as f_tar:
+                    for member in f_tar:
                         member_name = member.name
-                        if member_name in self.required_file_names:
-                            f_tar.extract(member, extract_dir, set_attrs=False)
-                            extracted[member_name] = os.path.join(extract_dir, member_name)
-            except IOError as e:
+                        if member_name in self.required_file_names and member.isfile():
+                            extract_path = os.path.join(extract_dir, member_name)
+                            self._extract_stream(f_tar.extractfile(member), extract_path)
+                            extracted[member_name] = extract_path
+            except (IOError, TarError, ArchiveError) as e:
                 print('[Warning] Failed to extract files in tar "%s" for %s: %s' % (file_name, student_id, str(e)),
                       file=sys.stderr)
             all_extracted.append((time, extracted))
         return all_extracted
 
-    def import_archive(self, archive_path: str, extract_dir: str):
-        if not os.path.exists(extract_dir):
-            os.makedirs(extract_dir)
-        if os.listdir(extract_dir):
-            raise GiveImporterError('extract dir is not empty')
-
+    def scan_archive(self, archive_path: str, extract_dir: str):
         try:
-            shutil.unpack_archive(archive_path, extract_dir)
-        except IOError as e:
-            raise GiveImporterError('failed to unpack archive', str(e)) from e
+            reader = self._open_archive(archive_path, extract_dir)
+        except ImporterError as e:
+            raise GiveImporterError(e.msg, e.detail) from e
 
         # find the "root" folder, which contains a list of student folders, by locating any default submission file
         root = None
-        for dir_path, dir_names, file_names in os.walk(extract_dir):
+        for dir_path, dir_names, file_names in reader.walk():
             if self._default_submission_name in file_names:
-                root, _ = os.path.split(dir_path)
+                root, _ = posixpath.split(dir_path)
                 break
         if root is None:
             raise GiveImporterError('failed to find a submission')
-        dir_list = os.listdir(root)
+        dir_list = reader.list_dir(root)
 
         for name in sorted(dir_list):
             if name.startswith('.') or name == '__MACOSX':
                 continue
-            path = os.path.join(root, name)
-            if not os.path.isdir(path):
+            path = posixpath.join(root, name)
+            if not reader.is_dir(path):
                 raise GiveImporterError('unexpected file: %s' % name)
             student_id = name
             if student_id[0] != 'z':
                 student_id = 'z' + student_id
-            yield student_id, self._import_student_folder(student_id, path)
+            yield student_id, path
 
 
 def _test():
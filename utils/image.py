@@ -1,66 +1,355 @@
 import os
-from typing import List
+import struct
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import repeat
+from typing import List, Optional, Tuple
 
 import cv2
 import numpy as np
 
+from utils.process import can_fork_workers
 
-def process_cut_middle(images: List[np.ndarray], options: dict) -> List[np.ndarray]:
+_output_formats = {
+    'jpg': '.jpg',
+    'png': '.png',
+    'webp': '.webp'
+}
+_quality_flags = {
+    '.jpg': cv2.IMWRITE_JPEG_QUALITY,
+    '.jpeg': cv2.IMWRITE_JPEG_QUALITY,
+    '.webp': cv2.IMWRITE_WEBP_QUALITY
+}
+_reduced_read_flags = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2)
+)
+
+
+def get_image_size(img_path: str) -> Optional[Tuple[int, int]]:
+    """Read the (width, height) of a jpeg or png image from its header, or None for other formats."""
+    with open(img_path, 'rb') as f:
+        head = f.read(24)
+        if head.startswith(b'\x89PNG\r\n\x1a\n') and head[12:16] == b'IHDR':
+            return struct.unpack('>II', head[16:24])
+        if not head.startswith(b'\xff\xd8'):
+            return None
+        f.seek(2)
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xff:
+                return None
+            if marker[1] == 0xff:  # fill byte
+                f.seek(-1, 1)
+                continue
+            if marker[1] in (0xd8, 0x01) or 0xd0 <= marker[1] <= 0xd7:  # markers without length
+                continue
+            length_data = f.read(2)
+            if len(length_data) < 2:
+                return None
+            length = struct.unpack('>H', length_data)[0]
+            if 0xc0 <= marker[1] <= 0xcf and marker[1] not in (0xc4, 0xc8, 0xcc):  # start of frame
+                data = f.read(5)
+                if len(data) < 5:
+                    return None
+                height, width = struct.unpack('>HH', data[1:5])
+                return width, height
+            f.seek(length - 2, 1)
+
+
+def _has_alpha(img_path: str) -> bool:
+    """Check if a png or webp image has an alpha channel (or transparency) from its header."""
+    with open(img_path, 'rb') as f:
+        head = f.read(30)
+        if head.startswith(b'\x89PNG\r\n\x1a\n') and head[12:16] == b'IHDR':
+            if head[25] in (4, 6):  # grayscale or truecolor with alpha
+                return True
+            f.seek(33)  # after the IHDR chunk, look for a transparency chunk before the image data
+            while True:
+                chunk_head = f.read(8)
+                if len(chunk_head) < 8 or chunk_head[4:8] == b'IDAT':
+                    return False
+                if chunk_head[4:8] == b'tRNS':
+                    return True
+                f.seek(struct.unpack('>I', chunk_head[:4])[0] + 4, 1)  # skip the data and crc
+        if head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+            if head[12:16] == b'VP8X':
+                return bool(head[20] & 0x10)
+            if head[12:16] == b'VP8L':
+                return bool(head[24] & 0x10)
+    return False
+
+
+def _read_image_on_white(img_path: str) -> np.ndarray:
+    """Decode an image with an alpha channel and flatten it onto a white background."""
+    img = cv2.imread(img_path, cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise ValueError('failed to decode image')
+    if img.dtype != np.uint8:  # 16-bit
+        img = (img // 257).astype(np.uint8)
+    if img.ndim == 2:
+        return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    if img.shape[2] != 4:
+        return img
+    alpha = img[:, :, 3:].astype(np.float32) / 255
+    return (img[:, :, :3] * alpha + 255 * (1 - alpha) + 0.5).astype(np.uint8)
+
+
+def _get_output_size_scale(width: int, height: int, options: dict) -> float:
+    if options.get('cutMiddle'):
+        width = width / 2
+    fit_max_height = options.get('fitMaxHeight')
+    fit_max_width = options.get('fitMaxWidth')
+    scale = 1
+    if fit_max_height and height > fit_max_height:
+        scale = min(scale, fit_max_height / height)
+    if fit_max_width and width > fit_max_width:
+        scale = min(scale, fit_max_width / width)
+    return scale
+
+
+def read_image(img_path: str, options: dict) -> np.ndarray:
+    """
+    Decode an image, at a reduced size if the output will be scaled down enough (jpeg images are then decoded at the
+    reduced size directly).
+    """
+    flag = cv2.IMREAD_COLOR
+    size = get_image_size(img_path)
+    if size is not None:
+        width, height = size
+        # the image may be rotated by its exif orientation, so take the larger scale of both orientations
+        scale = max(_get_output_size_scale(width, height, options), _get_output_size_scale(height, width, options))
+        for factor, reduced_flag in _reduced_read_flags:
+            if scale <= 1 / factor:
+                flag = reduced_flag
+                break
+    img = cv2.imread(img_path, flag)
+    if img is None:
+        raise ValueError('failed to decode image')
+    return img
+
+
+def process_cut_middle(img: np.ndarray, options: dict) -> List[np.ndarray]:
+    """Cut the image in the middle, which returns views of the image without copying."""
     cut_middle = options.get('cutMiddle')
     discard_first = options.get('discardFirst')
     discard_second = options.get('discardSecond')
 
     if not cut_middle:
-        return images
-
-    output_images = []
-    for img in images:
-        height, width = img.shape[:2]
-        cut = round(width / 2)
-        cut_images = []
-        if not discard_first:
-            cut_images.append(img[:, :cut])
-        if not discard_second:
-            cut_images.append(img[:, cut:])
-        output_images.extend(cut_images)
-    return output_images
-
-
-def process_fit_max_size(images: List[np.ndarray], options: dict) -> List[np.ndarray]:
+        return [img]
+
+    height, width = img.shape[:2]
+    cut = round(width / 2)
+    cut_images = []
+    if not discard_first:
+        cut_images.append(img[:, :cut])
+    if not discard_second:
+        cut_images.append(img[:, cut:])
+    return cut_images
+
+
+def process_fit_max_size(img: np.ndarray, options: dict) -> np.ndarray:
+    img_height, img_width = img.shape[:2]
     fit_max_height = options.get('fitMaxHeight')
     fit_max_width = options.get('fitMaxWidth')
+    scale = 1
+    if fit_max_height and img_height > fit_max_height:
+        scale = min(scale, fit_max_height / img_height)
+    if fit_max_width and img_width > fit_max_width:
+        scale = min(scale, fit_max_width / img_width)
+    if scale < 1:
+        return cv2.resize(img, dsize=None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return img
+
+
+def get_num_outputs(options: dict) -> int:
+    """Get the number of images output by process_image() with the options."""
+    if not options.get('cutMiddle'):
+        return 1
+    return int(not options.get('discardFirst')) + int(not options.get('discardSecond'))
+
+
+def get_output_ext(ext: str, options: dict) -> str:
+    output_format = options.get('outputFormat')
+    if not output_format:
+        return ext
+    output_ext = _output_formats.get(output_format)
+    if output_ext is None:
+        raise ValueError('unsupported output format: %s' % output_format)
+    return output_ext
 
-    if not fit_max_height and not fit_max_width:
-        return images
-
-    output_images = []
-    for img in images:
-        img_height, img_width = img.shape[:2]
-        scale = 1
-        if fit_max_height and img_height > fit_max_height:
-            scale = min(scale, fit_max_height / img_height)
-        if fit_max_width and img_width > fit_max_width:
-            scale = min(scale, fit_max_width / img_width)
-        if scale < 1:
-            output_images.append(cv2.resize(img, dsize=None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA))
-        else:
-            output_images.append(img)
-    return output_images
-
-
-def write_images(images: List[np.ndarray], ext: str, work_dir: str) -> List[str]:
+
+def write_images(images: List[np.ndarray], ext: str, work_dir: str, quality: int = None) -> List[str]:
+    params = []
+    quality_flag = _quality_flags.get(ext)
+    if quality and quality_flag is not None:
+        params = [quality_flag, int(quality)]
     output_paths = []
     for i, img in enumerate(images):
         output_path = os.path.join(work_dir, 'output_%d%s' % (i, ext))
-        cv2.imwrite(output_path, img)
+        if not cv2.imwrite(output_path, img, params):
+            raise ValueError('failed to encode image')
         output_paths.append(output_path)
     return output_paths
 
 
 def process_image(img_path: str, options: dict, work_dir: str) -> List[str]:
-    ext = os.path.splitext(img_path)[-1]
-    img = cv2.imread(img_path)
+    """
+    Process an image with the options, in which the cut and the resize are done region by region on a single decoded
+    image. The output format (outputFormat: jpg, png or webp) and the encoding quality (outputQuality) can also be
+    specified. Return the paths of the output images in work_dir.
+    """
+    ext = get_output_ext(os.path.splitext(img_path)[-1].lower(), options)
+    img = read_image(img_path, options)
+    images = [process_fit_max_size(region, options) for region in process_cut_middle(img, options)]
+    return write_images(images, ext, work_dir, options.get('outputQuality'))
+
+
+def _is_grayscale(img: np.ndarray) -> bool:
+    """Check if a color image has (almost) no color, sampling at most about 512x512 pixels."""
+    step = max(1, max(img.shape[:2]) // 512)
+    sample = img[::step, ::step].astype(np.int16)
+    diff = np.maximum(np.abs(sample[:, :, 0] - sample[:, :, 1]), np.abs(sample[:, :, 1] - sample[:, :, 2]))
+    return np.percentile(diff, 99) < 24
+
+
+def _is_bitonal(gray: np.ndarray) -> bool:
+    """Check if a grayscale image is (almost) black and white only, like a scanned text page."""
+    step = max(1, max(gray.shape[:2]) // 512)
+    sample = gray[::step, ::step]
+    return np.count_nonzero((sample > 64) & (sample < 192)) < sample.size * 0.03
+
+
+def transcode_image(img_path: str, config: dict, work_dir: str) -> str:
+    """
+    Re-encode an image to save storage: the image is scaled down to fit max_width and max_height, and encoded in the
+    format (jpg or webp) with the quality of the config, which also strips the metadata. Png scans are kept lossless
+    but converted to grayscale or bitonal (black and white) if png_mode allows and the image looks like that.
+    Transparent areas are flattened onto white, as they would turn black otherwise.
+    Return the path of the output, or the input path if re-encoding does not make it smaller.
+    """
+    fit_options = dict(fitMaxWidth=config.get('max_width'), fitMaxHeight=config.get('max_height'))
+    ext = os.path.splitext(img_path)[-1].lower()
+    if _has_alpha(img_path):
+        img = _read_image_on_white(img_path)
+    else:
+        img = read_image(img_path, fit_options)
+    img = process_fit_max_size(img, fit_options)
+
+    params = []
+    png_mode = config.get('png_mode')
+    if ext == '.png' and png_mode in ('grayscale', 'bitonal') and _is_grayscale(img):
+        output_ext = '.png'
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        if png_mode == 'bitonal' and _is_bitonal(img):
+            _, img = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+            png_bilevel = getattr(cv2, 'IMWRITE_PNG_BILEVEL', None)  # not available in older versions
+            if png_bilevel is not None:
+                params = [png_bilevel, 1]
+    else:
+        output_ext = _output_formats.get(config.get('format') or 'jpg')
+        if output_ext is None:
+            raise ValueError('unsupported output format: %s' % config.get('format'))
+        quality_flag = _quality_flags.get(output_ext)
+        if quality_flag is not None and config.get('quality'):
+            params = [quality_flag, int(config['quality'])]
+
+    output_path = os.path.join(work_dir, 'transcoded%s' % output_ext)
+    if not cv2.imwrite(output_path, img, params):
+        raise ValueError('failed to encode image')
+    if os.path.getsize(output_path) >= os.path.getsize(img_path):  # no gain
+        os.remove(output_path)
+        return img_path
+    return output_path
+
+
+def try_transcode_image(img_path: str, config: dict, work_dir: str) -> str:
+    """Transcode an image like transcode_image(), but keep the image as is if it can not be decoded or encoded."""
+    try:
+        return transcode_image(img_path, config, work_dir)
+    except (ValueError, cv2.error) as e:  # e.g. heic, some cmyk jpeg or truncated files
+        print('[Warning] Failed to transcode %s (%s), kept as is' % (os.path.basename(img_path), e), file=sys.stderr)
+        return img_path
+
+
+class ImageTranscoder:
+    """
+    Optional transcoding of the uploaded page images, which is disabled unless configured (PAGE_TRANSCODING), since it
+    changes the stored submissions, e.g. {"max_width": 2400, "max_height": 2400, "format": "jpg", "quality": 85,
+    "png_mode": "grayscale", "keep_original": true}. See transcode_image() for the config.
+    If keep_original is set, the original upload is also stored next to the transcoded file. The images that fail to
+    be transcoded are stored as uploaded.
+    """
+    enabled = False
+    keep_original = False
+    config = {}
+
+    @classmethod
+    def init(cls, app_config: dict):
+        config = app_config.get('PAGE_TRANSCODING')
+        if not config:
+            return
+        cls.config = config
+        cls.keep_original = bool(config.get('keep_original'))
+        cls.enabled = True
+
+    @classmethod
+    def apply_to_options(cls, options: dict) -> dict:
+        """Apply the limits and encoding of transcoding to the options of image processing."""
+        if not cls.enabled:
+            return options
+        options = dict(options)
+        for option_key, config_key in (('fitMaxWidth', 'max_width'), ('fitMaxHeight', 'max_height')):
+            limit = cls.config.get(config_key)
+            if limit and (not options.get(option_key) or options[option_key] > limit):
+                options[option_key] = limit
+        if not options.get('outputFormat'):
+            options['outputFormat'] = cls.config.get('format') or 'jpg'
+        if not options.get('outputQuality'):
+            options['outputQuality'] = cls.config.get('quality')
+        return options
+
+
+class ImagePipeline:
+    """
+    Transcode the images of an upload in parallel in a pool of worker processes, which is created once and reused.
+    The images uploaded with options are processed one by one in the background instead (see run_pages_process).
+    """
+    num_workers = None
+    _executor = None
+
+    @classmethod
+    def init(cls, app_config: dict):
+        cls.num_workers = app_config.get('IMAGE_WORKERS')
+
+    @classmethod
+    def _get_executor(cls) -> ProcessPoolExecutor:
+        if cls._executor is None:
+            cls._executor = ProcessPoolExecutor(cls.num_workers)
+        return cls._executor
+
+    @classmethod
+    def transcode_images(cls, img_paths: List[str], work_dir: str) -> List[str]:
+        """
+        Transcode the images with the config of ImageTranscoder and return the output path of each image in order, which
+        is the input path if the image is kept as is.
+        """
+        return cls._map(try_transcode_image, img_paths, ImageTranscoder.config, work_dir)
+
+    @classmethod
+    def _map(cls, func, img_paths: List[str], options: dict, work_dir: str) -> list:
+        work_dirs = []
+        for i in range(len(img_paths)):
+            img_work_dir = os.path.join(work_dir, '%s_%d' % (func.__name__, i))
+            os.mkdir(img_work_dir)
+            work_dirs.append(img_work_dir)
 
-    images = process_cut_middle([img], options)
-    images = process_fit_max_size(images, options)
-    return write_images(images, ext, work_dir)
+        if len(img_paths) <= 1 or cls.num_workers == 1 or not can_fork_workers('image processing'):
+            return [func(path, options, d) for path, d in zip(img_paths, work_dirs)]
+        try:
+            return list(cls._get_executor().map(func, img_paths, repeat(options), work_dirs))
+        except BrokenProcessPool:  # e.g. a worker was killed, so start over with a new pool next time
+            cls._executor = None
+            raise
@@ -0,0 +1,130 @@
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import repeat
+from typing import Dict, Iterator, Optional
+
+from utils.crypt import md5sum
+from utils.importer import Importer
+from utils.pdf import get_pdf_pages, PDFError
+from utils.process import can_fork_workers
+
+
+class ImportedFile:
+    def __init__(self, name: str, time: datetime, path: str, md5: str = None, num_pages: int = None,
+                 error: str = None):
+        self.name = name
+        self.time = time
+        self.path = path
+        self.md5 = md5
+        self.num_pages = num_pages
+        self.error = error
+
+    def __repr__(self):
+        return '<ImportedFile %r>' % self.name
+
+
+class StudentImport:
+    def __init__(self, student_id: str, has_submission: bool, submission_time: Optional[datetime] = None,
+                 files: Dict[str, ImportedFile] = None):
+        self.student_id = student_id
+        self.has_submission = has_submission
+        self.submission_time = submission_time
+        self.files = files or {}
+
+    def __repr__(self):
+        return '<StudentImport %r>' % self.student_id
+
+
+def prepare_student(importer: Importer, file_names: list, known_pdf_pages: Optional[Dict[str, int]], student_id: str,
+                    folder_path: str) -> StudentImport:
+    """
+    Do all the per-student work that does not touch the database: extract the submissions, pick the latest version of
+    each required file, count the pdf pages (unless known by md5) and hash the files (if not already hashed during the
+    extraction).
+
+    This is a module-level function so that it can be sent to the worker processes.
+    """
+    submissions_info = importer.import_student_folder(student_id, folder_path)
+    if not submissions_info:  # no submission
+        return StudentImport(student_id, False)
+
+    files_to_find = set(file_names)
+    files_found = {}
+    submission_time = None
+    for i, (_time, files) in enumerate(reversed(submissions_info)):  # from the latest to the oldest
+        if not files:  # overwritten or empty submission
+            continue
+        for name, tmp_path in files.items():
+            if name in files_to_find:  # not yet found
+                if i != 0:  # not the latest
+                    print('[Warning] Importing "%s" from non-default submission for student "%s"'
+                          % (name, student_id), file=sys.stderr)
+                files_to_find.remove(name)
+                files_found[name] = ImportedFile(name, _time, tmp_path)
+                if submission_time is None or submission_time < _time:
+                    submission_time = _time
+        if not files_to_find:  # all files found
+            break
+
+    for file in files_found.values():
+        file.md5 = importer.get_extracted_md5(file.path) or md5sum(file.path)
+        ext = os.path.splitext(file.name)[-1]
+        if ext == '.pdf':  # split pdf pages
+            try:
+                file.num_pages = get_pdf_pages(file.path, file.md5, known_pdf_pages)
+            except PDFError as e:
+                file.error = e.msg
+    return StudentImport(student_id, True, submission_time, files_found)
+
+
+class ImportEngine:
+    """
+    Run the per-student work of an importer in a pool of worker processes.
+
+    The results are yielded in the same order as the student folders are scanned, so the caller can do all the
+    database writes in the main process. The page counts of the pdf files already known (by md5) can be given as
+    known_pdf_pages, since the workers can not access the database.
+    """
+
+    def __init__(self, importer: Importer, file_names: list, num_workers: int = None,
+                 known_pdf_pages: Dict[str, int] = None):
+        self.importer = importer
+        self.file_names = file_names
+        self.known_pdf_pages = known_pdf_pages
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        self.num_workers = num_workers
+        self.num_students = None  # known once the archive has been scanned
+
+    def run(self, archive_path: str, extract_dir: str, num_skipped_students: int = 0) -> Iterator[StudentImport]:
+        """
+        Yield the results of the students in the archive, except for the first num_skipped_students ones (in the
+        scanning order), which is used to resume an interrupted import.
+        """
+        try:
+            yield from self._run(archive_path, extract_dir, num_skipped_students)
+        finally:
+            self.importer.close()
+
+    def _run(self, archive_path: str, extract_dir: str, num_skipped_students: int) -> Iterator[StudentImport]:
+        folders = list(self.importer.scan_archive(archive_path, extract_dir))
+        self.num_students = len(folders)
+        folders = folders[num_skipped_students:]
+        if not folders:
+            return
+        student_ids = [student_id for student_id, _ in folders]
+        folder_paths = [folder_path for _, folder_path in folders]
+
+        if self.num_workers <= 1 or len(folders) == 1 or not can_fork_workers('import of students'):
+            for student_id, folder_path in folders:
+                yield prepare_student(self.importer, self.file_names, self.known_pdf_pages, student_id, folder_path)
+            return
+
+        num_workers = min(self.num_workers, len(folders))
+        # use a few chunks per worker to balance the load without paying the IPC cost for every single student
+        chunk_size = max(1, len(folders) // (num_workers * 4))
+        with ProcessPoolExecutor(num_workers) as executor:
+            yield from executor.map(prepare_student, repeat(self.importer), repeat(self.file_names),
+                                    repeat(self.known_pdf_pages), student_ids, folder_paths, chunksize=chunk_size)
@@ -1,13 +1,14 @@
 import os
+import posixpath
 import re
-import shutil
 import sys
 from datetime import datetime
-from typing import Iterable
+from typing import Iterable, Iterator, Tuple, Optional, Dict, IO
 
 from dateutil import tz
 
 from error import BasicError
+from utils.archive import ArchiveReader, ArchiveError, extract_stream
 
 _tz_local = tz.tzlocal()
 _tz_utc = tz.tzutc()
@@ -18,9 +19,82 @@ class ImporterError(BasicError):
 
 
 class Importer:
+    archive_path = None  # type: Optional[str]
+    extract_dir = None  # type: Optional[str]
+    _reader = None  # type: Optional[ArchiveReader]
+    _extracted_md5s = None  # type: Optional[Dict[str, str]]
+
     def import_archive(self, archive_path: str, extract_dir: str):
+        try:
+            for student_id, folder_path in self.scan_archive(archive_path, extract_dir):
+                yield student_id, self.import_student_folder(student_id, folder_path)
+        finally:
+            self.close()
+
+    def scan_archive(self, archive_path: str, extract_dir: str) -> Iterator[Tuple[str, str]]:
+        """
+        Scan the archive and yield (student_id, folder_path) for each student folder, where folder_path is the path
+        of the folder inside the archive.
+        The per-student work is left to import_student_folder so that it can be distributed to other processes.
+        """
         raise NotImplementedError()
 
+    def import_student_folder(self, student_id: str, folder_path: str) -> list:
+        raise NotImplementedError()
+
+    def _open_archive(self, archive_path: str, extract_dir: str) -> ArchiveReader:
+        if not os.path.exists(extract_dir):
+            os.makedirs(extract_dir)
+        if os.listdir(extract_dir):
+            raise ImporterError('extract dir is not empty')
+
+        try:
+            self.archive_path = ArchiveReader.prepare(archive_path, extract_dir)
+        except IOError as e:
+            raise ImporterError('failed to unpack archive', str(e)) from e
+        except ArchiveError as e:
+            raise ImporterError('failed to unpack archive', e.detail or e.msg) from e
+        self.extract_dir = extract_dir
+        return self._get_reader()
+
+    def _get_reader(self) -> ArchiveReader:
+        """Open the archive lazily, as the importer may have been sent to another process."""
+        if self._reader is None:
+            try:
+                self._reader = ArchiveReader(self.archive_path)
+            except ArchiveError as e:
+                raise ImporterError('failed to unpack archive', e.detail or e.msg) from e
+        return self._reader
+
+    def _extract(self, reader: ArchiveReader, member_path: str, student_id: str, *path_parts: str) -> str:
+        """Extract a single member of the archive into the folder of the student and return the extracted path."""
+        extract_path = os.path.join(self.extract_dir, student_id, *path_parts)
+        with reader.open(member_path) as f_member:
+            self._extract_stream(f_member, extract_path)
+        return extract_path
+
+    def _extract_stream(self, src: IO[bytes], extract_path: str):
+        if self._extracted_md5s is None:
+            self._extracted_md5s = {}
+        self._extracted_md5s[extract_path] = extract_stream(src, extract_path)
+
+    def get_extracted_md5(self, extract_path: str) -> Optional[str]:
+        """Get the md5 of an extracted file, which has been computed during the extraction."""
+        if self._extracted_md5s is None:
+            return None
+        return self._extracted_md5s.get(extract_path)
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_reader'] = None  # do not send the open archive to other processes
+        state['_extracted_md5s'] = None
+        return state
+
 
 class GenericImporterError(ImporterError):
     pass
@@ -33,46 +107,43 @@ class GenericImporter(Importer):
     def __init__(self, required_file_names: Iterable[str]):
         self.required_file_names = set(required_file_names)
 
-    def import_archive(self, archive_path: str, extract_dir: str):
-        if not os.path.exists(extract_dir):
-            os.makedirs(extract_dir)
-        if os.listdir(extract_dir):
-            raise GenericImporterError('extract dir is not empty')
-
+    def scan_archive(self, archive_path: str, extract_dir: str):
         try:
-            shutil.unpack_archive(archive_path, extract_dir)
-        except IOError as e:
-            raise GenericImporterError('failed to unpack archive', str(e)) from e
+            reader = self._open_archive(archive_path, extract_dir)
+        except ImporterError as e:
+            raise GenericImporterError(e.msg, e.detail) from e
 
         # find the "root" folder, which contains a list of student folders, by locating any default submission file
         root = None
-        for dir_path, dir_names, file_names in os.walk(extract_dir):
+        for dir_path, dir_names, file_names in reader.walk():
             if any(name.lower().endswith('.pdf') for name in file_names):
-                root, _ = os.path.split(dir_path)
+                root, _ = posixpath.split(dir_path)
                 break
         if root is None:
             raise GenericImporterError('failed to find a submission')
-        dir_list = os.listdir(root)
+        dir_list = reader.list_dir(root)
 
         for name in sorted(dir_list):
             match = self._student_folder_pattern.fullmatch(name)
             if not match:
                 continue
-            path = os.path.join(root, name)
-            if not os.path.isdir(path):  # not a folder
+            path = posixpath.join(root, name)
+            if not reader.is_dir(path):  # not a folder
                 continue
             student_id = match.group(1).lower()
-            yield student_id, self._import_student_folder(student_id, path)
+            yield student_id, path
 
-    def _import_student_folder(self, student_id, path):
+    def import_student_folder(self, student_id: str, path: str):
         now = datetime.utcnow()
-        contents = os.listdir(path)
-        pdf_files = [name for name in contents if name.lower().endswith('.pdf')]
+        reader = self._get_reader()
+        contents = reader.list_dir(path)
+        pdf_files = [name for name in contents
+                     if name.lower().endswith('.pdf') and reader.is_file(posixpath.join(path, name))]
         if len(pdf_files) != 1:
             if len(pdf_files) > 1:
                 raise GenericImporterError('more than 1 pdf files exist in %s\'s submission' % student_id)
             else:  # == 0
                 print('[Warning] No pdf found in %s\'s submission' % student_id, file=sys.stderr)
                 return [(now, {})]  # return one submission with no files
-        pdf_file_path = os.path.join(path, pdf_files[0])
+        pdf_file_path = self._extract(reader, posixpath.join(path, pdf_files[0]), student_id, self.PDF_FILE_NAME)
         return [(now, {self.PDF_FILE_NAME: pdf_file_path})]
@@ -1,12 +1,27 @@
-from typing import Optional
+import threading
+import time
+from typing import Optional, Sequence
 
 import geoip2.database
 from geoip2.errors import AddressNotFoundError
 
+from utils.cache import LRUCache
+
+_missing = object()
+
 
 class IPTool:
+    """
+    Resolve the country (and the region decisions based on it) of client ip addresses, which are cached by ip with a
+    ttl (GEOIP cache_size and cache_ttl), since the same clients come again and again. The country database can be
+    loaded in memory (GEOIP memory) instead of being read from the file by each lookup.
+    """
     _geo_country_db = None
     _is_behind_proxy = False
+    _cache = LRUCache(max_size=65536, ttl=3600)
+    _num_lookups = 0
+    _lookup_seconds = 0.0
+    _lock = threading.Lock()
 
     @classmethod
     def init_app(cls, app):
@@ -15,20 +30,62 @@ class IPTool:
         if geo_ip_config:
             country_db_path = geo_ip_config.get('country')
             if country_db_path:
-                cls._geo_country_db = geoip2.database.Reader(country_db_path)
+                if geo_ip_config.get('memory'):
+                    cls._geo_country_db = geoip2.database.Reader(country_db_path, mode=geoip2.database.MODE_MEMORY)
+                else:
+                    cls._geo_country_db = geoip2.database.Reader(country_db_path)
+            cls._cache = LRUCache(max_size=geo_ip_config.get('cache_size') or 65536,
+                                  ttl=geo_ip_config.get('cache_ttl') or 3600)
 
     @classmethod
-    def get_ip_country(cls, ip_addr: str) -> Optional[str]:
-        if cls._geo_country_db is None:
-            return None
+    def _lookup_country(cls, ip_addr: str) -> Optional[str]:
+        start_time = time.perf_counter()
         try:
             country = cls._geo_country_db.country(ip_addr)
             if country:
                 return country.country.iso_code
-        except AddressNotFoundError:
+        except (AddressNotFoundError, ValueError):  # ValueError for an invalid address
             pass
+        finally:
+            with cls._lock:
+                cls._num_lookups += 1
+                cls._lookup_seconds += time.perf_counter() - start_time
         return None
 
+    @classmethod
+    def get_ip_country(cls, ip_addr: str) -> Optional[str]:
+        if cls._geo_country_db is None:
+            return None
+        key = ('country', ip_addr)
+        country = cls._cache.get(key, _missing)
+        if country is _missing:
+            country = cls._lookup_country(ip_addr)
+            cls._cache.put(key, country)
+        return country
+
+    @classmethod
+    def get_ip_region(cls, ip_addr: str, regions: Sequence[str]) -> Optional[str]:
+        """
+        Get the region of an ip address, i.e. its lower-cased country code, if it is one of regions (e.g. the regions
+        of the file mirror, or of the static folders), otherwise None. The decision is cached by ip and regions.
+        """
+        if cls._geo_country_db is None or not regions:
+            return None
+        key = ('region', ip_addr, tuple(regions))
+        region = cls._cache.get(key, _missing)
+        if region is _missing:
+            country = cls.get_ip_country(ip_addr)
+            region = country.lower() if country and country.lower() in regions else None
+            cls._cache.put(key, region)
+        return region
+
+    @classmethod
+    def get_cache_stats(cls) -> dict:
+        """Get the counters of the cache and of the actual lookups (in this process)."""
+        stats = cls._cache.get_stats()
+        stats.update(num_lookups=cls._num_lookups, lookup_seconds=cls._lookup_seconds)
+        return stats
+
     @classmethod
     def get_client_ip(cls, request) -> str:
         if cls._is_behind_proxy:
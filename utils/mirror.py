@@ -1,9 +1,14 @@
+import hashlib
+import os
+import threading
 import time
+from typing import Optional, Iterator, List
 from urllib.parse import urlsplit, urlunsplit
 from uuid import uuid4
 
 import oss2
 
+from utils.cache import LRUCache
 from utils.crypt import md5s
 
 
@@ -11,15 +16,18 @@ class MirrorConfig:
     def __init__(self,
                  provider,
                  regions,
-                 endpoint,
-                 bucket_name,
-                 access_key_id,
-                 access_key_secret,
-                 domain,
-                 secret,
-                 expire,
-                 expire_time_unit,
-                 randomize):
+                 endpoint=None,
+                 bucket_name=None,
+                 access_key_id=None,
+                 access_key_secret=None,
+                 domain=None,
+                 secret=None,
+                 expire=3600,
+                 expire_time_unit=60,
+                 randomize=False,
+                 multipart_threshold=None,
+                 part_size=None,
+                 checkpoint_dir=None):
         self.provider = provider
         self.regions = regions
         self.endpoint = endpoint
@@ -31,6 +39,9 @@ class MirrorConfig:
         self.expire = expire
         self.expire_time_unit = expire_time_unit
         self.randomize = randomize
+        self.multipart_threshold = multipart_threshold  # in bytes, resumable multipart upload for larger files
+        self.part_size = part_size
+        self.checkpoint_dir = checkpoint_dir  # where the progress of resumable uploads is kept
 
 
 class MirrorProgressController:
@@ -50,7 +61,9 @@ class MirrorProvider:
     def __init__(self, cfg: MirrorConfig):
         self._cfg = cfg
 
-    def put(self, remote_path: str, local_path: str, progress_controller: MirrorProgressController = None):
+    def put(self, remote_path: str, local_path: str, progress_controller: MirrorProgressController = None) \
+            -> Optional[str]:
+        """Upload a file and return the etag of the remote object if available."""
         raise NotImplementedError()
 
     def get_url(self, file_path: str) -> str:
@@ -62,28 +75,59 @@ class MirrorProvider:
     def exists(self, file_path: str) -> bool:
         raise NotImplementedError()
 
+    def list(self, prefix: str) -> Iterator[str]:
+        """List the paths of the remote objects starting with prefix."""
+        raise NotImplementedError()
+
 
 class AliyunOSSMirror(MirrorProvider):
+    """
+    The provider of Aliyun OSS. Each thread keeps a bucket with its own HTTP session, so that the connections are
+    reused across the requests of the thread (a forked process starts with new sessions).
+    """
+
     def __init__(self, cfg: MirrorConfig):
         super().__init__(cfg)
+        self._auth = oss2.Auth(cfg.access_key_id, cfg.access_key_secret)
+        self._local = threading.local()
+        self._url_cache = LRUCache(max_size=65536, ttl=cfg.expire_time_unit)
 
     def _get_bucket(self):
-        auth = oss2.Auth(self._cfg.access_key_id, self._cfg.access_key_secret)
-        return oss2.Bucket(auth, self._cfg.endpoint, self._cfg.bucket_name)
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            self._local.bucket = oss2.Bucket(self._auth, self._cfg.endpoint, self._cfg.bucket_name,
+                                             session=oss2.Session())
+            self._local.pid = pid
+        return self._local.bucket
 
-    def put(self, remote_path: str, local_path: str, progress_controller: MirrorProgressController = None):
+    def put(self, remote_path: str, local_path: str, progress_controller: MirrorProgressController = None) \
+            -> Optional[str]:
         if progress_controller:
             progress_callback = progress_controller.progress
         else:
             progress_callback = None
-        self._get_bucket().put_object_from_file(remote_path, local_path, progress_callback=progress_callback)
+        if self._cfg.multipart_threshold and os.path.getsize(local_path) >= self._cfg.multipart_threshold:
+            # resumed from the uploaded parts if a previous attempt failed
+            store = oss2.ResumableStore(root=self._cfg.checkpoint_dir) if self._cfg.checkpoint_dir else None
+            result = oss2.resumable_upload(self._get_bucket(), remote_path, local_path, store=store,
+                                           multipart_threshold=self._cfg.multipart_threshold,
+                                           part_size=self._cfg.part_size, progress_callback=progress_callback)
+        else:
+            result = self._get_bucket().put_object_from_file(remote_path, local_path,
+                                                             progress_callback=progress_callback)
+        return result.etag
 
     def get_url(self, file_path: str) -> str:
-        url = '%s/%s' % (self._cfg.domain, file_path)
         expire = int(time.time() + self._cfg.expire)
         unit = self._cfg.expire_time_unit
         expire = int(round(expire / unit) * unit)
-        return self.a_auth(url, self._cfg.secret, expire, self._cfg.randomize)
+        # the same url is given in the same time unit, so that it can be cached by the browser and the cdn
+        key = (file_path, expire)
+        url = self._url_cache.get(key)
+        if url is None:
+            url = self.a_auth('%s/%s' % (self._cfg.domain, file_path), self._cfg.secret, expire, self._cfg.randomize)
+            self._url_cache.put(key, url)
+        return url
 
     def delete(self, file_path: str):
         self._get_bucket().delete_object(file_path)
@@ -91,6 +135,10 @@ class AliyunOSSMirror(MirrorProvider):
     def exists(self, file_path: str) -> bool:
         return self._get_bucket().object_exists(file_path)
 
+    def list(self, prefix: str) -> Iterator[str]:
+        for obj in oss2.ObjectIterator(self._get_bucket(), prefix=prefix, max_keys=1000):
+            yield obj.key
+
     @staticmethod
     def a_auth(uri: str, key: str, exp_time: int, randomize: bool):
         exp_time = str(exp_time)
@@ -111,6 +159,70 @@ class AliyunOSSMirror(MirrorProvider):
         return urlunsplit((scheme, host, path, args, fragment))
 
 
+class LocalMirror(MirrorProvider):
+    """
+    A provider that mirrors the files into a local directory (endpoint), e.g. to test or benchmark the mirror path
+    without a remote service. The urls are the paths under domain, which should serve the directory.
+    """
+    _block_size = 1048576
+
+    def __init__(self, cfg: MirrorConfig):
+        super().__init__(cfg)
+        if not cfg.endpoint:
+            raise ValueError('endpoint (the mirror directory) is required for local mirror')
+        self._root = os.path.abspath(cfg.endpoint)
+
+    def _get_full_path(self, file_path: str) -> str:
+        full_path = os.path.abspath(os.path.join(self._root, file_path))
+        if not full_path.startswith(self._root + os.sep):
+            raise ValueError('invalid mirror path: %s' % file_path)
+        return full_path
+
+    def put(self, remote_path: str, local_path: str, progress_controller: MirrorProgressController = None) \
+            -> Optional[str]:
+        full_path = self._get_full_path(remote_path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        total_bytes = os.path.getsize(local_path)
+        consumed_bytes = 0
+        md5 = hashlib.md5()
+        tmp_path = '%s.%s.tmp' % (full_path, uuid4())
+        try:
+            with open(local_path, 'rb') as f_src, open(tmp_path, 'wb') as f_dst:
+                block = f_src.read(self._block_size)
+                while block:
+                    f_dst.write(block)
+                    md5.update(block)
+                    consumed_bytes += len(block)
+                    if progress_controller:
+                        progress_controller.progress(consumed_bytes, total_bytes)
+                    block = f_src.read(self._block_size)
+            os.replace(tmp_path, full_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return md5.hexdigest().upper()  # like the etag of oss
+
+    def get_url(self, file_path: str) -> str:
+        return '%s/%s' % (self._cfg.domain or '', file_path)
+
+    def delete(self, file_path: str):
+        full_path = self._get_full_path(file_path)
+        if os.path.exists(full_path):
+            os.remove(full_path)
+
+    def exists(self, file_path: str) -> bool:
+        return os.path.isfile(self._get_full_path(file_path))
+
+    def list(self, prefix: str) -> Iterator[str]:
+        for root, dirs, files in os.walk(os.path.join(self._root, os.path.dirname(prefix))):
+            for name in files:
+                if name.endswith('.tmp'):  # being uploaded
+                    continue
+                path = os.path.relpath(os.path.join(root, name), self._root)
+                if path.startswith(prefix):
+                    yield path
+
+
 class MirrorTool:
     enabled: bool = False
     _cfg: MirrorConfig = None
@@ -124,6 +236,8 @@ class MirrorTool:
             cls._cfg = cfg
             if cfg.provider == 'aliyun-oss':
                 cls._provider = AliyunOSSMirror(cfg)
+            elif cfg.provider == 'local':
+                cls._provider = LocalMirror(cfg)
             else:
                 raise ValueError('invalid mirror provider: %s' % cfg.provider)
             cls.enabled = True
@@ -131,14 +245,15 @@ class MirrorTool:
             cls.enabled = False
 
     @classmethod
-    def is_region_supported(cls, region: str):
-        return region in cls._cfg.regions
+    def get_regions(cls) -> List[str]:
+        return cls._cfg.regions
 
     @classmethod
-    def put(cls, remote_path: str, local_path: str, progress_controller: MirrorProgressController = None):
+    def put(cls, remote_path: str, local_path: str, progress_controller: MirrorProgressController = None) \
+            -> Optional[str]:
         if not cls.enabled:
             raise RuntimeError('mirror not enabled')
-        cls._provider.put(remote_path, local_path, progress_controller)
+        return cls._provider.put(remote_path, local_path, progress_controller)
 
     @classmethod
     def get_url(cls, file_path: str) -> str:
@@ -157,3 +272,9 @@ class MirrorTool:
         if not cls.enabled:
             raise RuntimeError('mirror not enabled')
         return cls._provider.exists(file_path)
+
+    @classmethod
+    def list(cls, prefix: str) -> Iterator[str]:
+        if not cls.enabled:
+            raise RuntimeError('mirror not enabled')
+        return cls._provider.list(prefix)
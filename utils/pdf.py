@@ -1,14 +1,59 @@
+import re
 import subprocess
-from typing import Optional
+import zlib
+from typing import Dict, Optional, Tuple
 
 from error import BasicError
+from utils.cache import LRUCache
 
 
 class PDFError(BasicError):
     pass
 
 
-def get_pdf_pages(file_path: str) -> Optional[int]:
+class _PDFParseError(Exception):
+    pass
+
+
+# page counts by the md5 of the files, as a fast path in front of the page counts recorded in the database
+_pages_cache = LRUCache(max_size=8192)
+
+_re_startxref = re.compile(rb'startxref\s+(\d+)')
+_re_obj_header = re.compile(rb'\s*(\d+)\s+(\d+)\s+obj')
+_re_stream_start = re.compile(rb'\s*stream(?:\r\n|\n|\r)')
+_white_spaces = b' \t\r\n\f\0'
+
+
+def get_pdf_pages(file_path: str, md5: str = None, known_pages: Dict[str, int] = None) -> Optional[int]:
+    """
+    Get the number of pages of a pdf file.
+
+    The page tree is read in process, and pdfinfo is only used if the file can not be parsed that way (e.g. a broken
+    cross-reference table that needs to be repaired). If md5 is provided, the result is cached by it, and looked up
+    in known_pages (the page counts by md5 recorded in the database) if not cached yet.
+    """
+    if md5:
+        num_pages = _pages_cache.get(md5)
+        if num_pages is not None:
+            return num_pages
+        num_pages = known_pages.get(md5) if known_pages else None
+        if num_pages is not None:
+            _pages_cache.put(md5, num_pages)
+            return num_pages
+    try:
+        num_pages = count_pdf_pages(file_path)
+    except (_PDFParseError, ValueError, IndexError, TypeError, zlib.error):
+        num_pages = _get_pdf_pages_by_pdfinfo(file_path)
+    if md5 and num_pages is not None:
+        _pages_cache.put(md5, num_pages)
+    return num_pages
+
+
+def get_pdf_pages_cache_stats() -> dict:
+    return _pages_cache.get_stats()
+
+
+def _get_pdf_pages_by_pdfinfo(file_path: str) -> Optional[int]:
     try:
         for line in subprocess.check_output(["pdfinfo", file_path]).splitlines():
             if line.startswith(b'Pages:'):
@@ -16,5 +61,338 @@ def get_pdf_pages(file_path: str) -> Optional[int]:
         return None
     except subprocess.CalledProcessError as e:
         raise PDFError('pdfinfo command failed [%d]' % e.returncode) from e
+    except FileNotFoundError as e:
+        raise PDFError('pdfinfo command not found') from e
     except ValueError as e:
         raise PDFError('failed to parse pdfinfo output') from e
+
+
+def count_pdf_pages(file_path: str) -> int:
+    """
+    Count the pages of a pdf file by reading its cross-reference sections (tables or streams) from the trailer and
+    then the /Count of the root of the page tree. Only the few objects on that path are read.
+    """
+    with open(file_path, 'rb') as f:
+        return _PDFReader(f).get_page_count()
+
+
+class _PDFReader:
+    _tail_size = 4096
+    _chunk_size = 65536
+
+    def __init__(self, f):
+        self._f = f
+        self._xref = {}  # type: Dict[int, Tuple]  # num -> (1, offset) or (2, stream_num, index)
+        self._trailer = None
+        self._obj_streams = {}  # type: Dict[int, Tuple[int, bytes]]
+        self._load_xref(self._find_startxref())
+
+    def get_page_count(self) -> int:
+        root = self._get_ref(self._trailer, b'Root')
+        if root is None:
+            raise _PDFParseError('root not found in trailer')
+        pages = self._get_ref(self._get_object(root), b'Pages')
+        if pages is None:
+            raise _PDFParseError('page tree not found in catalog')
+        pages_dict = self._get_object(pages)
+        count_ref = self._get_ref(pages_dict, b'Count')
+        if count_ref is not None:
+            return int(self._get_object(count_ref).split()[0])
+        count = self._get_int(pages_dict, b'Count')
+        if count is None:
+            raise _PDFParseError('page count not found')
+        return count
+
+    def _read(self, offset: int, size: int) -> bytes:
+        self._f.seek(offset)
+        return self._f.read(size)
+
+    def _find_startxref(self) -> int:
+        self._f.seek(0, 2)
+        file_size = self._f.tell()
+        tail = self._read(max(0, file_size - self._tail_size), self._tail_size)
+        matches = list(_re_startxref.finditer(tail))
+        if not matches:
+            raise _PDFParseError('startxref not found')
+        return int(matches[-1].group(1))
+
+    def _load_xref(self, offset: int):
+        visited = set()
+        offsets = [offset]
+        while offsets:
+            offset = offsets.pop(0)
+            if offset in visited:
+                continue
+            visited.add(offset)
+            data = self._read(offset, 4)
+            if data == b'xref':
+                trailer = self._load_xref_table(offset)
+            else:
+                trailer = self._load_xref_stream(offset)
+            if self._trailer is None:  # the latest trailer
+                self._trailer = trailer
+            for key in (b'XRefStm', b'Prev'):  # the hybrid stream is read before the previous section
+                prev = self._get_int(trailer, key)
+                if prev is not None:
+                    offsets.append(prev)
+
+    def _add_xref_entry(self, num: int, entry: Tuple):
+        if num not in self._xref:  # entries in the later sections take precedence
+            self._xref[num] = entry
+
+    def _load_xref_table(self, offset: int) -> bytes:
+        data = b''
+        pos = offset
+        while True:
+            chunk = self._read(pos, self._chunk_size)
+            if not chunk:
+                raise _PDFParseError('trailer not found')
+            data += chunk
+            pos += len(chunk)
+            trailer_pos = data.find(b'trailer')
+            if trailer_pos >= 0:
+                trailer_data = data[trailer_pos + len(b'trailer'):]
+                dict_start = trailer_data.find(b'<<')
+                dict_end = _find_dict_end(trailer_data, dict_start) if dict_start >= 0 else -1
+                if dict_end >= 0:
+                    break
+
+        tokens = data[len(b'xref'):trailer_pos].split()
+        i = 0
+        while i < len(tokens):
+            start, count = int(tokens[i]), int(tokens[i + 1])
+            i += 2
+            for num in range(start, start + count):
+                entry_offset, _gen, entry_type = tokens[i:i + 3]
+                if entry_type == b'n':
+                    self._add_xref_entry(num, (1, int(entry_offset)))
+                elif entry_type == b'f':
+                    self._add_xref_entry(num, (0,))
+                else:
+                    raise _PDFParseError('invalid xref entry')
+                i += 3
+        return trailer_data[dict_start:dict_end]
+
+    def _load_xref_stream(self, offset: int) -> bytes:
+        _num, obj_dict, stream = self._read_object_at(offset)
+        if stream is None or not re.search(rb'/Type\s*/XRef\b', obj_dict):
+            raise _PDFParseError('invalid xref stream')
+        data = self._decode_stream(obj_dict, stream)
+
+        widths = [int(w) for w in self._get_array(obj_dict, b'W')]
+        if len(widths) != 3:
+            raise _PDFParseError('invalid xref stream widths')
+        index = self._get_array(obj_dict, b'Index')
+        if index is None:
+            index = [0, self._get_int(obj_dict, b'Size')]
+        index = [int(x) for x in index]
+
+        pos = 0
+        for i in range(0, len(index), 2):
+            start, count = index[i], index[i + 1]
+            for num in range(start, start + count):
+                fields = []
+                for width in widths:
+                    fields.append(int.from_bytes(data[pos:pos + width], 'big'))
+                    pos += width
+                entry_type = fields[0] if widths[0] else 1
+                if entry_type == 1:
+                    self._add_xref_entry(num, (1, fields[1]))
+                elif entry_type == 2:
+                    self._add_xref_entry(num, (2, fields[1], fields[2]))
+                else:
+                    self._add_xref_entry(num, (0,))
+            if pos > len(data):
+                raise _PDFParseError('truncated xref stream')
+        return obj_dict
+
+    def _read_object_at(self, offset: int) -> Tuple[int, bytes, Optional[bytes]]:
+        """Read an indirect object and return its number, its body (or dictionary) and its raw stream data if any."""
+        data = self._read(offset, self._chunk_size)
+        m = _re_obj_header.match(data)
+        if m is None:
+            raise _PDFParseError('object not found at %d' % offset)
+        num = int(m.group(1))
+        pos = m.end()
+        while pos < len(data) and data[pos] in _white_spaces:
+            pos += 1
+
+        if not data.startswith(b'<<', pos):  # not a dictionary
+            end = data.find(b'endobj', pos)
+            if end < 0:
+                raise _PDFParseError('endobj not found')
+            return num, data[pos:end].strip(), None
+
+        dict_end = _find_dict_end(data, pos)
+        while dict_end < 0:  # huge dictionary
+            more = self._read(offset + len(data), self._chunk_size)
+            if not more:
+                raise _PDFParseError('unterminated dictionary')
+            data += more
+            dict_end = _find_dict_end(data, pos)
+        obj_dict = data[pos:dict_end]
+
+        m = _re_stream_start.match(data, dict_end)
+        if m is None:
+            return num, obj_dict, None
+        stream_start = m.end()
+        length = None
+        if self._get_ref(obj_dict, b'Length') is None:
+            length = self._get_int(obj_dict, b'Length')
+        if length is None:  # indirect length, look for the end marker instead
+            while True:
+                stream_end = data.find(b'endstream', stream_start)
+                if stream_end >= 0:
+                    break
+                more = self._read(offset + len(data), self._chunk_size)
+                if not more:
+                    raise _PDFParseError('endstream not found')
+                data += more
+            stream = data[stream_start:stream_end].rstrip(b'\r\n')
+        else:
+            if stream_start + length > len(data):
+                data += self._read(offset + len(data), stream_start + length - len(data))
+            stream = data[stream_start:stream_start + length]
+        return num, obj_dict, stream
+
+    def _get_object(self, ref: Tuple[int, int]) -> bytes:
+        num = ref[0]
+        entry = self._xref.get(num)
+        if entry is None or entry[0] == 0:
+            raise _PDFParseError('object %d not found' % num)
+        if entry[0] == 1:
+            obj_num, body, _stream = self._read_object_at(entry[1])
+            if obj_num != num:
+                raise _PDFParseError('object %d not found at its offset' % num)
+            return body
+        return self._get_compressed_object(entry[1], entry[2])
+
+    def _get_compressed_object(self, stream_num: int, index: int) -> bytes:
+        obj_stream = self._obj_streams.get(stream_num)
+        if obj_stream is None:
+            entry = self._xref.get(stream_num)
+            if entry is None or entry[0] != 1:
+                raise _PDFParseError('object stream %d not found' % stream_num)
+            _num, obj_dict, stream = self._read_object_at(entry[1])
+            if stream is None:
+                raise _PDFParseError('invalid object stream %d' % stream_num)
+            obj_stream = (self._get_int(obj_dict, b'First'), self._decode_stream(obj_dict, stream))
+            self._obj_streams[stream_num] = obj_stream
+        first, data = obj_stream
+        header = data[:first].split()
+        offsets = [int(x) for x in header[1::2]]
+        start = first + offsets[index]
+        end = first + offsets[index + 1] if index + 1 < len(offsets) else len(data)
+        return data[start:end].strip()
+
+    def _decode_stream(self, obj_dict: bytes, stream: bytes) -> bytes:
+        m = re.search(rb'/Filter\s*\[?\s*/(\w+)\s*\]?', obj_dict)
+        if m is None:
+            return stream
+        if m.group(1) != b'FlateDecode':
+            raise _PDFParseError('unsupported filter')
+        data = zlib.decompress(stream)
+        predictor = self._get_int(obj_dict, b'Predictor')
+        if predictor is not None and predictor >= 10:
+            columns = self._get_int(obj_dict, b'Columns') or 1
+            data = _undo_png_predictor(data, columns)
+        return data
+
+    @staticmethod
+    def _get_ref(obj_dict: bytes, key: bytes) -> Optional[Tuple[int, int]]:
+        m = re.search(rb'/' + key + rb'\s+(\d+)\s+(\d+)\s+R', obj_dict)
+        if m is None:
+            return None
+        return int(m.group(1)), int(m.group(2))
+
+    @staticmethod
+    def _get_int(obj_dict: bytes, key: bytes) -> Optional[int]:
+        m = re.search(rb'/' + key + rb'\s+(\d+)', obj_dict)
+        if m is None:
+            return None
+        return int(m.group(1))
+
+    @staticmethod
+    def _get_array(obj_dict: bytes, key: bytes) -> Optional[list]:
+        m = re.search(rb'/' + key + rb'\s*\[([^\]]*)\]', obj_dict)
+        if m is None:
+            return None
+        return m.group(1).split()
+
+
+def _find_dict_end(data: bytes, start: int) -> int:
+    """Find the end (exclusive) of the dictionary starting at start, or -1 if it is not complete in data."""
+    depth = 0
+    i = start
+    n = len(data)
+    while i < n:
+        c = data[i:i + 1]
+        if c == b'(':  # literal string, which may contain nested parentheses
+            nesting = 1
+            i += 1
+            while i < n and nesting:
+                c = data[i:i + 1]
+                if c == b'\\':
+                    i += 1
+                elif c == b'(':
+                    nesting += 1
+                elif c == b')':
+                    nesting -= 1
+                i += 1
+            continue
+        if c == b'%':  # comment
+            while i < n and data[i:i + 1] not in (b'\r', b'\n'):
+                i += 1
+            continue
+        if data.startswith(b'<<', i):
+            depth += 1
+            i += 2
+            continue
+        if data.startswith(b'>>', i):
+            depth -= 1
+            i += 2
+            if depth == 0:
+                return i
+            continue
+        if c == b'<':  # hex string
+            end = data.find(b'>', i)
+            if end < 0:
+                return -1
+            i = end + 1
+            continue
+        i += 1
+    return -1
+
+
+def _undo_png_predictor(data: bytes, columns: int) -> bytes:
+    row_size = columns + 1
+    output = bytearray()
+    prev_row = bytearray(columns)
+    for r in range(0, len(data) - len(data) % row_size, row_size):
+        filter_type = data[r]
+        row = bytearray(data[r + 1:r + row_size])
+        for i in range(columns):
+            left = row[i - 1] if i > 0 else 0
+            up = prev_row[i]
+            if filter_type == 1:  # sub
+                row[i] = (row[i] + left) & 0xff
+            elif filter_type == 2:  # up
+                row[i] = (row[i] + up) & 0xff
+            elif filter_type == 3:  # average
+                row[i] = (row[i] + (left + up) // 2) & 0xff
+            elif filter_type == 4:  # paeth
+                up_left = prev_row[i - 1] if i > 0 else 0
+                p = left + up - up_left
+                pa, pb, pc = abs(p - left), abs(p - up), abs(p - up_left)
+                if pa <= pb and pa <= pc:
+                    predicted = left
+                elif pb <= pc:
+                    predicted = up
+                else:
+                    predicted = up_left
+                row[i] = (row[i] + predicted) & 0xff
+            elif filter_type != 0:
+                raise _PDFParseError('unsupported png predictor')
+        output.extend(row)
+        prev_row = row
+    return bytes(output)
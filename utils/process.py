@@ -0,0 +1,19 @@
+import multiprocessing
+import sys
+
+_warned_purposes = set()
+
+
+def can_fork_workers(purpose: str) -> bool:
+    """
+    Check if the current process can start a pool of worker processes. Daemonic processes (e.g. the prefork workers
+    of celery) are not allowed to have children, in which case a warning is printed once for the purpose, and the
+    caller should do the work serially.
+    """
+    if not multiprocessing.current_process().daemon:
+        return True
+    if purpose not in _warned_purposes:
+        _warned_purposes.add(purpose)
+        print('[Warning] Running %s serially in a daemonic process, whose worker should be started with -P solo or '
+              '-P threads to use a process pool' % purpose, file=sys.stderr)
+    return False
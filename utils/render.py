@@ -0,0 +1,157 @@
+import mimetypes
+import os
+import subprocess
+import time
+from typing import List, Optional
+
+import cv2
+import numpy as np
+
+from error import BasicError
+from utils.store import FileStore
+
+
+mimetypes.add_type('image/webp', '.webp')  # unknown to older versions of python
+
+
+class RenderError(BasicError):
+    pass
+
+
+class RenderTool:
+    """
+    Render the pages of answer files into compact images at a few widths (e.g. thumbnail, screen and zoom), which are
+    stored under the data folder by the digest of the file content, so that they are shared by the same content and
+    never rendered twice.
+    """
+    enabled = False
+    widths = [240, 1200, 2400]
+    image_format = 'webp'
+    quality = 80
+    cache_timeout = 7 * 24 * 60 * 60  # 1 week
+    pending_timeout = 10 * 60  # a pending marker older than this is left by a lost job
+
+    _formats = {
+        'webp': ('.webp', cv2.IMWRITE_WEBP_QUALITY),
+        'jpg': ('.jpg', cv2.IMWRITE_JPEG_QUALITY)
+    }
+
+    @classmethod
+    def init(cls, app_config: dict):
+        config = app_config.get('PAGE_RENDITIONS')
+        if not config:
+            return
+        cls.widths = sorted(config.get('widths') or cls.widths)
+        cls.image_format = config.get('format') or cls.image_format
+        if cls.image_format not in cls._formats:
+            raise RenderError('unsupported rendition format: %s' % cls.image_format)
+        cls.quality = config.get('quality') or cls.quality
+        cls.enabled = True
+
+    @classmethod
+    def choose_width(cls, width: Optional[int]) -> int:
+        """Choose the smallest rendition that is at least as wide as requested, or the largest one."""
+        if width:
+            for w in cls.widths:
+                if w >= width:
+                    return w
+        return cls.widths[-1]
+
+    @classmethod
+    def get_rendition_path(cls, md5: str, file_index: Optional[int], width: int) -> str:
+        ext = cls._formats[cls.image_format][0]
+        return os.path.join('renditions', md5[:2], md5, '%d_%d%s' % (file_index or 0, width, ext))
+
+    @staticmethod
+    def list_renditions(md5: str) -> List[str]:
+        """List the paths of the stored renditions of a content, e.g. to remove them with the content."""
+        folder = os.path.join('renditions', md5[:2], md5)
+        try:
+            names = os.listdir(FileStore.get_full_path(folder))
+        except FileNotFoundError:
+            return []
+        return [os.path.join(folder, name) for name in sorted(names) if not name.startswith('.')]
+
+    @staticmethod
+    def _get_pending_marker_path(md5: str, file_index: Optional[int]) -> str:
+        # a hidden file, which is neither served nor mirrored
+        return os.path.join('renditions', md5[:2], md5, '.%d.pending' % (file_index or 0))
+
+    @classmethod
+    def mark_pending(cls, md5: str, file_index: Optional[int]) -> bool:
+        """
+        Mark a page as being rendered by a marker file, so that a page requested again while it is being rendered is
+        not queued again. Return False if the page is already marked (within pending_timeout).
+        """
+        full_path = FileStore.get_full_path(cls._get_pending_marker_path(md5, file_index))
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        try:
+            os.close(os.open(full_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(full_path) < cls.pending_timeout:
+                    return False
+                os.utime(full_path)  # take over the stale marker
+            except FileNotFoundError:  # cleared in the meantime
+                return cls.mark_pending(md5, file_index)
+        return True
+
+    @classmethod
+    def clear_pending(cls, md5: str, file_index: Optional[int]):
+        try:
+            os.remove(FileStore.get_full_path(cls._get_pending_marker_path(md5, file_index)))
+        except FileNotFoundError:
+            pass
+
+    @classmethod
+    def render(cls, file_path: str, md5: str, file_index: Optional[int], work_dir: str) -> List[str]:
+        """
+        Render a page of a file (the file_index-th page of a pdf, or an image if file_index is None) at all the
+        widths. Return the paths (relative to the data folder) of the new renditions, skipping the existing ones.
+        """
+        missing_widths = [w for w in cls.widths
+                          if not os.path.exists(FileStore.get_full_path(cls.get_rendition_path(md5, file_index, w)))]
+        if not missing_widths:
+            return []
+
+        if file_index is None:
+            img = cv2.imread(file_path)
+        else:
+            img = cls._render_pdf_page(file_path, file_index, cls.widths[-1], work_dir)
+        if img is None:
+            raise RenderError('failed to read page image', file_path)
+
+        ext, quality_flag = cls._formats[cls.image_format]
+        rendered_paths = []
+        for width in missing_widths:
+            height, img_width = img.shape[:2]
+            if width < img_width:  # never enlarge the page
+                output = cv2.resize(img, (width, max(1, round(height * width / img_width))),
+                                    interpolation=cv2.INTER_AREA)
+            else:
+                output = img
+            ok, data = cv2.imencode(ext, output, [quality_flag, cls.quality])
+            if not ok:
+                raise RenderError('failed to encode rendition')
+            tmp_path = os.path.join(work_dir, 'rendition%s' % ext)
+            with open(tmp_path, 'wb') as f:
+                f.write(data.tobytes())
+            rendition_path = cls.get_rendition_path(md5, file_index, width)
+            FileStore.put(tmp_path, rendition_path, move=True)
+            rendered_paths.append(rendition_path)
+        return rendered_paths
+
+    @staticmethod
+    def _render_pdf_page(file_path: str, page: int, width: int, work_dir: str) -> np.ndarray:
+        output_prefix = os.path.join(work_dir, 'page')
+        try:
+            subprocess.check_call(['pdftoppm', '-f', str(page), '-l', str(page), '-singlefile', '-scale-to-x',
+                                   str(width), '-scale-to-y', '-1', '-png', file_path, output_prefix])
+        except subprocess.CalledProcessError as e:
+            raise RenderError('pdftoppm command failed [%d]' % e.returncode) from e
+        except FileNotFoundError as e:
+            raise RenderError('pdftoppm command not found') from e
+        output_path = output_prefix + '.png'
+        img = cv2.imread(output_path)
+        os.remove(output_path)
+        return img
@@ -0,0 +1,69 @@
+import os
+import unicodedata
+from typing import Iterable
+
+from flask import request, send_file, safe_join, Response
+from werkzeug.exceptions import NotFound
+from werkzeug.urls import url_quote
+
+from utils.cache import LRUCache
+from utils.crypt import md5sum
+
+# digests of the files without a recorded digest, by (path, size, mtime)
+_digest_cache = LRUCache(max_size=4096)
+
+
+def get_file_digest(full_path: str, stat: os.stat_result, md5: str = None, size: int = None,
+                    mtime: float = None) -> str:
+    """
+    Get the md5 of a file. The recorded md5 is trusted as long as the recorded size and mtime match the file,
+    otherwise the file is hashed once and the digest is memorized until the file is changed.
+    """
+    if md5 is not None and size == stat.st_size and mtime == stat.st_mtime:
+        return md5
+    key = (full_path, stat.st_size, stat.st_mtime)
+    digest = _digest_cache.get(key)
+    if digest is None:
+        digest = md5sum(full_path)
+        _digest_cache.put(key, digest)
+    return digest
+
+
+def send_file_with_digest(directory: str, filename: str, md5: str = None, size: int = None, mtime: float = None,
+                          **kwargs):
+    """
+    Send a file like send_from_directory, but with a strong ETag from the digest of the content. Conditional requests
+    (If-None-Match, If-Modified-Since) and range requests (used by PDF.js to load large files progressively) are
+    supported.
+    """
+    full_path = safe_join(directory, filename)
+    if full_path is None:
+        raise NotFound()
+    try:
+        stat = os.stat(full_path)
+    except (FileNotFoundError, NotADirectoryError):
+        raise NotFound()
+    if not os.path.isfile(full_path):
+        raise NotFound()
+
+    digest = get_file_digest(full_path, stat, md5, size, mtime)
+    rv = send_file(full_path, conditional=False, add_etags=False, **kwargs)
+    rv.set_etag(digest)
+    rv = rv.make_conditional(request, accept_ranges=True, complete_length=stat.st_size)
+    # only set by make_conditional for range requests, but PDF.js needs it in the first response to use ranges
+    rv.headers['Accept-Ranges'] = 'bytes'
+    return rv
+
+
+def send_stream_as_attachment(chunks: Iterable[bytes], filename: str, mimetype: str) -> Response:
+    """Send content generated chunk by chunk as an attachment, without caching it (the length is unknown)."""
+    try:
+        filename.encode('latin-1')
+        disposition = dict(filename=filename)
+    except UnicodeEncodeError:  # like send_file, add an ascii fallback of the name
+        disposition = {'filename': unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode(),
+                       'filename*': "UTF-8''%s" % url_quote(filename, safe=b'')}
+    rv = Response(chunks, mimetype=mimetype, direct_passthrough=True)
+    rv.headers.set('Content-Disposition', 'attachment', **disposition)
+    rv.cache_control.no_store = True
+    return rv
@@ -0,0 +1,108 @@
+import os
+import shutil
+from typing import Optional
+from uuid import uuid4
+
+from utils.crypt import md5sum
+
+
+class FileStore:
+    """
+    Place the files of answer books under the data folder.
+
+    With deduplication enabled, each distinct content is stored once as a blob named by its md5 and the file of a book
+    is a hard link to the blob. The files are always replaced atomically, so that a file being replaced never writes
+    through a hard link into a blob shared with other books.
+    """
+    dedup: bool = False
+    _data_folder: str = None
+
+    @classmethod
+    def init(cls, app_config: dict):
+        cls._data_folder = app_config['DATA_FOLDER']
+        cls.dedup = bool(app_config.get('ANSWER_FILE_DEDUP'))
+
+    @staticmethod
+    def get_book_file_path(book_id: int, path: str) -> str:
+        return os.path.join('answer_books', str(book_id), path)
+
+    @staticmethod
+    def get_blob_path(md5: str) -> str:
+        return os.path.join('blobs', md5[:2], md5)
+
+    @staticmethod
+    def get_original_path(path_id: str, ext: str) -> str:
+        """Get the path of the original upload kept next to a transcoded image of a book, which is not mirrored."""
+        return '%s.original%s' % (path_id, ext)
+
+    @staticmethod
+    def is_original_path(path: str) -> bool:
+        root, ext = os.path.splitext(os.path.basename(path))
+        return ext == '.original' or root.endswith('.original')
+
+    @classmethod
+    def get_stored_path(cls, book_id: int, path: str, blob_md5: Optional[str] = None) -> str:
+        """Get the path where the content of a book file is actually stored, which is also its path in the mirror."""
+        if blob_md5:
+            return cls.get_blob_path(blob_md5)
+        return cls.get_book_file_path(book_id, path)
+
+    @classmethod
+    def get_full_path(cls, rel_path: str) -> str:
+        return os.path.join(cls._data_folder, rel_path)
+
+    @classmethod
+    def put(cls, src_path: str, rel_path: str, move: bool = False, link: bool = False):
+        """
+        Atomically replace the file at rel_path (relative to the data folder) with the file at src_path.
+        The source file is hard linked if link is True (falling back to a copy across file systems), renamed if move
+        is True, otherwise copied.
+        """
+        full_path = cls.get_full_path(rel_path)
+        folder = os.path.dirname(full_path)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        tmp_path = os.path.join(folder, '.%s.tmp' % uuid4())
+        try:
+            if link:
+                try:
+                    os.link(src_path, tmp_path)
+                except OSError:  # e.g. on a different file system
+                    shutil.copyfile(src_path, tmp_path)
+            elif move:
+                shutil.move(src_path, tmp_path)
+            else:
+                shutil.copyfile(src_path, tmp_path)
+            os.replace(tmp_path, full_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @classmethod
+    def has_content(cls, rel_path: str, size: int, md5: str, stored_md5: Optional[str] = None) -> bool:
+        """
+        Check if the file at rel_path exists with the given content, e.g. stored by an interrupted import. The md5 of
+        the stored file is trusted if known (e.g. from its record), otherwise the file is hashed.
+        """
+        full_path = cls.get_full_path(rel_path)
+        try:
+            if os.path.getsize(full_path) != size:
+                return False
+        except FileNotFoundError:
+            return False
+        if stored_md5 is not None:
+            return stored_md5 == md5
+        return md5sum(full_path) == md5
+
+    @classmethod
+    def put_blob(cls, src_path: str, md5: str, move: bool = False) -> str:
+        blob_path = cls.get_blob_path(md5)
+        if not os.path.exists(cls.get_full_path(blob_path)):
+            cls.put(src_path, blob_path, move=move)
+        return blob_path
+
+    @classmethod
+    def remove(cls, rel_path: str):
+        full_path = cls.get_full_path(rel_path)
+        if os.path.exists(full_path):
+            os.remove(full_path)
@@ -1,5 +1,4 @@
-import os
-import shutil
+import posixpath
 from datetime import datetime
 from typing import Iterable
 
@@ -16,37 +15,38 @@ class SubmitImporter(Importer):
     def __init__(self, required_file_names: Iterable[str]):
         self.required_file_names = set(required_file_names)
 
-    def import_archive(self, archive_path: str, extract_dir: str):
-        if not os.path.exists(extract_dir):
-            os.makedirs(extract_dir)
-        if os.listdir(extract_dir):
-            raise SubmitImporterError('extract dir is not empty')
-
+    def scan_archive(self, archive_path: str, extract_dir: str):
         try:
-            shutil.unpack_archive(archive_path, extract_dir)
-        except IOError as e:
-            raise SubmitImporterError('failed to unpack archive', str(e)) from e
+            reader = self._open_archive(archive_path, extract_dir)
+        except ImporterError as e:
+            raise SubmitImporterError(e.msg, e.detail) from e
 
-        root_list = os.listdir(os.path.join(extract_dir))
-        submissions_folder = os.path.join(extract_dir, 'submissions')
-        if not os.path.exists(submissions_folder):
+        root_list = reader.list_dir()
+        submissions_folder = 'submissions'
+        if not reader.is_dir(submissions_folder):
             raise SubmitImporterError('submissions folder not found')
         if 'teams.json' in root_list:
             # TODO add team task support (non-trivial)
             raise SubmitImporterError('team task is not supported', 'please find "TODO" in source code')
 
-        for student_id in sorted(os.listdir(submissions_folder)):
-            submission_info = []
-            user_folder = os.path.join(submissions_folder, student_id)
-            for timestamp in os.listdir(user_folder):
-                submission_time = datetime.strptime(timestamp, _DATETIME_FORMAT)
-                files = {}
-                submission_folder = os.path.join(user_folder, timestamp)
-                for file_name in os.listdir(submission_folder):
-                    if file_name not in self.required_file_names:
-                        continue
-                    files[file_name] = os.path.join(submission_folder, file_name)
-                submission_info.append((submission_time, files))
-            # sort submission info list according to submission time (ascending order)
-            submission_info.sort(key=lambda x: x[0])
-            yield student_id, submission_info
+        for student_id in reader.list_dir(submissions_folder):
+            yield student_id, posixpath.join(submissions_folder, student_id)
+
+    def import_student_folder(self, student_id: str, user_folder: str) -> list:
+        reader = self._get_reader()
+        submission_info = []
+        for timestamp in reader.list_dir(user_folder):
+            submission_time = datetime.strptime(timestamp, _DATETIME_FORMAT)
+            files = {}
+            submission_folder = posixpath.join(user_folder, timestamp)
+            for file_name in reader.list_dir(submission_folder):
+                if file_name not in self.required_file_names:
+                    continue
+                member_path = posixpath.join(submission_folder, file_name)
+                if not reader.is_file(member_path):
+                    continue
+                files[file_name] = self._extract(reader, member_path, student_id, timestamp, file_name)
+            submission_info.append((submission_time, files))
+        # sort submission info list according to submission time (ascending order)
+        submission_info.sort(key=lambda x: x[0])
+        return submission_info
@@ -0,0 +1,82 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from typing import Optional
+
+from werkzeug.datastructures import FileStorage
+
+
+class StagedUpload:
+    """
+    The stream of an uploaded file, which is written to a staging folder while the request body is parsed and hashed
+    at the same time, so that the file can be moved into place by renaming without being read or written again.
+
+    The staged file is removed when the stream is closed, unless it has been moved away.
+    """
+
+    def __init__(self, folder: str, suffix: str = ''):
+        fd, self.path = tempfile.mkstemp(suffix=suffix, prefix='.upload-', dir=folder)
+        os.chmod(self.path, 0o644)  # mkstemp only allows the owner to read
+        self._file = os.fdopen(fd, 'w+b')
+        self._md5 = hashlib.md5()
+        self.size = 0
+
+    @property
+    def md5(self) -> str:
+        return self._md5.hexdigest()
+
+    def write(self, data: bytes) -> int:
+        self._md5.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def close(self):
+        self._file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __iter__(self):
+        return iter(self._file)
+
+
+class UploadTool:
+    _staging_folder = None
+
+    @classmethod
+    def init(cls, app_config: dict):
+        # must be in the same file system as the data folder
+        cls._staging_folder = os.path.join(app_config['DATA_FOLDER'], 'tmp', 'uploads')
+        if not os.path.exists(cls._staging_folder):
+            os.makedirs(cls._staging_folder)
+
+    @classmethod
+    def get_staging_folder(cls) -> str:
+        return cls._staging_folder
+
+    @classmethod
+    def create_stream(cls, filename: str = None) -> StagedUpload:
+        suffix = os.path.splitext(filename)[-1].lower() if filename else ''
+        if len(suffix) > 16:  # not a real extension
+            suffix = ''
+        return StagedUpload(cls._staging_folder, suffix)
+
+    @staticmethod
+    def get_staged(file: FileStorage) -> Optional[StagedUpload]:
+        stream = file.stream
+        if isinstance(stream, StagedUpload):
+            return stream
+        return None
+
+    @classmethod
+    def save(cls, file: FileStorage, dst_path: str):
+        """Save an uploaded file, by renaming it if it has been staged."""
+        staged = cls.get_staged(file)
+        if staged is None:
+            file.save(dst_path)
+            return
+        staged.flush()
+        shutil.move(staged.path, dst_path)
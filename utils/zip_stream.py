@@ -0,0 +1,52 @@
+import os
+import zipfile
+from typing import Iterable, Iterator, Tuple
+
+# formats that are already compressed, which are stored as is
+_compressed_exts = {'.pdf', '.jpg', '.jpeg', '.png', '.webp', '.gif', '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z',
+                    '.rar', '.mp3', '.mp4', '.m4a', '.mov', '.docx', '.xlsx', '.pptx'}
+
+
+class _ChunkBuffer:
+    """An unseekable file that keeps what is written until it is taken, so zipfile writes data descriptors."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip(entries: Iterable[Tuple[str, str]], block_size: int = 1048576) -> Iterator[bytes]:
+    """
+    Generate a zip archive of files, given as (path of the file, name in the archive), chunk by chunk, so that it can
+    be sent while being written without a temporary file. Already compressed formats are stored without compression,
+    and zip64 is used when the archive or a file is too large for the plain zip format.
+    """
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, 'w', allowZip64=True) as f_zip:
+        for file_path, arc_name in entries:
+            zinfo = zipfile.ZipInfo.from_file(file_path, arc_name)
+            if os.path.splitext(file_path)[-1].lower() in _compressed_exts:
+                zinfo.compress_type = zipfile.ZIP_STORED
+            else:
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+            with open(file_path, 'rb') as f_src, f_zip.open(zinfo, 'w') as f_dst:
+                block = f_src.read(block_size)
+                while block:
+                    f_dst.write(block)
+                    data = buffer.take()
+                    if data:
+                        yield data
+                    block = f_src.read(block_size)
+            yield buffer.take()  # the rest of the entry and its data descriptor
+    yield buffer.take()  # the central directory